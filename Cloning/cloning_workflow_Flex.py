@@ -14,6 +14,26 @@ metadata = {
 requirements = {"robotType": "Flex", "apiLevel": "2.21"}
 
 num_rxns = len(combinations_to_make)
+
+# This function indexes every DNA part once, so that each lookup in run() is a single dict access
+def index_dna_parts(dna_plate_map_dict):
+    """Return a dict mapping each DNA part name to its (plate name, well name)."""
+    rows = 'ABCDEFGHIJKLMNOP'
+    dna_part_index = {}
+    for plate_name, plate_map in dna_plate_map_dict.items():
+        for i, row in enumerate(plate_map):
+            for j, dna_name in enumerate(row):
+                if not dna_name:
+                    continue
+                well_name = rows[i] + str(j + 1)
+                if dna_name in dna_part_index:
+                    raise ValueError("DNA piece \"{0}\" is listed twice: {1} {2} and {3} {4}".format(
+                        dna_name, *dna_part_index[dna_name], plate_name, well_name))
+                dna_part_index[dna_name] = (plate_name, well_name)
+    return dna_part_index
+
+dna_part_index = index_dna_parts(dna_plate_map_dict)
+
 volume_buffer = 1
 volume_enzyme = 1
 volume_reaction = 10
@@ -46,14 +66,14 @@ def run(protocol: protocol_api.ProtocolContext):
     
     # ========== this block should be activated if an additional temperature module is used instead of a thermocycler module  ==========
     temp_mod_reaction = protocol.load_module('temperature module gen2', 'A1')
-    temp_mod_reaction.set_temperature(celsius=temp_reaction)
+    temp_mod_reaction.start_set_temperature(celsius=temp_reaction)
     reaction_plate = temp_mod_reaction.load_labware('biorad_96_wellplate_200ul_pcr', 'A1')
 
 
 
     # Load in Water & Enzymer+ Buffer, wash water, dilution water, and wash trough (USA Scientific 12 Well Reservoir 22ml)
     temp_mod = protocol.load_module('temperature module gen2', 'D3')
-    temp_mod.set_temperature(celsius=temp_reagent)
+    temp_mod.start_set_temperature(celsius=temp_reagent)
     trough = temp_mod.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', 'D3')
     buffer_H2O_mix = trough.wells()[0]  # Well A1
     well_enzyme = trough.wells()[1]  # Well B1
@@ -72,40 +92,36 @@ def run(protocol: protocol_api.ProtocolContext):
 
 
     # This function checks the existence of DNA parts and returns for well location of the parts
-    def find_dna(name, dna_plate_map_dict, dna_plate_dict):
+    def find_dna(name, dna_part_index, dna_plate_dict):
         """Return a well containing the named DNA."""
-        well_num=None
-        rows = ['A','B','C','D','E','F','G','H','I','J']
-        columns = [1,2,3,4,5,6,7,8,9,10,11,12]
-        for plate_name, plate_map in dna_plate_map_dict.items():
-            for i, row in enumerate(plate_map):
-                for j, dna_name in enumerate(row):
-                    if dna_name == name:
-                        plate_part = plate_name
-                        if plate_name == 'fixed_toolkit_map':
-                            #well_num = 8 * j + i
-                            well_num = rows[i]+str(columns[j])
-                        elif plate_name == 'custom_parts_map':
-                            #well_num = 4 * j + i
-                            well_num = rows[i]+str(columns[j])
-                         # Check if well_num is assigned a value
-        if well_num is not None:
-            return dna_plate_dict[plate_part].wells_by_name()[well_num]
-            #return [plate_part,well_num]
-
-        # Handle the case where the name is not found
-        print(f"DNA with name '{name}' not found.")
-        return None  # or raise an exception, depending on your requirements   
-                        #return dna_plate_dict[plate_name].wells()[well_num]
-        raise ValueError("Could not find dna piece named \"{0}\"".format(name))
+        if name not in dna_part_index:
+            raise ValueError("Could not find dna piece named \"{0}\"".format(name))
+        plate_name, well_name = dna_part_index[name]
+        return dna_plate_dict[plate_name].wells_by_name()[well_name]
+
+    # This function maps every combination to its well in the reaction plates, filling the plates in order.
+    # The layout is built once and shared by all the transfer steps below.
+    def map_combinations_to_wells(combinations_to_make, plates):
+        """Return a dict mapping each combination name to its destination well."""
+        plate_wells = [well for plate in plates for well in plate.wells()]
+        if len(combinations_to_make) > len(plate_wells):
+            raise ValueError("Too many combinations ({0}) for {1} reaction wells.".format(len(combinations_to_make), len(plate_wells)))
+        reaction_layout = {}
+        for i, combination in enumerate(combinations_to_make):
+            if combination["name"] in reaction_layout:
+                raise ValueError("Combination \"{0}\" is listed twice.".format(combination["name"]))
+            reaction_layout[combination["name"]] = plate_wells[i]
+        return reaction_layout
+
+    reaction_layout = map_combinations_to_wells(combinations_to_make, [reaction_plate])
+    reaction_wells = list(reaction_layout.values())
 
     # This function checks if the DNA parts exist in the DNA plates and returns for well location of output DNA combinations
-    def find_combination(name, combinations_to_make):
+    def find_combination(name, reaction_layout):
         """Return a well containing the named combination."""
-        for i, combination in enumerate(combinations_to_make):
-            if combination["name"] == name:
-                return reaction_plate.wells()[i]
-        raise ValueError("Could not find combination \"{0}\".".format(name))
+        if name not in reaction_layout:
+            raise ValueError("Could not find combination \"{0}\".".format(name))
+        return reaction_layout[name]
 
     combinations_by_part = {}
     for i in combinations_to_make:
@@ -117,6 +133,8 @@ def run(protocol: protocol_api.ProtocolContext):
                 combinations_by_part[j] = [name]
 
     # This section will take the GG buffer and water into the designation wells
+    temp_mod_reaction.await_temperature(celsius=temp_reaction)
+    temp_mod.await_temperature(celsius=temp_reagent)
     protocol.pause('Temperature modules ready!')
     p50_single.configure_for_volume(volume_master_mix)
     p50_single.pick_up_tip()
@@ -125,15 +143,15 @@ def run(protocol: protocol_api.ProtocolContext):
         p50_single.consolidate(
             [volume_waterbuffer_per_reaction],          # volume of water and buffer
             [trough.wells_by_name()[well_name] for well_name in ['A1']],
-            reaction_plate.wells()[i].bottom(z=0.5), new_tip='never')
+            reaction_wells[i].bottom(z=0.5), new_tip='never')
     p50_single.drop_tip()
 
     # This section of the code combines and mix the DNA parts according to the combination list
     # Take one input part and add it in all the combinations it is part of, then do the next input part ...
     p50_single.configure_for_volume(volume_inputDNA)
     for part, combinations in combinations_by_part.items():
-        part_well = find_dna(part, dna_plate_map_dict, dna_plate_dict)
-        combination_wells = [find_combination(x, combinations_to_make) for x in combinations]
+        part_well = find_dna(part, dna_part_index, dna_plate_dict)
+        combination_wells = [find_combination(x, reaction_layout) for x in combinations]
         while combination_wells:
             if len(combination_wells) > 10:
                 current_wells = combination_wells[0:10]
@@ -161,15 +179,15 @@ def run(protocol: protocol_api.ProtocolContext):
         p50_single.pick_up_tip()
 
         p50_single.aspirate(volume_enzyme, well_enzyme.bottom(z=1.5))
-        p50_single.dispense(volume_enzyme,  reaction_plate.wells()[i].bottom(z=1))
+        p50_single.dispense(volume_enzyme,  reaction_wells[i].bottom(z=1))
 
-        p50_single.mix(3, 7, reaction_plate.wells()[i].bottom(z=1))
+        p50_single.mix(3, 7, reaction_wells[i].bottom(z=1))
         p50_single.blow_out()
         p50_single.drop_tip()
 
     # Seal the Reaction Plate with adhesive film and conduct the GG program
-    temp_mod.deactivate()
-    temp_mod_reaction.deactivate()
+    temp_mod_reaction.start_set_temperature(celsius=temp_reaction)
+    temp_mod.start_set_temperature(celsius=temp_reagent)
     protocol.pause( 'Please seal the PCR plates and resume run to conduct GG program.')
     '''
 
@@ -187,8 +205,8 @@ def run(protocol: protocol_api.ProtocolContext):
     #temp_mod.set_temperature(4) #Optional
     protocol.pause('Place remove the seal film of the PCR plates and resume run to conduct heat shock program.')
     '''
-    temp_mod_reaction.set_temperature(celsius=temp_reaction)
-    temp_mod.set_temperature(celsius=temp_reagent)
+    temp_mod_reaction.await_temperature(celsius=temp_reaction)
+    temp_mod.await_temperature(celsius=temp_reagent)
     protocol.pause('Temperature modules ready, add the competent cells in D1')
     p50_single.configure_for_volume(volume_competent_cells)
     # Add competent cells
@@ -196,9 +214,9 @@ def run(protocol: protocol_api.ProtocolContext):
             p50_single.pick_up_tip()
 
             p50_single.aspirate(volume_competent_cells, competent_cell.bottom(z=2), rate =0.2)
-            p50_single.dispense(volume_competent_cells, reaction_plate.wells()[i].bottom(z=2), rate =0.2)
+            p50_single.dispense(volume_competent_cells, reaction_wells[i].bottom(z=2), rate =0.2)
 
-            p50_single.mix(1, 25, reaction_plate.wells()[i].bottom(z=2), rate =0.2)
+            p50_single.mix(1, 25, reaction_wells[i].bottom(z=2), rate =0.2)
             p50_single.blow_out()
             p50_single.drop_tip()
     temp_mod.deactivate()
@@ -223,8 +241,8 @@ def run(protocol: protocol_api.ProtocolContext):
     for i in range(0, num_rxns):
         if i <a:
             p50_single.pick_up_tip()
-            p50_single.mix(3, volume_competent_cells, reaction_plate.wells()[i].bottom(z=2))
-            p50_single.distribute(2.5, reaction_plate.wells()[i].bottom(z=2),
+            p50_single.mix(3, volume_competent_cells, reaction_wells[i].bottom(z=2))
+            p50_single.distribute(2.5, reaction_wells[i].bottom(z=2),
                                   [agar_plate.wells()[i].bottom(z=0).move(position) for position in
                                    [types.Point(x=0, y=0, z=6), types.Point(x=0, y=6, z=5), types.Point(x=6, y=0, z=6),
                                     types.Point(x=0, y=-6, z=5), types.Point(x=-6, y=0, z=6),
@@ -238,8 +256,8 @@ def run(protocol: protocol_api.ProtocolContext):
             if i % a == 0:
                protocol.pause('Please change a new agar plates')    
             p50_single.pick_up_tip()
-            p50_single.mix(2, volume_competent_cells, reaction_plate.wells()[i].bottom(z=2))
-            p50_single.distribute(2.5, reaction_plate.wells()[i].bottom(z=2),
+            p50_single.mix(2, volume_competent_cells, reaction_wells[i].bottom(z=2))
+            p50_single.distribute(2.5, reaction_wells[i].bottom(z=2),
                                   [agar_plate.wells()[i].bottom(z=0).move(position) for position in
                                    [types.Point(x=0, y=0, z=6), types.Point(x=0, y=6, z=5), types.Point(x=6, y=0, z=6),
                                     types.Point(x=0, y=-6, z=5), types.Point(x=-6, y=0, z=6),
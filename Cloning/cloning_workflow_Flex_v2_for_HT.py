@@ -7,6 +7,9 @@
 from opentrons import protocol_api, types
 import time
 import math
+import json
+import zlib
+import base64
 
 
 metadata = {
@@ -15,88 +18,647 @@ metadata = {
 
 requirements = {"robotType": "Flex", "apiLevel": "2.21"}
 
+# Compact protocols (generator --emission compact or compressed) carry compact_payload instead of the plate maps and the
+# combinations: each part name once, referred to by its ID (index in part_names), the plate maps pruned to the parts of
+# the combinations as {plate name: [rows, columns, [[part ID, row, column], ...]]} and the combinations as [name, [part IDs]].
+# In compressed protocols, the payload and the transfer plan are zlib-compressed JSON in base64.
+def decompress_payload(payload):
+    """Return the JSON value held by a payload of a compressed protocol."""
+    return json.loads(zlib.decompress(base64.b64decode(payload)))
+
+def expand_compact_payload(payload):
+    """Return the plate maps, the combinations and the (rows, columns) of each plate map of a compact payload."""
+    if isinstance(payload, str):
+        payload = decompress_payload(payload)
+    part_names = payload['part_names']
+    dna_plate_map_dict = {}
+    part_plate_extents = {}
+    for plate_name, (nb_rows, nb_columns, wells) in payload['plate_maps'].items():
+        plate_map = [['' for j in range(nb_columns)] for i in range(nb_rows)]
+        for part_id, i, j in wells:
+            plate_map[i][j] = part_names[part_id]
+        dna_plate_map_dict[plate_name] = plate_map
+        part_plate_extents[plate_name] = (nb_rows, nb_columns)
+    combinations_to_make = [{"name": name, "parts": [part_names[part_id] for part_id in part_ids]} for name, part_ids in payload['combinations']]
+    return dna_plate_map_dict, combinations_to_make, part_plate_extents
+
+# The pruned plate maps keep the rows and columns of the full maps, so that the same part plate labware is loaded
+part_plate_extents = {}
+if compact_payload is not None:
+    dna_plate_map_dict, combinations_to_make, part_plate_extents = expand_compact_payload(compact_payload)
+
 num_rxns = len(combinations_to_make)
-volume_buffer = 1.2
-volume_enzyme = 1.2
-volume_reaction = 12
-nb_parts = 6
-volume_inputDNA = 1
-volume_waterbuffer_per_reaction = volume_reaction - volume_buffer - nb_parts * volume_inputDNA
-volume_master_mix = volume_enzyme + volume_waterbuffer_per_reaction
+
+# Reaction plate format, chosen in the generator (reaction_plate_format): labware and rows of the reaction plate, adapter
+# on the temperature module and default reaction profile. 384-well plates take low-volume reactions.
+reaction_plate_formats = {
+    96: {'labware': 'biorad_96_wellplate_200ul_pcr', 'rows': 8, 'adapter': 'opentrons_96_well_aluminum_block', 'reaction_profile': 'standard'},
+    384: {'labware': 'biorad_384_wellplate_50ul', 'rows': 16, 'adapter': None, 'reaction_profile': 'low_volume'},
+}
+if reaction_plate_format not in reaction_plate_formats:
+    raise ValueError("Unknown reaction plate format {0}, choose one of {1}".format(reaction_plate_format, ', '.join(str(x) for x in reaction_plate_formats)))
+reaction_plate_profile = reaction_plate_formats[reaction_plate_format]
+
+# Reaction profiles, chosen in the generator (reaction_profile, else the default of the plate format): volumes (uL)
+# of the reaction, of its buffer and enzyme, of each DNA part, of the competent cells and of each plating spot.
+# The water of a reaction is what the buffer, the enzyme and its DNA parts leave of the reaction volume.
+# DNA parts and spots stay at or above the pipette minimum (min_pipette_volume), smaller buffer, enzyme and water
+# volumes go through the master mixes (master_mix_mode).
+reaction_profiles = {
+    'standard': {'reaction': 12, 'buffer': 1.2, 'enzyme': 1.2, 'dna_per_part': 1, 'competent_cells': 50, 'spot': 2.5},
+    'low_volume': {'reaction': 8, 'buffer': 0.8, 'enzyme': 0.8, 'dna_per_part': 1, 'competent_cells': 25, 'spot': 1.25},
+}
+if reaction_profile is None:
+    reaction_profile = reaction_plate_profile['reaction_profile']
+if reaction_profile not in reaction_profiles:
+    raise ValueError("Unknown reaction profile \"{0}\", choose one of {1}".format(reaction_profile, ', '.join(reaction_profiles)))
+
+# Part plates: the smallest plate (rows, columns, labware) the plate map fits in
+part_plate_formats = [(8, 12, 'biorad_96_wellplate_200ul_pcr'), (16, 24, 'biorad_384_wellplate_50ul')]
+
+def part_plate_labware(plate_name, plate_map):
+    """Return the load name of the part plate for a plate map of up to 16 rows and 24 columns."""
+    if plate_name in part_plate_extents:
+        nb_rows, nb_columns = part_plate_extents[plate_name]
+    else:
+        nb_rows = max((i + 1 for i, row in enumerate(plate_map) if any(row)), default=0)
+        nb_columns = max((j + 1 for row in plate_map for j, dna_name in enumerate(row) if dna_name), default=0)
+    for max_rows, max_columns, load_name in part_plate_formats:
+        if nb_rows <= max_rows and nb_columns <= max_columns:
+            return load_name
+    raise ValueError("Plate map \"{0}\" has {1} rows and {2} columns, part plates have at most 16 rows and 24 columns".format(
+        plate_name, nb_rows, nb_columns))
+
+# This function indexes every DNA part once, so that each lookup in run() is a single dict access.
+# Parts are indexed by their row and column in the plate map, the well itself is taken from the labware.
+def index_dna_parts(dna_plate_map_dict):
+    """Return a dict mapping each DNA part name to its (plate name, row index, column index)."""
+    dna_part_index = {}
+    for plate_name, plate_map in dna_plate_map_dict.items():
+        part_plate_labware(plate_name, plate_map)
+        for i, row in enumerate(plate_map):
+            for j, dna_name in enumerate(row):
+                if not dna_name:
+                    continue
+                if dna_name in dna_part_index:
+                    other_plate_name, other_i, other_j = dna_part_index[dna_name]
+                    raise ValueError("DNA piece \"{0}\" is listed twice: {1} row {2} column {3} and {4} row {5} column {6}".format(
+                        dna_name, other_plate_name, other_i + 1, other_j + 1, plate_name, i + 1, j + 1))
+                dna_part_index[dna_name] = (plate_name, i, j)
+    return dna_part_index
+
+dna_part_index = index_dna_parts(dna_plate_map_dict)
+
+volume_buffer = reaction_profiles[reaction_profile]['buffer']
+volume_enzyme = reaction_profiles[reaction_profile]['enzyme']
+volume_reaction = reaction_profiles[reaction_profile]['reaction']
+volume_inputDNA = reaction_profiles[reaction_profile]['dna_per_part']
+
+# This function computes the water of a reaction from its number of parts
+def water_volume(combination):
+    """Return the volume (uL) of water that brings the reaction to the reaction volume of the profile."""
+    volume = round(volume_reaction - volume_buffer - volume_enzyme - len(combination["parts"]) * volume_inputDNA, 2)
+    if volume < 0:
+        raise ValueError("Combination \"{0}\" has too many parts ({1}) for {2} uL reactions".format(
+            combination["name"], len(combination["parts"]), volume_reaction))
+    return volume
+
+# Reactions taking the same volume of water are multi-dispensed together
+def group_by_water_volume(combinations_to_make):
+    """Return a dict mapping each water volume to the names of the combinations taking it, in plate order."""
+    water_groups = {}
+    for combination in combinations_to_make:
+        water_groups.setdefault(water_volume(combination), []).append(combination["name"])
+    return water_groups
+
+water_groups = group_by_water_volume(combinations_to_make)
 
 volume_tubes_competent = 1100
 volume_tubes_competent_safe = volume_tubes_competent - 100
-volume_competent_cells = 50
-nb_reaction_per_tube = volume_tubes_competent_safe // volume_competent_cells
+volume_competent_cells = reaction_profiles[reaction_profile]['competent_cells']
+nb_reaction_per_tube = int(volume_tubes_competent_safe // volume_competent_cells)
+# Mix after adding the cells, kept under the liquid of smaller reactions so that no air is drawn in
+volume_competent_cells_mix = min(25, 0.8 * (volume_reaction + volume_competent_cells))
+
+# Plating: volume of each spot, the number of spots per construct is set by the agar plate format
+volume_spot = reaction_profiles[reaction_profile]['spot']
+volume_spot_disposal = volume_spot * 0.6
+
+# Smallest volume (uL) the 50 uL pipettes transfer accurately, see the volume checks after the master-mix mode
+min_pipette_volume = 1
 
 temp_reaction = 4
 temp_reagent = 4
 
+# Agar plate formats, chosen with agar_plate_format: labware, sites and spot layout of each construct.
+# sites: rows and columns of constructs per plate, one per well, or a grid spaced by site_pitch (mm) on the single
+# well of an omnitray (no Opentrons definition of the OmniTray, a single-well reservoir of its footprint stands in).
+# The spots of a construct are laid out by pattern ('grid', 'rings' or 'spiral') within radius (mm) of the centre of
+# its site, at height (mm) above the well bottom.
+agar_plate_formats = {
+    6: {'labware': 'corning_6_wellplate_16.8ml_flat', 'sites': (2, 3), 'site_pitch': None, 'spots': 13, 'pattern': 'rings', 'radius': 12, 'height': 6},
+    24: {'labware': 'corning_24_wellplate_3.4ml_flat', 'sites': (4, 6), 'site_pitch': None, 'spots': 5, 'pattern': 'rings', 'radius': 5, 'height': 4},
+    48: {'labware': 'corning_48_wellplate_1.6ml_flat', 'sites': (6, 8), 'site_pitch': None, 'spots': 5, 'pattern': 'rings', 'radius': 3.5, 'height': 4},
+    'omnitray': {'labware': 'axygen_1_reservoir_90ml', 'sites': (8, 12), 'site_pitch': 9, 'spots': 4, 'pattern': 'grid', 'radius': 3, 'height': 3},
+}
+# Chosen in the generator (--agar-plate-format), else:
+if agar_plate_format is None:
+    agar_plate_format = 6
+if agar_plate_format not in agar_plate_formats:
+    raise ValueError("Unknown agar plate format {0}, choose one of {1}".format(agar_plate_format, ', '.join(str(x) for x in agar_plate_formats)))
+agar_plate_profile = agar_plate_formats[agar_plate_format]
+
+def spot_diameter(volume):
+    """Return the diameter (mm) of a spot of volume (uL) on the agar, taken as a hemisphere."""
+    return 2 * (3 * volume / (2 * math.pi)) ** (1 / 3)
+
+def spot_pattern(pattern, nb_spots, radius):
+    """Return the (x, y) offsets (mm) of nb_spots spots within radius of the centre.
+
+    grid: the points of a square grid closest to the centre, rings: the centre then rings of 4, 8, 12... spots,
+    spiral: a sunflower spiral from the centre to the rim."""
+    if nb_spots == 1:
+        return [(0, 0)]
+    if pattern == 'grid':
+        side = math.ceil(math.sqrt(nb_spots))
+        pitch = 2 * radius / math.sqrt(2) / (side - 1)
+        points = [((column - (side - 1) / 2) * pitch, ((side - 1) / 2 - row) * pitch) for row in range(side) for column in range(side)]
+        return sorted(points, key=lambda point: math.hypot(*point))[:nb_spots]
+    if pattern == 'rings':
+        nb_rings = 1
+        while 1 + 2 * nb_rings * (nb_rings + 1) < nb_spots:
+            nb_rings += 1
+        points = [(0, 0)]
+        for ring in range(1, nb_rings + 1):
+            nb_ring_spots = min(4 * ring, nb_spots - len(points))
+            ring_radius = radius * ring / nb_rings
+            points += [(ring_radius * math.sin(2 * math.pi * k / nb_ring_spots), ring_radius * math.cos(2 * math.pi * k / nb_ring_spots))
+                       for k in range(nb_ring_spots)]
+        return points
+    if pattern == 'spiral':
+        golden_angle = math.pi * (3 - math.sqrt(5))
+        return [(radius * math.sqrt(k / (nb_spots - 1)) * math.cos(k * golden_angle), radius * math.sqrt(k / (nb_spots - 1)) * math.sin(k * golden_angle))
+                for k in range(nb_spots)]
+    raise ValueError("Unknown spot pattern \"{0}\", choose one of grid, rings, spiral".format(pattern))
+
+def agar_sites(agar_plate_profile):
+    """Return the (well index, x, y) of the site of each construct on an agar plate, column by column."""
+    nb_rows, nb_columns = agar_plate_profile['sites']
+    pitch = agar_plate_profile['site_pitch']
+    if pitch is None:
+        return [(well_index, 0, 0) for well_index in range(nb_rows * nb_columns)]
+    return [(0, (column - (nb_columns - 1) / 2) * pitch, ((nb_rows - 1) / 2 - row) * pitch)
+            for column in range(nb_columns) for row in range(nb_rows)]
+
+# Spot layout, computed once: the spots of a construct must not touch each other nor the spots of the next site
+spot_offsets = spot_pattern(agar_plate_profile['pattern'], agar_plate_profile['spots'], agar_plate_profile['radius'])
+spot_spacing = min((math.hypot(x1 - x2, y1 - y2) for i, (x1, y1) in enumerate(spot_offsets) for x2, y2 in spot_offsets[i + 1:]), default=math.inf)
+if agar_plate_profile['site_pitch'] is not None:
+    spot_spacing = min(spot_spacing, agar_plate_profile['site_pitch'] - 2 * agar_plate_profile['radius'])
+if spot_spacing < spot_diameter(volume_spot):
+    raise ValueError("Spots of {0} uL are {1:.1f} mm wide, more than the {2:.1f} mm between the spots of the {3} agar plate format".format(
+        volume_spot, spot_diameter(volume_spot), spot_spacing, agar_plate_format))
+agar_plate_sites = agar_sites(agar_plate_profile)
+constructs_per_plate = len(agar_plate_sites)
+
+# Agar plate exchange (Flex gripper): fresh agar plates wait in the deck slots left free by the tip racks, in the slots
+# of the tip racks spent before plating and in the staging slots, and the gripper swaps each full plate in C1 with a
+# fresh one, through one slot kept empty. Once all the slots hold full plates, the operator replaces them with fresh
+# ones in a single pause. Chosen in the generator (--agar-exchange), else:
+if agar_exchange_mode is None:
+    agar_exchange_mode = False
+agar_staging_slots = ['B4', 'C4']  # Staging area slots, A4 and D4 are left out by the trash bin (A3) and the reagent module (D3)
+
+# 8-channel mode: column-aligned reactions get water, buffer, enzyme and competent cells one column at a time
+# (water only for the columns whose reactions all take the same volume of water).
+# Reagents then sit in columns of a deep-well plate on the D3 temperature module:
+# column 1 water, column 2 enzyme, column 3 competent cells, column 5 buffer.
+# Chosen in the generator (--multichannel), else:
+if multichannel_mode is None:
+    multichannel_mode = False
+
+# 8-channel plating (8-channel mode, omnitray agar format): the reactions of a column block are mixed and spotted
+# together onto the sites of the same tray column, 9 mm apart like the nozzles. Ragged columns are plated one by one.
+# Chosen in the generator (--multichannel-plating), else:
+if multichannel_plating is None:
+    multichannel_plating = False
+
+# Tip policy for the DNA parts (Step 2):
+# 'strict': a fresh tip for every part and reaction, no risk of carry-over between reactions
+# 'multi_dispense': one tip per part, aspirating for up to nb_dispense_per_aspiration reactions at a time
+# 'multi_dispense_wash': as 'multi_dispense', and the tip is rinsed in the dilution water before aspirating the part again
+# Chosen in the generator (--dna-tip-policy), else:
+if dna_tip_policy is None:
+    dna_tip_policy = 'strict'
+nb_dispense_per_aspiration = 10
+
+# Step 2 schedule: parts visited in the column order of the part plates, and the reactions of each part in serpentine
+# order (down a column of the reaction plate, up the next one) instead of the order of the combinations file
+travel_schedule = True
+
+# Thermocycler mode: the reaction plate stays for the whole run on a Flex thermocycler (slots A1 and B1) instead of the
+# A1 temperature module, and the Golden Gate cycles, the heat shock and the outgrowth run on deck instead of an external
+# cycler. The heated lid replaces the adhesive film. 96-well reaction plates only.
+# The programs are compiled by the generator (thermocycler_programs, see thermocycler_profiles.py) into
+# (steps, repetitions) segments, one execute_profile call each. Chosen in the generator (--thermocycler), else:
+if thermocycler_mode is None:
+    thermocycler_mode = False
+temp_lid = 105
+temp_outgrowth = 37
+
+if thermocycler_mode and reaction_plate_format != 96:
+    raise ValueError("Thermocycler mode needs a 96-well reaction plate, the Flex thermocycler does not take 384-well plates")
+
+# Master-mix mode: buffer, enzyme and water are premixed by the operator, one tube per water group, and multi-dispensed
+# in Step 1 before the DNA parts. Step 3 is then only a final mix of each reaction, done with the tip of the last
+# DNA part in the 'strict' DNA tip policy. Master mixes sit in A3 -> C6 of the tube block, or in columns 6 -> 12
+# of the reagent plate in 8-channel mode. Chosen in the generator (--master-mix), else:
+if master_mix_mode is None:
+    master_mix_mode = False
+
+# Buffer, enzyme or water volumes under the pipette minimum are only pipetted within a master mix, and the protocol is
+# refused when a DNA part, a plating spot or a master mix of a reaction is still under it
+small_reagent_volumes = {'buffer': volume_buffer, 'enzyme': volume_enzyme}
+small_reagent_volumes.update({f'water {volume:g} uL group': volume for volume in water_groups if volume})
+small_reagent_volumes = [f'{name} {volume:g} uL' for name, volume in small_reagent_volumes.items() if volume < min_pipette_volume]
+if small_reagent_volumes:
+    master_mix_mode = True
+small_volumes = {'DNA part': volume_inputDNA, 'plating spot': volume_spot}
+if master_mix_mode:
+    small_volumes.update({f'master mix of the water {volume:g} uL group': volume + volume_buffer + volume_enzyme for volume in water_groups})
+small_volumes = [f'{name} {volume:g} uL' for name, volume in small_volumes.items() if volume < min_pipette_volume]
+if small_volumes:
+    raise ValueError("Volumes under the {0} uL pipette minimum: {1}, choose a larger reaction profile".format(min_pipette_volume, ', '.join(small_volumes)))
+
+if multichannel_mode and reaction_plate_format != 96:
+    raise ValueError("8-channel mode needs a 96-well reaction plate, the nozzles only reach every other row of a 384-well plate")
+if multichannel_plating and not (multichannel_mode and agar_plate_profile['site_pitch'] == 9):
+    raise ValueError("8-channel plating needs the 8-channel mode and the omnitray agar format, whose sites are 9 mm apart like the nozzles")
+
+dna_tip_policies = ['strict', 'multi_dispense', 'multi_dispense_wash']
+if dna_tip_policy not in dna_tip_policies:
+    raise ValueError("Unknown DNA tip policy \"{0}\", choose one of {1}".format(dna_tip_policy, ', '.join(dna_tip_policies)))
+
+# Approximate durations (s) of the Step 2 moves, used to compare the DNA tip policies in the setup message
+time_tip_change = 16  # pick up + drop tip
+time_aspirate = 6
+time_dispense = 5
+time_wash = 14  # 2 mixes in the dilution water + blow out
+time_mix = 8  # 3 mixes + blow out
+
+# This function estimates Step 2 for a DNA tip policy, part_counts being the number of reactions of each part
+def estimate_dna_step(policy, part_counts):
+    """Return the (tips, seconds) needed to add the DNA parts with the given policy."""
+    if policy == 'strict':
+        nb_transfers = sum(part_counts)
+        return nb_transfers, nb_transfers * (time_tip_change + time_aspirate + time_dispense)
+    nb_aspirations = sum(math.ceil(n / nb_dispense_per_aspiration) for n in part_counts)
+    seconds = len(part_counts) * time_tip_change + nb_aspirations * time_aspirate + sum(part_counts) * time_dispense
+    if policy == 'multi_dispense_wash':
+        seconds += (nb_aspirations - len(part_counts)) * time_wash
+    return len(part_counts), seconds
+
+# This function estimates Steps 1 and 3 (water, buffer and enzyme) with or without the master mixes, for the 1-channel pipette
+def estimate_reagent_steps(master_mix, water_groups, dna_tip_policy):
+    """Return the (tips, seconds) needed to add the water, buffer and enzyme and mix the reactions."""
+    nb_rxns = sum(len(names) for names in water_groups.values())
+    def nb_passes(volume, nb_wells):
+        return math.ceil(nb_wells / (2 * (30 // math.ceil(volume))))
+    if master_mix:
+        passes = sum(nb_passes(volume + volume_buffer + volume_enzyme, len(names)) for volume, names in water_groups.items())
+        mix_tips = 0 if dna_tip_policy == 'strict' else nb_rxns
+        tips = passes + mix_tips
+        return tips, tips * time_tip_change + passes * 2 * time_aspirate + nb_rxns * (time_dispense + time_mix)
+    passes = sum(nb_passes(volume, len(names)) for volume, names in water_groups.items() if volume) + nb_passes(volume_buffer, nb_rxns)
+    tips = passes + nb_rxns
+    return tips, tips * time_tip_change + passes * 2 * time_aspirate + nb_rxns * (2 * time_dispense + time_aspirate + time_dispense + time_mix)
+
+# Deck model for the gantry travel of Step 2: front-left corner (mm) of each slot, and position of well A1 in a plate
+deck_slot_origins = {'A1': (0, 321), 'A2': (164, 321), 'A3': (328, 321), 'B1': (0, 214), 'B2': (164, 214), 'B3': (328, 214),
+                     'C1': (0, 107), 'C2': (164, 107), 'C3': (328, 107), 'D1': (0, 0), 'D2': (164, 0), 'D3': (328, 0)}
+well_a1_offset = (14, 74)
+well_pitches = {'biorad_96_wellplate_200ul_pcr': 9, 'biorad_384_wellplate_50ul': 4.5}
+part_plate_slots = ['C2', 'D2']
+
+# This function gives the position of a well on the deck, or of the centre of the slot without a row and column
+def deck_position(slot, row=None, column=None, pitch=9):
+    """Return the (x, y) position (mm) of a well of the plate in the slot."""
+    x, y = deck_slot_origins[slot]
+    if row is None:
+        return (x + 64, y + 43)
+    return (x + well_a1_offset[0] + column * pitch, y + well_a1_offset[1] - row * pitch)
+
+# This function returns the row and column indices of a well name, e.g. 'B3' -> (1, 2) and 'P24' -> (15, 23)
+def well_coordinates(well_name):
+    """Return the (row index, column index) of a well name."""
+    return ord(well_name[0]) - ord('A'), int(well_name[1:]) - 1
+
+# This function reorders the parts and their reactions to shorten the gantry travel of Step 2
+def schedule_dna_transfers(combinations_by_part, reaction_well_names):
+    """Return combinations_by_part with the parts in column order of the part plates and the reactions of each part in serpentine order."""
+    plate_names = list(dna_plate_map_dict)
+    def part_key(part):
+        plate_name, i, j = dna_part_index[part]
+        return plate_names.index(plate_name), j, i
+    def serpentine_key(name):
+        row, column = well_coordinates(reaction_well_names[name])
+        return column, row if column % 2 == 0 else -row
+    return {part: sorted(combinations_by_part[part], key=serpentine_key) for part in sorted(combinations_by_part, key=part_key)}
+
+# This function estimates the gantry travel of Step 2 for a DNA tip policy: tips are taken from B3, dropped in the
+# trash in A3 and rinsed in the dilution water on D3
+def estimate_dna_travel(policy, combinations_by_part, reaction_well_names):
+    """Return the gantry travel (m) needed to add the DNA parts in the given order."""
+    tips, trash, dilution_water = deck_position('B3'), deck_position('A3'), deck_position('D3')
+    plate_names = list(dna_plate_map_dict)
+    reaction_pitch = well_pitches[reaction_plate_profile['labware']]
+    path = []
+    for part, combinations in combinations_by_part.items():
+        plate_name, i, j = dna_part_index[part]
+        part_pitch = well_pitches[part_plate_labware(plate_name, dna_plate_map_dict[plate_name])]
+        source = deck_position(part_plate_slots[plate_names.index(plate_name)], i, j, part_pitch)
+        destinations = [deck_position('A1', *well_coordinates(reaction_well_names[name]), reaction_pitch) for name in combinations]
+        if policy == 'strict':
+            for destination in destinations:
+                path += [tips, source, destination, trash]
+            continue
+        path.append(tips)
+        for k in range(0, len(destinations), nb_dispense_per_aspiration):
+            if k and policy == 'multi_dispense_wash':
+                path.append(dilution_water)
+            path += [source] + destinations[k:k + nb_dispense_per_aspiration]
+        path.append(trash)
+    return sum(math.dist(a, b) for a, b in zip(path, path[1:])) / 1000
+
+# Step 2 transfer plan, compiled by the generator (transfer_plan) so that run() only executes it. It gives the DNA tip
+# policy, the gantry travel (m) in input order and scheduled, and one transfer per tip, in order:
+# [part, part plate name, part well, volume (uL), reaction wells of each aspiration, reaction well to mix or ''].
+# Without a compiled plan (transfer_plan = None), run() compiles it.
+def compile_transfer_plan(combinations_to_make):
+    """Return the Step 2 transfer plan of the combinations, for the reaction wells filled in order, column by column."""
+    rows = 'ABCDEFGHIJKLMNOP'
+    nb_rows = reaction_plate_profile['rows']
+    reaction_well_names = {combination["name"]: rows[i % nb_rows] + str(i // nb_rows + 1) for i, combination in enumerate(combinations_to_make)}
+    combinations_by_part = {}
+    for combination in combinations_to_make:
+        for part in combination["parts"]:
+            if part not in dna_part_index:
+                raise ValueError("Could not find dna piece named \"{0}\"".format(part))
+            combinations_by_part.setdefault(part, []).append(combination["name"])
+
+    input_order_travel = estimate_dna_travel(dna_tip_policy, combinations_by_part, reaction_well_names)
+    if travel_schedule:
+        combinations_by_part = schedule_dna_transfers(combinations_by_part, reaction_well_names)
+    scheduled_travel = estimate_dna_travel(dna_tip_policy, combinations_by_part, reaction_well_names)
+
+    # In master-mix mode, the tip of the last DNA part of each reaction mixes it ('strict' DNA tip policy)
+    last_part = {name: part for part, names in combinations_by_part.items() for name in names}
+    transfers = []
+    for part, names in combinations_by_part.items():
+        plate_name, i, j = dna_part_index[part]
+        part_well = rows[i] + str(j + 1)
+        if dna_tip_policy == 'strict':
+            for name in names:
+                mix_well = reaction_well_names[name] if master_mix_mode and last_part[name] == part else ''
+                transfers.append([part, plate_name, part_well, volume_inputDNA, [[reaction_well_names[name]]], mix_well])
+            continue
+        wells = [reaction_well_names[name] for name in names]
+        aspirations = [wells[k:k + nb_dispense_per_aspiration] for k in range(0, len(wells), nb_dispense_per_aspiration)]
+        transfers.append([part, plate_name, part_well, volume_inputDNA, aspirations, ''])
+    return {'dna_tip_policy': dna_tip_policy, 'travel': [round(input_order_travel, 2), round(scheduled_travel, 2)], 'dna_transfers': transfers}
+
 def run(protocol: protocol_api.ProtocolContext):
 
-    # Compute needed tips
-    def calculate_tips_needed():
-        # 1. Tips for buffer/water: 1 tip total
-        nb_per_disp = 2 * (50 // volume_waterbuffer_per_reaction)  # number of wells that can be distributed per dispense (2 distribute per tip)
-        buffer_tips = num_rxns // nb_per_disp
-
-        # 2. Tips for DNA parts: 1 tip per parts per combination
-        dna_tips = 0
-        combinations_by_part = {}
-        for combo in combinations_to_make:
-            for part in combo["parts"]:
-                if part in combinations_by_part:
-                    combinations_by_part[part] += 1
-                else:
-                    combinations_by_part[part] = 1
-        dna_tips = sum(combinations_by_part.values())
-
-        # 3. Tips for enzyme: 1 tip per reaction
-        enzyme_tips = num_rxns
-
-        # 4. Tips for competent cells: 1 tip per reaction
-        competent_tips = num_rxns
-
-        # 5. Tips for plating: 1 tip per reaction
-        plating_tips = num_rxns
-
-        total_tips = buffer_tips + dna_tips + enzyme_tips + competent_tips + plating_tips
-
-        # Add a 10% safety margin
-        total_tips = int(total_tips * 1.1)
-
-        return total_tips, {
-            'buffer': buffer_tips,
-            'dna': dna_tips,
-            'enzyme': enzyme_tips,
-            'competent': competent_tips,
-            'plating': plating_tips
-        }
-
-    # Calculation of reagent quantities
-    total_buffer_needed = volume_waterbuffer_per_reaction * num_rxns
-    total_enzyme_needed = volume_enzyme * num_rxns
-    total_competent_cells_needed = volume_competent_cells * num_rxns
-
-    tips_needed, tips_breakdown = calculate_tips_needed()
+    # Load modules
+    # Temperatures are set without waiting: the modules cool down during the setup pause and are awaited before Step 1
+    if thermocycler_mode:
+        tc_mod = protocol.load_module('thermocyclerModuleV2')
+        reaction_plate = tc_mod.load_labware(reaction_plate_profile['labware'])
+        tc_mod.open_lid()
+    else:
+        temp_mod_reaction = protocol.load_module('temperature module gen2', 'A1')
+        temp_mod_reaction.start_set_temperature(celsius=temp_reaction)
+        if reaction_plate_profile['adapter']:
+            temp_adapter = temp_mod_reaction.load_adapter(reaction_plate_profile['adapter'])
+            reaction_plate = temp_adapter.load_labware(reaction_plate_profile['labware'])
+        else:
+            reaction_plate = temp_mod_reaction.load_labware(reaction_plate_profile['labware'])
+
+    temp_mod = protocol.load_module('temperature module gen2', 'D3')
+    temp_mod.start_set_temperature(celsius=temp_reagent)
+    if multichannel_mode:
+        reagent_adapter = temp_mod.load_adapter('opentrons_96_deep_well_temp_mod_adapter')
+        reagent_plate = reagent_adapter.load_labware('nest_96_wellplate_2ml_deep', 'Reagent Columns')
+        water_column = reagent_plate.columns()[0]  # Column 1
+        enzyme_column = reagent_plate.columns()[1]  # Column 2
+        competent_cells_column = reagent_plate.columns()[2]  # Column 3
+        buffer_column = reagent_plate.columns()[4]  # Column 5
+        well_water = water_column[0]  # Well A1
+        well_enzyme = enzyme_column[0]  # Well A2
+        competent_cells = [competent_cells_column[0]]  # Well A3
+        dilution_water = reagent_plate.columns()[3][0]  # Well A4
+        well_buffer = buffer_column[0]  # Well A5
+        master_mix_columns = reagent_plate.columns()[5:]  # Columns 6 -> 12
+        master_mix_wells = [column[0] for column in master_mix_columns]
+    else:
+        trough = temp_mod.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', 'D3')
+        well_water = trough.wells()[0]  # Well A1
+        well_enzyme = trough.wells()[1]  # Well B1
+        dilution_water = trough.wells()[2]  # Well C1
+        #competent_cell = trough.wells()[3]  # Well D1
+        competent_cells = [trough.wells()[3], trough.wells()[7], trough.wells()[11], trough.wells()[15], trough.wells()[19]]  # Well D1 -> D5
+        liquid_waste = trough.wells()[4]  # Well A2
+        well_buffer = trough.wells()[5]  # Well B2
+        master_mix_wells = [trough.wells_by_name()[well_name] for well_name in ['A3', 'B3', 'C3', 'A4', 'B4', 'C4', 'A5', 'B5', 'C5', 'A6', 'B6', 'C6']]
+    if master_mix_mode and len(water_groups) > len(master_mix_wells):
+        raise ValueError('{0} master mixes are needed, one per water volume, but there is only room for {1}.'.format(
+            len(water_groups), len(master_mix_wells)))
+
+    # Load in Input DNA Plate
+
+    dna_plate_dict = {}
+    plate_name = list(dna_plate_map_dict.keys())
+    dna_plate_dict[plate_name[0]] = protocol.load_labware(part_plate_labware(plate_name[0], dna_plate_map_dict[plate_name[0]]), 'C2', 'Input DNA Plate')
+    #activate the following line by deleting '#' if a second custom_parts_map needs to be used
+    #dna_plate_dict[plate_name[1]] = protocol.load_labware(part_plate_labware(plate_name[1], dna_plate_map_dict[plate_name[1]]), 'D2', 'Input DNA Plate2')
+
+    # Load in Agar plate
+    agar_plate = protocol.load_labware(agar_plate_profile['labware'], 'C1', 'Agar Plate')
+
+
+    # This function checks the existance of DNA parts and returns for well location of the parts
+    def find_dna(name, dna_part_index, dna_plate_dict):
+        """Return a well containing the named DNA."""
+        if name not in dna_part_index:
+            raise ValueError("Could not find dna piece named \"{0}\"".format(name))
+        plate_name, i, j = dna_part_index[name]
+        return dna_plate_dict[plate_name].rows()[i][j]
+
+    # This function maps every combination to its well in the reaction plates, filling the plates in order.
+    # The layout is built once and shared by all the transfer steps below.
+    def map_combinations_to_wells(combinations_to_make, plates):
+        """Return a dict mapping each combination name to its destination well."""
+        plate_wells = [well for plate in plates for well in plate.wells()]
+        if len(combinations_to_make) > len(plate_wells):
+            raise ValueError("Too many combinations ({0}) for {1} reaction wells.".format(len(combinations_to_make), len(plate_wells)))
+        reaction_layout = {}
+        for i, combination in enumerate(combinations_to_make):
+            if combination["name"] in reaction_layout:
+                raise ValueError("Combination \"{0}\" is listed twice.".format(combination["name"]))
+            reaction_layout[combination["name"]] = plate_wells[i]
+        return reaction_layout
+
+    reaction_layout = map_combinations_to_wells(combinations_to_make, [reaction_plate])
+    reaction_wells = list(reaction_layout.values())
+
+    # This function checks if the DNA parts exist in the DNA plates and returns for well location of output DNA combinations
+    def find_combination(name, reaction_layout):
+        """Return a well containing the named combination."""
+        if name not in reaction_layout:
+            raise ValueError("Could not find combination \"{0}\".".format(name))
+        return reaction_layout[name]
+
+    dna_plan = decompress_payload(transfer_plan) if isinstance(transfer_plan, str) else transfer_plan
+    if dna_plan is None:
+        dna_plan = compile_transfer_plan(combinations_to_make)
+    if dna_plan['dna_tip_policy'] != dna_tip_policy:
+        raise ValueError("The transfer plan was compiled for the DNA tip policy \"{0}\", generate the protocol again for \"{1}\"".format(
+            dna_plan['dna_tip_policy'], dna_tip_policy))
+    dna_transfers = dna_plan['dna_transfers']
+    input_order_travel, scheduled_travel = dna_plan['travel']
+
+    # This function splits wells into the column blocks the 8-channel pipette can serve in one move.
+    # A block is a run of wells ending at row H of a plate column, so that partial blocks can be served
+    # from nozzle H1 without the empty nozzles leaving the deck; ragged columns are left to the single channel.
+    def split_column_blocks(wells):
+        """Return the list of column blocks and the list of leftover wells."""
+        wells_by_column = {}
+        for well in wells:
+            column = (well.parent, well.well_name[1:])
+            if column in wells_by_column.keys():
+                wells_by_column[column].append(well)
+            else:
+                wells_by_column[column] = [well]
+        column_blocks = []
+        single_wells = []
+        for column_wells in wells_by_column.values():
+            column_wells = sorted(column_wells, key=lambda well: well.well_name[0])
+            rows = ''.join(well.well_name[0] for well in column_wells)
+            if len(column_wells) > 1 and rows == 'ABCDEFGH'[8 - len(column_wells):]:
+                column_blocks.append(column_wells)
+            else:
+                single_wells.extend(column_wells)
+        return column_blocks, single_wells
+
+    # This function groups column blocks by height, as the nozzle layout has to be set once for each height
+    def group_blocks_by_rows(column_blocks):
+        """Return a dict mapping a number of rows to the column blocks of that height."""
+        blocks_by_rows = {}
+        for block in column_blocks:
+            if len(block) in blocks_by_rows.keys():
+                blocks_by_rows[len(block)].append(block)
+            else:
+                blocks_by_rows[len(block)] = [block]
+        return blocks_by_rows
+
+    if multichannel_mode:
+        column_blocks, single_wells = split_column_blocks(reaction_wells)
+    else:
+        column_blocks, single_wells = [], reaction_wells
+    nb_moves = len(column_blocks) + len(single_wells)
+    speedup = num_rxns / nb_moves if nb_moves else 1
+    speedup_message = f"{len(column_blocks)} column moves + {len(single_wells)} single-well moves instead of {num_rxns} ({speedup:.1f}x)"
+
+    # Tips and reagent volumes planned by the generator from an offline run of this protocol (see run_planner.py).
+    # The generator runs it first without a plan (run_plan = None), where only the first tip rack is loaded.
+    if run_plan:
+        planned_tips = run_plan['tips']
+        planned_volumes = run_plan['volumes']
+    else:
+        planned_tips = {'single': 0, 'multichannel_full_columns': 0, 'multichannel_partial_columns': 0}
+        planned_volumes = {}
     tips_per_rack = 96
-    racks_needed = math.ceil(tips_needed / tips_per_rack)
+    racks_needed = max(1, math.ceil(planned_tips['single'] / tips_per_rack))
+    partial_racks_needed = math.ceil(planned_tips['multichannel_partial_columns'] / 12)
+    full_racks_needed = math.ceil(planned_tips['multichannel_full_columns'] / 12)
+    multi_racks_needed = partial_racks_needed + full_racks_needed
 
     # Slots available for tip racks
     available_slots = ['A2', 'B1', 'B2', 'D1','C3','D2']  # Emplacements libres
+    if thermocycler_mode:
+        available_slots.remove('B1')  # Back half of the thermocycler
+    nb_free_slots = len(available_slots)
+
+    # Partial-column pickups start from nozzle H1, so the empty nozzles hang over the slot behind the rack:
+    # partial racks go in B1 and D1, behind which sit the reaction module (A1) and the agar plate (C1)
+    partial_slot_choices = [slot for slot in ['B1', 'D1'] if slot in available_slots]
+    partial_slots = partial_slot_choices[:partial_racks_needed]
+    available_slots = [slot for slot in available_slots if slot not in partial_slots]
+    multi_slots = partial_slots + available_slots[:full_racks_needed]
+    available_slots = available_slots[full_racks_needed:]
+    if partial_racks_needed > len(partial_slot_choices) or len(multi_slots) < multi_racks_needed:
+        raise ValueError('{0} 8-channel tip racks are needed but the deck only has room for {1}, split the combinations into several runs.'.format(
+            multi_racks_needed, nb_free_slots))
+
+    # When the 1-channel pipette needs more racks than the deck holds, the operator refills them once they are empty
+    racks_loaded = min(racks_needed, 1 + len(available_slots))
+    nb_refills = math.ceil(racks_needed / racks_loaded) - 1
+
+    # Agar plates wait in the slots no tip rack takes, then in those of the racks spent before plating (see Step 7).
+    # The last slot is kept empty for the first swap
+    agar_slots = available_slots[racks_loaded - 1:] + agar_staging_slots if agar_exchange_mode else []
 
     # Pause for tip rack setup
     setup_message = f""" Tip setup:
-- Number of constructions: {num_rxns}
-- Tips needed : {tips_needed}
+- Number of constructions: {num_rxns} ({reaction_plate_format}-well reaction plate, {volume_reaction:g} uL reactions)
+- Tips needed : {planned_tips['single']}
 - Tip racks needed: {racks_needed}
 
-Place {racks_needed} of 50 uL at the location :
+Place {racks_loaded} of 50 uL at the location :
 """
 
-    for i in range(racks_needed):
-        if i < len(available_slots):
-            setup_message += f"\n - Rack {i+1} of 50uL: {available_slots[i]}"
+    setup_message += f"\n - Rack 1 of 50uL: B3"
+    for i in range(racks_loaded - 1):
+        setup_message += f"\n - Rack {i+2} of 50uL: {available_slots[i]}"
+    if nb_refills:
+        setup_message += f"\nThe racks will be refilled {nb_refills} time(s) during the run."
+
+    if thermocycler_mode:
+        setup_message += "\n\nThermocycler mode: Golden Gate, heat shock and outgrowth run on the thermocycler (A1 + B1), no plate to seal or move."
+
+    setup_message += f"\n\nReaction profile '{reaction_profile}': {volume_reaction:g} uL, water in {len(water_groups)} group(s):"
+    for volume, names in water_groups.items():
+        setup_message += f"\n - {volume:g} uL water: {len(names)} reactions"
+
+    if small_reagent_volumes:
+        setup_message += f"\n\nMaster mixes used for the volumes under the {min_pipette_volume} uL pipette minimum: {', '.join(small_reagent_volumes)}"
+
+    setup_message += "\n\nWater, buffer and enzyme (Steps 1 and 3), 1-channel estimate:"
+    for master_mix in [False, True]:
+        reagent_tips, reagent_seconds = estimate_reagent_steps(master_mix, water_groups, dna_tip_policy)
+        selected = ' (selected)' if master_mix == master_mix_mode else ''
+        setup_message += f"\n - {'master mix' if master_mix else 'separate reagents'}: {reagent_tips} tips, ~{math.ceil(reagent_seconds / 60)} min{selected}"
+
+    part_counts = {}
+    for part, plate_name, part_well, volume, aspirations, mix_well in dna_transfers:
+        part_counts[part] = part_counts.get(part, 0) + sum(len(wells) for wells in aspirations)
+    part_counts = list(part_counts.values())
+    setup_message += f"\n\nDNA parts (Step 2), policy '{dna_tip_policy}':"
+    for policy in dna_tip_policies:
+        policy_tips, policy_seconds = estimate_dna_step(policy, part_counts)
+        selected = ' (selected)' if policy == dna_tip_policy else ''
+        setup_message += f"\n - {policy}: {policy_tips} tips, ~{math.ceil(policy_seconds / 60)} min{selected}"
+    travel_gain = 100 * (1 - scheduled_travel / input_order_travel) if input_order_travel else 0
+    setup_message += f"\nGantry travel: {input_order_travel:.1f} m in input order, {scheduled_travel:.1f} m"
+    setup_message += f" {'scheduled' if travel_schedule else 'without schedule'} ({travel_gain:.0f}% less)"
+
+    if multichannel_mode:
+        setup_message += f"""
+
+8-channel mode: {speedup_message} for water, buffer, enzyme and competent cells.
+Place {multi_racks_needed} racks of 50 uL for the 8-channel pipette at the location :"""
+        for i, slot in enumerate(multi_slots):
+            setup_message += f"\n - 8-channel rack {i+1} of 50uL: {slot}"
 
     protocol.pause(setup_message)
 
@@ -111,164 +673,273 @@ Place {racks_needed} of 50 uL at the location :
     tip_racks.extend([tr_300])
 
     # Additional racks if needed
-    for i in range(min(racks_needed - 1, len(available_slots))):  # -1 because we already have 1 tip rack
-        if racks_needed > 1:  # Only if we need more than one rack
-            additional_rack = protocol.load_labware('opentrons_flex_96_tiprack_50ul',
-                                                   available_slots[i],
-                                                   f'Tips Rack {i+3}')
-            tip_racks.append(additional_rack)
+    for i in range(racks_loaded - 1):  # -1 because we already have 1 tip rack
+        additional_rack = protocol.load_labware('opentrons_flex_96_tiprack_50ul',
+                                               available_slots[i],
+                                               f'Tips Rack {i+2}')
+        tip_racks.append(additional_rack)
 
     # Load in pipettes
     p50_single = protocol.load_instrument('flex_1channel_50', 'right', tip_racks=tip_racks)
-
-    # Load modules
-    temp_mod_reaction = protocol.load_module('temperature module gen2', 'A1')
-    temp_mod_reaction.set_temperature(celsius=temp_reaction)
-    temp_adapter = temp_mod_reaction.load_adapter('opentrons_96_well_aluminum_block')
-    reaction_plate = temp_adapter.load_labware('biorad_96_wellplate_200ul_pcr')
-
-    temp_mod = protocol.load_module('temperature module gen2', 'D3')
-    temp_mod.set_temperature(celsius=temp_reagent)
-    trough = temp_mod.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', 'D3')
-    buffer_H2O_mix = trough.wells()[0]  # Well A1
-    well_enzyme = trough.wells()[1]  # Well B1
-    dilution_water = trough.wells()[2]  # Well C1
-    #competent_cell = trough.wells()[3]  # Well D1
-    competent_cells = [trough.wells()[3], trough.wells()[7], trough.wells()[11], trough.wells()[15], trough.wells()[19]]  # Well D1 -> D5
-    liquid_waste = trough.wells()[4]  # Well A2
-
-    # Load in Input DNA Plate
-
-    dna_plate_dict = {}
-    plate_name = list(dna_plate_map_dict.keys())
-    dna_plate_dict[plate_name[0]] = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 'C2', 'Input DNA Plate')
-    #activate the following line by deleting '#' if a second custom_parts_map needs to be used
-    #dna_plate_dict[plate_name[1]] = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 'D2', 'Input DNA Plate2')
-
-    # Load in Agar plate
-    agar_plate = protocol.load_labware('corning_6_wellplate_16.8ml_flat', 'C1', 'Agar Plate')
-
-
-    # This function checks the existance of DNA parts and returns for well location of the parts
-    def find_dna(name, dna_plate_map_dict, dna_plate_dict):
-        """Return a well containing the named DNA."""
-        well_num=None
-        rows = ['A','B','C','D','E','F','G','H','I','J']
-        columns = [1,2,3,4,5,6,7,8,9,10,11,12]
-        for plate_name, plate_map in dna_plate_map_dict.items():
-            for i, row in enumerate(plate_map):
-                for j, dna_name in enumerate(row):
-                    if dna_name == name:
-                        plate_part = plate_name
-                        if 'fixed_toolkit_map' in plate_name:
-                            #well_num = 8 * j + i
-                            well_num = rows[i]+str(columns[j])
-                        elif 'custom_parts_map' in plate_name:
-                            #well_num = 4 * j + i
-                            well_num = rows[i]+str(columns[j])
-        if well_num is not None:
-            return dna_plate_dict[plate_part].wells_by_name()[well_num]
-        print(f"DNA with name '{name}' not found.")
-        return None  # or raise an exception, depending on your requirements   
-                        #return dna_plate_dict[plate_name].wells()[well_num]
-        raise ValueError("Could not find dna piece named \"{0}\"".format(name))
-
-    # This function checks if the DNA parts exist in the DNA plates and returns for well location of output DNA combinations
-    def find_combination(name, combinations_to_make):
-        """Return a well containing the named combination."""
-        for i, combination in enumerate(combinations_to_make):
-            if combination["name"] == name:
-                return reaction_plate.wells()[i]
-        raise ValueError("Could not find combination \"{0}\".".format(name))
-
-    combinations_by_part = {}
-    for i in combinations_to_make:
-        name = i["name"]
-        for j in i["parts"]:
-            if j in combinations_by_part.keys():
-                combinations_by_part[j].append(name)
+    if multichannel_mode:
+        multi_tip_racks = [protocol.load_labware('opentrons_flex_96_tiprack_50ul', slot, f'8-channel Tips Rack {i+1}')
+                           for i, slot in enumerate(multi_slots)]
+        partial_tip_racks = multi_tip_racks[:partial_racks_needed]
+        full_tip_racks = multi_tip_racks[partial_racks_needed:]
+        p50_multi = protocol.load_instrument('flex_8channel_50', 'left', tip_racks=full_tip_racks)
+
+    # This function counts the tips of the 1-channel pipette, and pauses for the operator to refill the racks once they are empty
+    single_tips_left = {'tips': racks_loaded * tips_per_rack}
+    def use_single_tip():
+        if single_tips_left['tips'] == 0:
+            protocol.pause(f'Replace the {racks_loaded} empty tip racks of the 1-channel pipette with full ones.')
+            p50_single.reset_tipracks()
+            single_tips_left['tips'] = racks_loaded * tips_per_rack
+        single_tips_left['tips'] -= 1
+
+    # This function sets the 8-channel nozzle layout for a block of nb_rows wells.
+    # Partial blocks use the bottom nozzles (from H1), so the primary nozzle targets the row H well of the block.
+    def configure_multichannel(nb_rows):
+        """Configure the 8-channel pipette and return the index of the well its primary nozzle goes to."""
+        if nb_rows == 8:
+            p50_multi.configure_nozzle_layout(style=protocol_api.ALL, tip_racks=full_tip_racks)
+            return 0
+        p50_multi.configure_nozzle_layout(style=protocol_api.PARTIAL_COLUMN, start='H1', end='ABCDEFGH'[8 - nb_rows] + '1',
+                                           tip_racks=partial_tip_racks)
+        return -1
+
+    # This function runs transfer(pipette, source, destination) once per column block with the 8-channel pipette
+    def dispatch_column_blocks(transfer, source_column):
+        """Serve every column block, taking the reagent from the matching rows of source_column."""
+        for nb_rows, blocks in group_blocks_by_rows(column_blocks).items():
+            target = configure_multichannel(nb_rows)
+            for block in blocks:
+                transfer(p50_multi, source_column[target], block[target])
+
+    # This function names a reagent in the Opentrons App and loads the volume planned for each of its wells
+    def load_reagent(name, wells, display_color):
+        liquid = protocol.define_liquid(name, description=name, display_color=display_color)
+        for well in wells:
+            well.load_liquid(liquid, planned_volume(name, well))
+
+    def planned_volume(name, well):
+        """Return the volume (uL) of the reagent to put in the well, dead volume included."""
+        return planned_volumes.get(name, {}).get(well.well_name, 0)
+
+    # This function tells how much reagent each well of a reagent column needs in 8-channel mode
+    def column_volume_message(name, column, column_name):
+        """Return the pause message line for one reagent column."""
+        return f'{planned_volume(name, column[1])} uL in each well of {column_name} of the reagent plate ({planned_volume(name, column[0])} uL in row A)'
+
+    if master_mix_mode:
+        for k in range(len(water_groups)):
+            load_reagent(f'Master mix {k+1}', master_mix_columns[k] if multichannel_mode else [master_mix_wells[k]], '#50B4E6')
+    elif multichannel_mode:
+        load_reagent('Water', water_column, '#50B4E6')
+        load_reagent('Buffer', buffer_column, '#5064E6')
+        load_reagent('Enzyme', enzyme_column, '#E6A050')
+    else:
+        load_reagent('Water', [well_water], '#50B4E6')
+        load_reagent('Buffer', [well_buffer], '#5064E6')
+        load_reagent('Enzyme', [well_enzyme], '#E6A050')
+    if multichannel_mode:
+        load_reagent('Competent cells', competent_cells_column, '#B450E6')
+    else:
+        load_reagent('Competent cells', competent_cells, '#B450E6')
+    for part in dict.fromkeys(transfer[0] for transfer in dna_transfers):
+        load_reagent(part, [find_dna(part, dna_part_index, dna_plate_dict)], '#50E68C')
+
+    # Step 1: Add water and buffer, or the master mixes of buffer, enzyme and water
+    if thermocycler_mode:
+        tc_mod.set_block_temperature(temp_reaction)
+    else:
+        temp_mod_reaction.await_temperature(celsius=temp_reaction)
+    temp_mod.await_temperature(celsius=temp_reagent)
+    if master_mix_mode:
+        master_mix_message = 'Temperature modules ready!\n Master mixes (per reaction: water + {0:g} uL buffer + {1:g} uL enzyme):'.format(volume_buffer, volume_enzyme)
+        for k, volume in enumerate(water_groups):
+            if multichannel_mode:
+                location = column_volume_message(f'Master mix {k+1}', master_mix_columns[k], f'column {k+6}')
             else:
-                combinations_by_part[j] = [name]
-
-    # Step 1: Add Buffer/Water
-    protocol.pause(f'Temperature modules ready!\n Put {total_buffer_needed * 1.2} uL of buffer/water in A1 position.')
-
-    p50_single.configure_for_volume(volume_waterbuffer_per_reaction)
-
-    nb_per_disp = 2 * (30 // math.ceil(volume_waterbuffer_per_reaction))  # number of wells that can be distributed per dispense (2 distribute per tip)
-    div = num_rxns // nb_per_disp
-    for disp in range(div + 1):
-        start_pos = disp * nb_per_disp
-        end_pos = min(start_pos + nb_per_disp, num_rxns)
-        distribute_wells = reaction_plate.wells()[start_pos:end_pos]
-        if distribute_wells !=[]:
-            p50_single.distribute(volume_waterbuffer_per_reaction,
-                                  [trough.wells_by_name()[well_name] for well_name in ['A1']],
-                                  distribute_wells,
+                location = f'{planned_volume(f"Master mix {k+1}", master_mix_wells[k])} uL in {master_mix_wells[k].well_name}'
+            master_mix_message += f'\n - Master mix {k+1} with {volume:g} uL water per reaction: {location}'
+        protocol.pause(master_mix_message)
+    elif multichannel_mode:
+        protocol.pause(f'Temperature modules ready!\n Put {column_volume_message("Water", water_column, "column 1")} of water'
+                       f' and {column_volume_message("Buffer", buffer_column, "column 5")} of buffer.')
+    else:
+        protocol.pause(f'Temperature modules ready!\n Put {planned_volume("Water", well_water)} uL of water in A1'
+                       f' and {planned_volume("Buffer", well_buffer)} uL of buffer in B2.')
+
+    # These functions multi-dispense a volume with a fresh tip for each pass of nb_per_disp wells or column blocks
+    # (2 aspirations per tip)
+    def distribute_single(volume, source, wells):
+        nb_per_disp = 2 * (30 // math.ceil(volume))
+        p50_single.configure_for_volume(volume)
+        for start_pos in range(0, len(wells), nb_per_disp):
+            use_single_tip()
+            p50_single.distribute(volume, source, wells[start_pos:start_pos + nb_per_disp],
                                   disposal_volume=1, new_tip='always')
 
+    def distribute_multi(volume, source_column, blocks):
+        nb_per_disp = 2 * (30 // math.ceil(volume))
+        p50_multi.configure_for_volume(volume)
+        for nb_rows, blocks_of_height in group_blocks_by_rows(blocks).items():
+            target = configure_multichannel(nb_rows)
+            for start_pos in range(0, len(blocks_of_height), nb_per_disp):
+                p50_multi.distribute(volume, source_column[target],
+                                     [block[target] for block in blocks_of_height[start_pos:start_pos + nb_per_disp]],
+                                     disposal_volume=1, new_tip='always')
+
+    # Water, or master mix: one pass per water group. A column block goes to the 8-channel pipette when all its reactions take the same water.
+    water_by_well = {find_combination(name, reaction_layout): volume for volume, names in water_groups.items() for name in names}
+    for k, (volume, names) in enumerate(water_groups.items()):
+        if master_mix_mode:
+            group_volume = volume + volume_buffer + volume_enzyme
+        elif volume:
+            group_volume = volume
+        else:
+            continue
+        group_blocks = [block for block in column_blocks if all(water_by_well[well] == volume for well in block)]
+        if group_blocks:
+            distribute_multi(group_volume, master_mix_columns[k] if master_mix_mode else water_column, group_blocks)
+        block_wells = [well for block in group_blocks for well in block]
+        group_wells = [find_combination(name, reaction_layout) for name in names]
+        distribute_single(group_volume, master_mix_wells[k] if master_mix_mode else well_water,
+                          [well for well in group_wells if well not in block_wells])
+
+    if not master_mix_mode:
+        if multichannel_mode:
+            distribute_multi(volume_buffer, buffer_column, column_blocks)
+        distribute_single(volume_buffer, well_buffer, single_wells)
+    if multichannel_mode:
+        protocol.comment(f'Step 1 {"master mixes" if master_mix_mode else "water and buffer"}: {speedup_message}')
+
     # Step 2: Add DNA parts
+    if dna_tip_policy == 'multi_dispense_wash':
+        if multichannel_mode:
+            protocol.pause('Put 1000 uL of dilution water in A4 of the reagent plate to rinse the tips.')
+        else:
+            protocol.pause('Put 1000 uL of dilution water in C1 to rinse the tips.')
+
+    # One tip per transfer of the plan; in master-mix mode, the tip of the last DNA part of a reaction mixes it
+    mix_volume = min(volume_reaction*0.75, 10)
     p50_single.configure_for_volume(volume_inputDNA)
-    for part, combinations in combinations_by_part.items():
-        part_well = find_dna(part, dna_plate_map_dict, dna_plate_dict)
-        combination_wells = [find_combination(x, combinations_to_make) for x in combinations]
-        while combination_wells:
-            if len(combination_wells) > 10:
-                current_wells = combination_wells[0:10]
-                combination_wells = combination_wells[10:]
-            else:
-                current_wells = combination_wells
-                combination_wells = []
-            for i in current_wells:
-                p50_single.pick_up_tip()
-                p50_single.aspirate(volume_inputDNA, part_well.bottom(z=1))
-                p50_single.dispense(volume_inputDNA, i.bottom(z=1))
-                p50_single.drop_tip()
-
-    # Step 3: Add enzyme
-    protocol.pause(f'Put {total_enzyme_needed} uL of enzyme in B1')
-
-    p50_single.configure_for_volume(10)
-    for i in range(num_rxns):
+    for part, plate_name, part_well, volume, aspirations, mix_well in dna_transfers:
+        source = dna_plate_dict[plate_name][part_well].bottom(z=1)
+        use_single_tip()
         p50_single.pick_up_tip()
-        p50_single.aspirate(volume_enzyme, well_enzyme.bottom(z=1.5))
-        p50_single.dispense(volume_enzyme,  reaction_plate.wells()[i].bottom(z=1))
-        mix_volume = min(volume_reaction*0.75, 10)
-        p50_single.mix(3, mix_volume, reaction_plate.wells()[i].bottom(z=1))
-        p50_single.blow_out()
+        for k, wells in enumerate(aspirations):
+            if k and dna_tip_policy == 'multi_dispense_wash':
+                p50_single.mix(2, 10, dilution_water.bottom(z=1))
+                p50_single.blow_out()
+            p50_single.aspirate(volume * len(wells), source)
+            for well_name in wells:
+                p50_single.dispense(volume, reaction_plate[well_name].bottom(z=1))
+        if mix_well:
+            p50_single.mix(3, mix_volume, reaction_plate[mix_well].bottom(z=1))
+            p50_single.blow_out()
         p50_single.drop_tip()
 
-    # Step 4 : Incubation GG
-    temp_mod.deactivate()
-    temp_mod_reaction.deactivate()
-    protocol.pause('Golden Gate:\nn Seal PCR plates with adhesive film\n Start the Golden Gae program (cycles 37C/16C)\n Press Resume once finished.')
+    # Step 3: Add enzyme, or in master-mix mode only mix the reactions not mixed in Step 2
+    def mix_reaction(pipette, destination):
+        pipette.pick_up_tip()
+        pipette.mix(3, mix_volume, destination.bottom(z=1))
+        pipette.blow_out()
+        pipette.drop_tip()
+
+    if master_mix_mode and dna_tip_policy != 'strict':
+        p50_single.configure_for_volume(10)
+        if multichannel_mode:
+            p50_multi.configure_for_volume(10)
+            for nb_rows, blocks in group_blocks_by_rows(column_blocks).items():
+                target = configure_multichannel(nb_rows)
+                for block in blocks:
+                    mix_reaction(p50_multi, block[target])
+        for well in single_wells:
+            use_single_tip()
+            mix_reaction(p50_single, well)
+    elif multichannel_mode and not master_mix_mode:
+        protocol.pause(f'Put {column_volume_message("Enzyme", enzyme_column, "column 2")} of enzyme.')
+    elif not master_mix_mode:
+        protocol.pause(f'Put {planned_volume("Enzyme", well_enzyme)} uL of enzyme in B1')
+
+    def add_enzyme(pipette, source, destination):
+        pipette.pick_up_tip()
+        pipette.aspirate(volume_enzyme, source.bottom(z=1.5))
+        pipette.dispense(volume_enzyme,  destination.bottom(z=1))
+        pipette.mix(3, mix_volume, destination.bottom(z=1))
+        pipette.blow_out()
+        pipette.drop_tip()
+
+    if not master_mix_mode:
+        p50_single.configure_for_volume(10)
+        if multichannel_mode:
+            p50_multi.configure_for_volume(10)
+            dispatch_column_blocks(add_enzyme, enzyme_column)
+            protocol.comment(f'Step 3 enzyme: {speedup_message}')
+        for well in single_wells:
+            use_single_tip()
+            add_enzyme(p50_single, well_enzyme, well)
 
-    temp_mod_reaction.set_temperature(celsius=temp_reaction)
-    temp_mod.set_temperature(celsius=temp_reagent)
+    # Step 4 : Incubation GG
+    # The modules are kept cold through the pause, so that the competent cells go on without waiting for a cooldown
+    temp_mod.start_set_temperature(celsius=temp_reagent)
+    if thermocycler_mode:
+        tc_mod.close_lid()
+        tc_mod.set_lid_temperature(temp_lid)
+        for steps, repetitions in thermocycler_programs['golden_gate']:
+            tc_mod.execute_profile(steps=steps, repetitions=repetitions, block_max_volume=volume_reaction)
+        tc_mod.set_block_temperature(temp_reaction)
+        tc_mod.open_lid()
+    else:
+        temp_mod_reaction.start_set_temperature(celsius=temp_reaction)
+        protocol.pause('Golden Gate:\nn Seal PCR plates with adhesive film\n Start the Golden Gae program (cycles 37C/16C)\n Press Resume once finished.')
+        temp_mod_reaction.await_temperature(celsius=temp_reaction)
+    temp_mod.await_temperature(celsius=temp_reagent)
 
     # Step 5: Add competent cells
-    protocol.pause(f'{total_competent_cells_needed} uL of competent cells in total, {volume_tubes_competent} per tube in D1 -> D5')
+    if multichannel_mode:
+        protocol.pause(f'Put {column_volume_message("Competent cells", competent_cells_column, "column 3")} of competent cells.')
+    else:
+        competent_cells_message = ', '.join(f'{planned_volume("Competent cells", tube)} uL in {tube.well_name}'
+                                            for tube in competent_cells if planned_volume("Competent cells", tube))
+        protocol.pause(f'Competent cells: {competent_cells_message}')
+
+    def add_competent_cells(pipette, source, destination):
+        pipette.pick_up_tip()
+        pipette.aspirate(volume_competent_cells, source.bottom(z=2), rate =0.2)
+        pipette.dispense(volume_competent_cells, destination.bottom(z=2), rate =0.2)
+        pipette.mix(1, volume_competent_cells_mix, destination.bottom(z=2), rate =0.2)
+        pipette.blow_out()
+        pipette.drop_tip()
 
     p50_single.configure_for_volume(volume_competent_cells)
-    for i in range(0, num_rxns):
-        tube_number = i // nb_reaction_per_tube
-        competent_cell = competent_cells[tube_number]
-        p50_single.pick_up_tip()
-        p50_single.aspirate(volume_competent_cells, competent_cell.bottom(z=2), rate =0.2)
-        p50_single.dispense(volume_competent_cells, reaction_plate.wells()[i].bottom(z=2), rate =0.2)
-        p50_single.mix(1, 25, reaction_plate.wells()[i].bottom(z=2), rate =0.2)
-        p50_single.blow_out()
-        p50_single.drop_tip()
+    if multichannel_mode:
+        p50_multi.configure_for_volume(volume_competent_cells)
+        dispatch_column_blocks(add_competent_cells, competent_cells_column)
+        protocol.comment(f'Step 5 competent cells: {speedup_message}')
+    for i, well in enumerate(single_wells):
+        tube_number = min(i // nb_reaction_per_tube, len(competent_cells) - 1)
+        use_single_tip()
+        add_competent_cells(p50_single, competent_cells[tube_number], well)
 
     temp_mod.deactivate()
-    temp_mod_reaction.deactivate()
 
-    # Step 6: heat shock
-    protocol.pause(' Heat shock:\n Reseal the PCR plates\n Proceed with the heat shock program \n Press Resume to begin plating.')
+    # Step 6: heat shock, and outgrowth in thermocycler mode
+    if thermocycler_mode:
+        tc_mod.close_lid()
+        for steps, repetitions in thermocycler_programs['heat_shock']:
+            tc_mod.execute_profile(steps=steps, repetitions=repetitions, block_max_volume=volume_reaction + volume_competent_cells)
+        tc_mod.set_block_temperature(temp_outgrowth)
+        tc_mod.open_lid()
+    else:
+        temp_mod_reaction.deactivate()
+        protocol.pause(' Heat shock:\n Reseal the PCR plates\n Proceed with the heat shock program \n Press Resume to begin plating.')
 
     # Step 7: plating
-    num_agar_plates_needed = math.ceil(num_rxns / 6)
-    total_volume_per_construct = 2.5 * 13  #13 deposition points per construct
+    num_agar_plates_needed = math.ceil(num_rxns / constructs_per_plate)
+    total_volume_per_construct = volume_spot * len(spot_offsets)
     total_plating_volume = total_volume_per_construct * num_rxns
 
     plating_setup_message = f""" Setup plating:
@@ -276,43 +947,103 @@ Place {racks_needed} of 50 uL at the location :
  {num_agar_plates_needed} agar plaque(s)
  Total volume to plate: {total_plating_volume} uL
 
-Place the first agar plate in position C1 and press Resume."""
-
-    protocol.pause(plating_setup_message)
-
+Place the first agar plate in position C1"""
+
+    # Fresh and full agar plates waiting for the gripper, as (plate, slot)
+    fresh_plates = []
+    full_plates = []
+    if agar_exchange_mode:
+        # When the agar slots cannot hold all the plates, the tip racks spent before plating make room for more.
+        # The gripper cannot take labware off deck, so the operator lifts them when prompted. The first freed slots
+        # take full racks for the plating tips the racks left on deck lack, instead of a refill pause during plating.
+        # The 8-channel racks are all spent unless they plate.
+        nb_spent_racks = (racks_loaded * tips_per_rack - single_tips_left['tips']) // tips_per_rack
+        spent_racks = list(zip(tip_racks, ['B3'] + available_slots[:racks_loaded - 1]))[:nb_spent_racks]
+        if multichannel_mode and not multichannel_plating:
+            spent_racks += list(zip(multi_tip_racks, multi_slots))
+        nb_plating_racks = max(0, math.ceil((num_rxns - single_tips_left['tips']) / tips_per_rack))
+        nb_missing_slots = max(0, num_agar_plates_needed - len(agar_slots))
+        if nb_missing_slots and nb_plating_racks < len(spent_racks):
+            spent_racks = spent_racks[:nb_plating_racks + nb_missing_slots]
+            for rack, slot in spent_racks:
+                protocol.move_labware(rack, protocol_api.OFF_DECK, use_gripper=False)
+            freed_slots = [slot for rack, slot in spent_racks]
+            plating_racks = [protocol.load_labware('opentrons_flex_96_tiprack_50ul', slot, f'Plating Tips Rack {k+1}')
+                             for k, slot in enumerate(freed_slots[:nb_plating_racks])]
+            if plating_racks:
+                p50_single.tip_racks = tip_racks[nb_spent_racks:] + plating_racks
+                single_tips_left['tips'] += len(plating_racks) * tips_per_rack
+                plating_setup_message += f", full tip racks of 50 uL in {', '.join(freed_slots[:nb_plating_racks])}"
+            agar_slots = freed_slots[nb_plating_racks:] + agar_slots
+
+        for slot in agar_slots[:min(len(agar_slots) - 1, num_agar_plates_needed - 1)]:
+            fresh_plates.append((protocol.load_labware(agar_plate_profile['labware'], slot, 'Agar Plate'), slot))
+        empty_slot = agar_slots[len(fresh_plates)]
+        if fresh_plates:
+            plating_setup_message += f", and fresh agar plates in {', '.join(slot for plate, slot in fresh_plates)}, leaving {empty_slot} empty"
+    protocol.pause(plating_setup_message + ' and press Resume.')
+
+    # Spot positions of each site, relative to the bottom of its well
+    site_spots = [[types.Point(x=site_x + x, y=site_y + y, z=agar_plate_profile['height']) for x, y in spot_offsets]
+                  for well_index, site_x, site_y in agar_plate_sites]
+
+    def plate_construct(pipette, reaction_well, site_index):
+        pipette.pick_up_tip()
+        pipette.mix(3, volume_competent_cells, reaction_well.bottom(z=2))
+        well_index, site_x, site_y = agar_plate_sites[site_index]
+        pipette.distribute(volume_spot, reaction_well.bottom(z=2),
+                           [agar_plate.wells()[well_index].bottom(z=0).move(position) for position in site_spots[site_index]],
+                           disposal_volume=volume_spot_disposal, new_tip='never')
+        pipette.blow_out(trash)
+        pipette.drop_tip()
+
+    # 8-channel plating: all the reactions fit on one tray, so the column blocks are plated before any plate change
     p50_single.configure_for_volume(volume_competent_cells)
-    wells_per_plate = 6
+    plated_wells = set()
+    if multichannel_plating:
+        p50_multi.configure_for_volume(volume_competent_cells)
+        for nb_rows, blocks in group_blocks_by_rows(column_blocks).items():
+            target = configure_multichannel(nb_rows)
+            for block in blocks:
+                plate_construct(p50_multi, block[target], reaction_wells.index(block[target]) % constructs_per_plate)
+                plated_wells.update(block)
+        protocol.comment(f'Step 7 plating: {speedup_message}')
 
     for i in range(0, num_rxns):
-        well_index = i % wells_per_plate
-
-        if well_index == 0 and i > 0:
-            plate_number = (i // wells_per_plate) + 1
+        if reaction_wells[i] in plated_wells:
+            continue
+        site_index = i % constructs_per_plate
+
+        if site_index == 0 and i > 0 and agar_exchange_mode:
+            plate_number = (i // constructs_per_plate) + 1
+            if not fresh_plates:
+                # All the slots hold full plates: the operator replaces the ones needed for the rest of the run
+                fresh_plates = full_plates[:num_agar_plates_needed - plate_number + 1]
+                full_plates = full_plates[len(fresh_plates):]
+                protocol.pause(f' Reloading agar plates:\n Replace the full agar plates in {", ".join(slot for plate, slot in fresh_plates)} with new empty ones\nPress Resume once the new plates are in place.')
+            next_plate, next_slot = fresh_plates.pop(0)
+            protocol.move_labware(agar_plate, empty_slot, use_gripper=True)
+            full_plates.append((agar_plate, empty_slot))
+            protocol.move_labware(next_plate, 'C1', use_gripper=True)
+            agar_plate, empty_slot = next_plate, next_slot
+        elif site_index == 0 and i > 0:
+            plate_number = (i // constructs_per_plate) + 1
             protocol.pause(f' Changing agar plate:\n Remove the full agar plate (plate {plate_number - 1})\n Place a new empty agar plate at the same location C1\n You start the plate {plate_number}/{num_agar_plates_needed}\nPress Resume once the new plate is in place.')
 
-        current_well = agar_plate.wells()[well_index]
-
-        positions = [
-            types.Point(x=0, y=0, z=6), types.Point(x=0, y=6, z=5), types.Point(x=6, y=0, z=6),
-            types.Point(x=0, y=-6, z=5), types.Point(x=-6, y=0, z=6),
-            types.Point(x=0, y=12, z=5), types.Point(x=7.5, y=7.5, z=6), types.Point(x=12, y=0, z=5),
-            types.Point(x=7.5, y=-7.5, z=6), types.Point(x=0, y=-12, z=5),
-            types.Point(x=-7.5, y=-7.5, z=6), types.Point(x=-12, y=0, z=5), types.Point(x=-7.5, y=7.5, z=6)
-        ]
+        use_single_tip()
+        plate_construct(p50_single, reaction_wells[i], site_index)
 
-        p50_single.pick_up_tip()
-        p50_single.mix(3, volume_competent_cells, reaction_plate.wells()[i].bottom(z=2))
-        p50_single.distribute(2.5, reaction_plate.wells()[i].bottom(z=2),
-                            [current_well.bottom(z=0).move(position) for position in positions],
-                            disposal_volume=1.5, new_tip='never')
-        p50_single.blow_out(trash)
-        p50_single.drop_tip()
+    if thermocycler_mode:
+        tc_mod.deactivate()
 
     # Final message
+    last_plates = 'the last agar plate'
+    if full_plates:
+        last_plates += f" (C1) and the full plates in {', '.join(slot for plate, slot in full_plates)}"
     final_message = f""" PROTOCOL COMPLETED!
 
  NEXT STEPS:
-- Remove the last agar plate
+- Remove {last_plates}
 - Incubate the agar plates at 37C overnight
 - Check colony growth tomorrow
 
@@ -12,6 +12,98 @@ metadata = {
 
 num_rxns = len(combinations_to_make)
 
+# This function indexes every DNA part once, so that each lookup in run() is a single dict access
+def index_dna_parts(dna_plate_map_dict):
+    """Return a dict mapping each DNA part name to its (plate name, well name)."""
+    rows = 'ABCDEFGHIJKLMNOP'
+    dna_part_index = {}
+    for plate_name, plate_map in dna_plate_map_dict.items():
+        for i, row in enumerate(plate_map):
+            for j, dna_name in enumerate(row):
+                if not dna_name:
+                    continue
+                well_name = rows[i] + str(j + 1)
+                if dna_name in dna_part_index:
+                    raise ValueError("DNA piece \"{0}\" is listed twice: {1} {2} and {3} {4}".format(
+                        dna_name, *dna_part_index[dna_name], plate_name, well_name))
+                dna_part_index[dna_name] = (plate_name, well_name)
+    return dna_part_index
+
+dna_part_index = index_dna_parts(dna_plate_map_dict)
+
+# Plating: volume (uL) of each spot
+volume_spot = 4.5
+volume_spot_disposal = 1.5
+
+# Agar plate formats, chosen with agar_plate_format: labware, sites and spot layout of each construct.
+# sites: rows and columns of constructs per plate, one per well, or a grid spaced by site_pitch (mm) on the single
+# well of an omnitray (no Opentrons definition of the OmniTray, a single-well reservoir of its footprint stands in).
+# The spots of a construct are laid out by pattern ('grid', 'rings' or 'spiral') within radius (mm) of the centre of
+# its site, at height (mm) above the well bottom.
+agar_plate_formats = {
+    6: {'labware': 'corning_6_wellplate_16.8ml_flat', 'sites': (2, 3), 'site_pitch': None, 'spots': 13, 'pattern': 'rings', 'radius': 8, 'height': 6},
+    24: {'labware': 'corning_24_wellplate_3.4ml_flat', 'sites': (4, 6), 'site_pitch': None, 'spots': 5, 'pattern': 'rings', 'radius': 5, 'height': 4},
+    48: {'labware': 'corning_48_wellplate_1.6ml_flat', 'sites': (6, 8), 'site_pitch': None, 'spots': 5, 'pattern': 'rings', 'radius': 3.5, 'height': 4},
+    'omnitray': {'labware': 'axygen_1_reservoir_90ml', 'sites': (8, 12), 'site_pitch': 9, 'spots': 4, 'pattern': 'grid', 'radius': 3, 'height': 3},
+}
+agar_plate_format = 6
+if agar_plate_format not in agar_plate_formats:
+    raise ValueError("Unknown agar plate format {0}, choose one of {1}".format(agar_plate_format, ', '.join(str(x) for x in agar_plate_formats)))
+agar_plate_profile = agar_plate_formats[agar_plate_format]
+
+def spot_diameter(volume):
+    """Return the diameter (mm) of a spot of volume (uL) on the agar, taken as a hemisphere."""
+    return 2 * (3 * volume / (2 * math.pi)) ** (1 / 3)
+
+def spot_pattern(pattern, nb_spots, radius):
+    """Return the (x, y) offsets (mm) of nb_spots spots within radius of the centre.
+
+    grid: the points of a square grid closest to the centre, rings: the centre then rings of 4, 8, 12... spots,
+    spiral: a sunflower spiral from the centre to the rim."""
+    if nb_spots == 1:
+        return [(0, 0)]
+    if pattern == 'grid':
+        side = math.ceil(math.sqrt(nb_spots))
+        pitch = 2 * radius / math.sqrt(2) / (side - 1)
+        points = [((column - (side - 1) / 2) * pitch, ((side - 1) / 2 - row) * pitch) for row in range(side) for column in range(side)]
+        return sorted(points, key=lambda point: math.hypot(*point))[:nb_spots]
+    if pattern == 'rings':
+        nb_rings = 1
+        while 1 + 2 * nb_rings * (nb_rings + 1) < nb_spots:
+            nb_rings += 1
+        points = [(0, 0)]
+        for ring in range(1, nb_rings + 1):
+            nb_ring_spots = min(4 * ring, nb_spots - len(points))
+            ring_radius = radius * ring / nb_rings
+            points += [(ring_radius * math.sin(2 * math.pi * k / nb_ring_spots), ring_radius * math.cos(2 * math.pi * k / nb_ring_spots))
+                       for k in range(nb_ring_spots)]
+        return points
+    if pattern == 'spiral':
+        golden_angle = math.pi * (3 - math.sqrt(5))
+        return [(radius * math.sqrt(k / (nb_spots - 1)) * math.cos(k * golden_angle), radius * math.sqrt(k / (nb_spots - 1)) * math.sin(k * golden_angle))
+                for k in range(nb_spots)]
+    raise ValueError("Unknown spot pattern \"{0}\", choose one of grid, rings, spiral".format(pattern))
+
+def agar_sites(agar_plate_profile):
+    """Return the (well index, x, y) of the site of each construct on an agar plate, column by column."""
+    nb_rows, nb_columns = agar_plate_profile['sites']
+    pitch = agar_plate_profile['site_pitch']
+    if pitch is None:
+        return [(well_index, 0, 0) for well_index in range(nb_rows * nb_columns)]
+    return [(0, (column - (nb_columns - 1) / 2) * pitch, ((nb_rows - 1) / 2 - row) * pitch)
+            for column in range(nb_columns) for row in range(nb_rows)]
+
+# Spot layout, computed once: the spots of a construct must not touch each other nor the spots of the next site
+spot_offsets = spot_pattern(agar_plate_profile['pattern'], agar_plate_profile['spots'], agar_plate_profile['radius'])
+spot_spacing = min((math.hypot(x1 - x2, y1 - y2) for i, (x1, y1) in enumerate(spot_offsets) for x2, y2 in spot_offsets[i + 1:]), default=math.inf)
+if agar_plate_profile['site_pitch'] is not None:
+    spot_spacing = min(spot_spacing, agar_plate_profile['site_pitch'] - 2 * agar_plate_profile['radius'])
+if spot_spacing < spot_diameter(volume_spot):
+    raise ValueError("Spots of {0} uL are {1:.1f} mm wide, more than the {2:.1f} mm between the spots of the {3} agar plate format".format(
+        volume_spot, spot_diameter(volume_spot), spot_spacing, agar_plate_format))
+agar_plate_sites = agar_sites(agar_plate_profile)
+constructs_per_plate = len(agar_plate_sites)
+
 def run(protocol: protocol_api.ProtocolContext):
     # Load in 1 10ul tiprack and 2 300ul tipracks
     tr_300 = protocol.load_labware('opentrons_96_tiprack_300ul', '6')
@@ -43,38 +135,40 @@ def run(protocol: protocol_api.ProtocolContext):
     dna_plate_dict[plate_name[1]] = protocol.load_labware('opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap', '2', 'Input DNA Plate2')
 
     # Load in Agar plate
-    agar_plate = protocol.load_labware('corning_6_wellplate_16.8ml_flat', '5', 'Agar Plate')
+    agar_plate = protocol.load_labware(agar_plate_profile['labware'], '5', 'Agar Plate')
 
 
     # This function checks the existance of DNA parts and returns for well location of the parts
-    def find_dna(name, dna_plate_map_dict, dna_plate_dict):
+    def find_dna(name, dna_part_index, dna_plate_dict):
         """Return a well containing the named DNA."""
-        well_num=None
-        for plate_name, plate_map in dna_plate_map_dict.items():
-            for i, row in enumerate(plate_map):
-                for j, dna_name in enumerate(row):
-                    if dna_name == name:
-                        if plate_name == 'fixed_input_dna_map':
-                            well_num = 8 * j + i
-                        elif plate_name == 'customised_input_dna_map':
-                            well_num = 4 * j + i
-                         # Check if well_num is assigned a value
-        if well_num is not None:
-            return dna_plate_dict[plate_name].wells()[well_num]
-
-        # Handle the case where the name is not found
-        print(f"DNA with name '{name}' not found.")
-        return None  # or raise an exception, depending on your requirements   
-                        #return dna_plate_dict[plate_name].wells()[well_num]
-        raise ValueError("Could not find dna piece named \"{0}\"".format(name))
+        if name not in dna_part_index:
+            raise ValueError("Could not find dna piece named \"{0}\"".format(name))
+        plate_name, well_name = dna_part_index[name]
+        return dna_plate_dict[plate_name].wells_by_name()[well_name]
+
+    # This function maps every combination to its well in the reaction plates, filling the plates in order.
+    # The layout is built once and shared by all the transfer steps below.
+    def map_combinations_to_wells(combinations_to_make, plates):
+        """Return a dict mapping each combination name to its destination well."""
+        plate_wells = [well for plate in plates for well in plate.wells()]
+        if len(combinations_to_make) > len(plate_wells):
+            raise ValueError("Too many combinations ({0}) for {1} reaction wells.".format(len(combinations_to_make), len(plate_wells)))
+        reaction_layout = {}
+        for i, combination in enumerate(combinations_to_make):
+            if combination["name"] in reaction_layout:
+                raise ValueError("Combination \"{0}\" is listed twice.".format(combination["name"]))
+            reaction_layout[combination["name"]] = plate_wells[i]
+        return reaction_layout
+
+    reaction_layout = map_combinations_to_wells(combinations_to_make, [reaction_plate])
+    reaction_wells = list(reaction_layout.values())
 
     # This function checks if the DNA parts exist in the DNA plates and returns for well locaion of output DNA combinations
-    def find_combination(name, combinations_to_make):
+    def find_combination(name, reaction_layout):
         """Return a well containing the named combination."""
-        for i, combination in enumerate(combinations_to_make):
-            if combination["name"] == name:
-                return reaction_plate.wells()[i]
-        raise ValueError("Could not find combination \"{0}\".".format(name))
+        if name not in reaction_layout:
+            raise ValueError("Could not find combination \"{0}\".".format(name))
+        return reaction_layout[name]
 
     combinations_by_part = {}
     for i in combinations_to_make:
@@ -85,21 +179,23 @@ def run(protocol: protocol_api.ProtocolContext):
             else:
                 combinations_by_part[j] = [name]
 
-    # This section will take the GG buffer and water into the designation wells
-    p10_single.pick_up_tip()
+    # This section will take the GG buffer and water into the designation wells:
+    # the enzyme/buffer mix in one pass, then the water (8 - N) in one pass per group of reactions with the same number of parts
+    water_groups = {}
     for i in range(num_rxns):
         N = len(combinations_to_make[i]['parts'])
-        p10_single.consolidate(
-            [2, 8 - N],
-            [trough.wells_by_name()[well_name] for well_name in ['A1', 'B1']],
-            reaction_plate.wells()[i].bottom(z=0.5), new_tip='never')
-        # p10_single.blow_out()
+        water_groups.setdefault(8 - N, []).append(reaction_wells[i].bottom(z=0.5))
+    p10_single.pick_up_tip()
+    p10_single.distribute(2, typeII_enzyme_buffer_mix, [well.bottom(z=0.5) for well in reaction_wells], new_tip='never')
+    for volume, wells in water_groups.items():
+        if volume > 0:
+            p10_single.distribute(volume, water, wells, new_tip='never')
     p10_single.drop_tip()
 
     # This section of the code combines and mix the DNA parts according to the combination list
     for part, combinations in combinations_by_part.items():
-        part_well = find_dna(part, dna_plate_map_dict, dna_plate_dict)
-        combination_wells = [find_combination(x, combinations_to_make) for x in combinations]
+        part_well = find_dna(part, dna_part_index, dna_plate_dict)
+        combination_wells = [find_combination(x, reaction_layout) for x in combinations]
         p10_single.pick_up_tip()
         while combination_wells:
             if len(combination_wells) > 10:
@@ -122,13 +218,9 @@ def run(protocol: protocol_api.ProtocolContext):
 
     tc_mod.close_lid()
     tc_mod.set_lid_temperature(105)
-    profile1 = [
-            {'temperature': 37, 'hold_time_seconds': 120},
-            {'temperature': 16, 'hold_time_seconds': 300}]
-    tc_mod.execute_profile(steps=profile1, repetitions=25, block_max_volume=20)
-    profile2 = [
-            {'temperature': 60, 'hold_time_seconds': 300}]
-    tc_mod.execute_profile(steps=profile2, repetitions=1, block_max_volume=20)
+    # Golden Gate cycles and 60C step, compiled by the generator into (steps, repetitions) segments
+    for steps, repetitions in thermocycler_programs['golden_gate']:
+        tc_mod.execute_profile(steps=steps, repetitions=repetitions, block_max_volume=20)
     tc_mod.set_block_temperature(4)
     tc_mod.open_lid()
     #temp_mod.set_temperature(4) #Optional
@@ -137,8 +229,8 @@ def run(protocol: protocol_api.ProtocolContext):
     # Add competent cells
     for i in range(0, num_rxns):
             p300_single.pick_up_tip()
-            p300_single.transfer(50, competent_cell.bottom(z=0.5), reaction_plate.wells()[i].bottom(z=0.5), new_tip='never')
-            p300_single.mix(1, 25, reaction_plate.wells()[i].bottom(z=0.5))
+            p300_single.transfer(50, competent_cell.bottom(z=0.5), reaction_wells[i].bottom(z=0.5), new_tip='never')
+            p300_single.mix(1, 25, reaction_wells[i].bottom(z=0.5))
             p300_single.blow_out()
             p300_single.drop_tip()
     temp_mod.deactivate()
@@ -146,46 +238,26 @@ def run(protocol: protocol_api.ProtocolContext):
 
      # Incubate at 4℃, then heat shock.
     tc_mod.close_lid()
-    profile1 = [
-            {'temperature': 4, 'hold_time_seconds': 600},
-            {'temperature': 42, 'hold_time_seconds': 90},
-            {'temperature': 4, 'hold_time_seconds': 120},
-            {'temperature': 37, 'hold_time_seconds': 3600}]
-    tc_mod.execute_profile(steps=profile1, repetitions=1, block_max_volume=40)
+    for steps, repetitions in thermocycler_programs['heat_shock']:
+        tc_mod.execute_profile(steps=steps, repetitions=repetitions, block_max_volume=40)
     tc_mod.set_block_temperature(37)
     tc_mod.open_lid()
     protocol.pause('Please remove the seal and resume for plating')
 
     # Plating
-    a = len(agar_plate.wells())
+    # Spot positions of each site, relative to the bottom of its well
+    site_spots = [[types.Point(x=site_x + x, y=site_y + y, z=agar_plate_profile['height']) for x, y in spot_offsets]
+                  for well_index, site_x, site_y in agar_plate_sites]
     for i in range(0, num_rxns):
-        if i <a:
-            p300_single.pick_up_tip()
-            p300_single.mix(1, 25, reaction_plate.wells()[i].bottom(z=0.5))
-            p300_single.distribute(4.5, reaction_plate.wells()[i].bottom(z=0.5),
-                               [agar_plate.wells()[i].bottom(z=6).move(position) for position in
-                                [types.Point(x=0, y=0),
-                                 types.Point(x=0, y=4), types.Point(x=4, y=0), types.Point(x=0, y=-4), types.Point(x=-4, y=0),
-                                 types.Point(x=0, y=8), types.Point(x=5.5, y=5.5), types.Point(x=8, y=0),
-                                 types.Point(x=5.5, y=-5.5), types.Point(x=0, y=-8), types.Point(x=-5.5, y=-5.5),
-                                 types.Point(x=-8, y=0), types.Point(x=-5.5, y=5.5)]],
-                               disposal_volume=1.5, new_tip='never')
-            p300_single.blow_out()
-            p300_single.drop_tip()
-        if i >= a:
-            if i % a == 0:
-               protocol.pause('Please change a new agar plates')    
-            p300_single.pick_up_tip()
-            p300_single.mix(1, 25, reaction_plate.wells()[i].bottom(z=0.5))
-            p300_single.distribute(4.5, reaction_plate.wells()[i].bottom(z=0.5),
-                                   [agar_plate.wells()[i%a].bottom(z=6).move(position) for position in
-                                    [types.Point(x=0, y=0),
-                                     types.Point(x=0, y=4), types.Point(x=4, y=0), types.Point(x=0, y=-4),
-                                     types.Point(x=-4, y=0),
-                                     types.Point(x=0, y=8), types.Point(x=5.5, y=5.5), types.Point(x=8, y=0),
-                                     types.Point(x=5.5, y=-5.5), types.Point(x=0, y=-8), types.Point(x=-5.5, y=-5.5),
-                                     types.Point(x=-8, y=0), types.Point(x=-5.5, y=5.5)]],
-                                   disposal_volume=1.5, new_tip='never')
-            p300_single.blow_out()
-            p300_single.drop_tip()
+        site_index = i % constructs_per_plate
+        if site_index == 0 and i > 0:
+            protocol.pause('Please change a new agar plates')
+        well_index, site_x, site_y = agar_plate_sites[site_index]
+        p300_single.pick_up_tip()
+        p300_single.mix(1, 25, reaction_wells[i].bottom(z=0.5))
+        p300_single.distribute(volume_spot, reaction_wells[i].bottom(z=0.5),
+                               [agar_plate.wells()[well_index].bottom(z=0).move(position) for position in site_spots[site_index]],
+                               disposal_volume=volume_spot_disposal, new_tip='never')
+        p300_single.blow_out()
+        p300_single.drop_tip()
     tc_mod.deactivate()
@@ -3,11 +3,22 @@
 # Adapted by Alicia Da Silva and Henri Galez for Flex robot, Institut Pasteur
 
 import os
-import tkinter
-from tkinter import filedialog, messagebox
+import argparse
+import base64
 import csv
+import functools
 import json
 import sys
+import zlib
+
+# The run time estimator and the thermocycler programs are shared by the cloning and colony PCR generators, at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layout_optimiser import PLATE_FORMATS, optimise_combination_layout, save_reaction_plate_layout
+from sharding import generate_shards
+from run_time_estimator import estimate_run_time, print_run_time_report
+from run_planner import plan_run, plan_transfers, save_bill_of_materials, save_spot_map, save_transfer_plan
+from thermocycler_profiles import cloning_programs, print_programs
 
 from datetime import date
 today = date.today()
@@ -15,6 +26,9 @@ today = date.today()
 
 def main():
 
+	# tkinter is only imported for the dialogs, so that the command line works without a display
+	import_tkinter()
+
 	# GETTING USER INPUT
 	dna_fixed_plate_map_filename = ask_fixed_dna_plate_map_filename()
 	dna_customised_plate_map_filename = ask_customised_dna_plate_map_filename()
@@ -22,16 +36,118 @@ def main():
 	template_folder_path_config = get_template_path_config()
 	output_folder_path_config = get_output_folder_path_config()
 
+	generate_protocol(dna_fixed_plate_map_filename, dna_customised_plate_map_filename, combinations_filename, template_folder_path_config, output_folder_path_config)
+
+	# Display success message
+	messagebox.showinfo("Completed", "The protocol has been successfully generated!")
+
+def main_cli(argv=None):
+	parser = argparse.ArgumentParser(description='Generate high-throughput Golden Gate cloning protocols for the Flex.')
+	parser.add_argument('--fixed-map', required=True, help='fixed toolkit map CSV (fixed_toolkit_map.csv)')
+	parser.add_argument('--custom-map', required=True, help='custom parts map CSV (custom_parts_map.csv)')
+	parser.add_argument('--combinations', required=True, nargs='+', help='combinations to make CSV, one protocol per file')
+	parser.add_argument('--template', required=True, help='workflow file (cloning_workflow_Flex_v2_for_HT.py)')
+	parser.add_argument('--output', required=True, help='output folder, with one subfolder per protocol when several are generated')
+	parser.add_argument('--shard', action='store_true', help='split more combinations than fit on the reaction plate into several runs, one protocol per shard')
+	parser.add_argument('--plate-format', type=int, choices=sorted(PLATE_FORMATS), default=96,
+	                    help='wells of the reaction plate, 384 for low-volume reactions (default: 96)')
+	parser.add_argument('--reaction-profile', help='reaction profile of the workflow, standard or low_volume '
+	                                               '(default: standard on 96-well plates, low_volume on 384-well plates)')
+	parser.add_argument('--emission', choices=EMISSIONS, default='full',
+	                    help='plate maps and combinations written in full, compact (only the parts used, as IDs) '
+	                         'or compressed (compact, then zlib and base64) (default: full)')
+	# Workflow modes, left to the default of the workflow file when not given
+	parser.add_argument('--multichannel', dest='multichannel_mode', action='store_true', default=None,
+	                    help='8-channel mode: column-aligned reactions get their reagents one column at a time')
+	parser.add_argument('--dna-tip-policy', dest='dna_tip_policy',
+	                    help='tip policy for the DNA parts: strict, multi_dispense or multi_dispense_wash (default: strict)')
+	parser.add_argument('--master-mix', dest='master_mix_mode', action='store_true', default=None,
+	                    help='master-mix mode: buffer, enzyme and water premixed by the operator, one tube per water group')
+	parser.add_argument('--thermocycler', dest='thermocycler_mode', action='store_true', default=None,
+	                    help='thermocycler mode: Golden Gate, heat shock and outgrowth on a Flex thermocycler, 96-well reaction plates only')
+	parser.add_argument('--agar-exchange', dest='agar_exchange_mode', action='store_true', default=None,
+	                    help='agar plate exchange: the Flex gripper swaps the full agar plates with fresh ones waiting on the deck')
+	parser.add_argument('--agar-plate-format', dest='agar_plate_format', type=parse_agar_plate_format,
+	                    help='agar plate format: 6, 24 or 48 wells, or omnitray (default: 6)')
+	parser.add_argument('--multichannel-plating', dest='multichannel_plating', action='store_true', default=None,
+	                    help='8-channel plating of whole reaction columns, with --multichannel and the omnitray agar format')
+	args = parser.parse_args(argv)
+	workflow_modes = {name: getattr(args, name) for name in WORKFLOW_MODES if getattr(args, name) is not None}
+
+	# With several files, each protocol goes to a subfolder named after its file
+	job_names = [os.path.splitext(os.path.basename(filename))[0] for filename in args.combinations]
+	if len(set(job_names)) != len(job_names):
+		parser.error('the --combinations files must have different names')
+	for combinations_filename, job_name in zip(args.combinations, job_names):
+		output_folder_path = args.output if len(job_names) == 1 else os.path.join(args.output, job_name)
+		os.makedirs(output_folder_path, exist_ok=True)
+		if args.shard:
+			protocol_paths = generate_sharded_protocols(args.fixed_map, args.custom_map, combinations_filename, args.template, output_folder_path,
+			                                            args.plate_format, args.reaction_profile, args.emission, workflow_modes)
+		else:
+			protocol_paths = [generate_protocol(args.fixed_map, args.custom_map, combinations_filename, args.template, output_folder_path,
+			                                    args.plate_format, args.reaction_profile, args.emission, workflow_modes)]
+		for protocol_path in protocol_paths:
+			print("Protocol generated:", protocol_path)
+
+def generate_protocol(dna_fixed_plate_map_filename, dna_customised_plate_map_filename, combinations_filename, template_folder_path_config, output_folder_path_config, plate_format=96, reaction_profile=None, emission='full',
+                      workflow_modes=None):
+	"""Generate the protocol and its output files from the input files, and return the protocol path."""
 	# Load in CSV files as a dict containing lists of lists.
 	dna_plate_map_dict = generate_plate_maps(dna_fixed_plate_map_filename, dna_customised_plate_map_filename)
 	combinations_to_make = generate_combinations(combinations_filename)
-	check_number_of_combinations( combinations_to_make)
+	template_string = read_template(template_folder_path_config)
+	return build_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config, plate_format, reaction_profile, emission, workflow_modes)
+
+def generate_sharded_protocols(dna_fixed_plate_map_filename, dna_customised_plate_map_filename, combinations_filename, template_folder_path_config, output_folder_path_config, plate_format=96, reaction_profile=None, emission='full',
+                               workflow_modes=None):
+	"""Generate one protocol per shard of at most one reaction plate of combinations, with the shard manifest, and return the protocol paths."""
+	dna_plate_map_dict = generate_plate_maps(dna_fixed_plate_map_filename, dna_customised_plate_map_filename)
+	combinations_to_make = generate_combinations(combinations_filename)
+	template_string = read_template(template_folder_path_config)
+	return generate_shards(functools.partial(build_protocol, plate_format=plate_format, reaction_profile=reaction_profile, emission=emission, workflow_modes=workflow_modes),
+	                       dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config, shard_size=plate_format)
+
+def build_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config, plate_format=96, reaction_profile=None, emission='full',
+                   workflow_modes=None):
+	"""Generate the protocol and its output files from the parsed input files, and return the protocol path.
+
+	plate_format is the number of wells of the reaction plate, 96 or 384 (low-volume reactions).
+	reaction_profile names one of the reaction profiles of the workflow, None for the default of the plate format.
+	emission is how the plate maps and combinations are written into the protocol, one of EMISSIONS.
+	workflow_modes maps names of WORKFLOW_MODES to their values, the others keep the default of the workflow file."""
+	check_number_of_combinations( combinations_to_make, plate_format)
+	nb_rows, nb_columns = PLATE_FORMATS[plate_format]
+
+	# Reorder combinations so that combinations sharing parts fill whole reaction plate columns.
+	combinations_to_make = optimise_combination_layout(combinations_to_make, nb_rows)
 
 	# Generate and save output plate maps.
 	generate_and_save_output_plate_maps(combinations_to_make, output_folder_path_config)
+	save_reaction_plate_layout(combinations_to_make, output_folder_path_config, nb_rows, nb_columns)
 
-	# Create a protocol file.
-	create_protocol(dna_plate_map_dict, combinations_to_make, template_folder_path_config, output_folder_path_config)
+	# Create a protocol file, compile its DNA transfer plan and run it offline to plan the tips and reagents,
+	# then write both plans into it.
+	protocol_path = create_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config, plate_format, reaction_profile,
+	                                emission=emission, workflow_modes=workflow_modes)
+	transfer_plan = plan_transfers(protocol_path)
+	run_plan, report = plan_run(protocol_path)
+	create_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config, plate_format, reaction_profile, run_plan, transfer_plan,
+	                emission, workflow_modes)
+	print("Protocol size: {0} kB ({1} emission)".format(round(os.path.getsize(protocol_path) / 1000, 1), emission))
+	save_bill_of_materials(run_plan, report, output_folder_path_config)
+	save_transfer_plan(transfer_plan, output_folder_path_config)
+	save_spot_map(protocol_path, output_folder_path_config)
+	print_programs(cloning_programs())
+
+	# Estimate the run time offline, without a robot.
+	print_run_time_report(estimate_run_time(protocol_path))
+	return protocol_path
+
+def import_tkinter():
+	global tkinter, filedialog, messagebox
+	import tkinter
+	from tkinter import filedialog, messagebox
 
 
 # Functions for getting user input
@@ -92,30 +208,23 @@ def ask_combinations_filename():
 
 def generate_plate_maps(filename1, filename2):
 	plate_maps = {}
-	plate_map1 = []
-	plate_map2 = []
-	with open(filename1, "r") as file:
-		for row in csv.reader(file, dialect='excel', delimiter=';'):
-			if len(row) == 0:
-				continue
-			if row[0]:
-				if '\ufeff' in row[0]:
-					row[0] = str(row[0].replace(u'\ufeff',''))
-				plate_map1.append(row)
-	plate_name1 = os.path.splitext(os.path.basename(filename1))[0]
-	plate_maps[plate_name1] = plate_map1
+	for filename in (filename1, filename2):
+		plate_name, plate_map = read_plate_map(filename)
+		plate_maps[plate_name] = plate_map
+	return plate_maps
 
-	with open(filename2, "r") as file:
+def read_plate_map(filename):
+	plate_map = []
+	with open(filename, "r") as file:
 		for row in csv.reader(file, dialect='excel', delimiter=';'):
 			if len(row) == 0:
 				continue
 			if row[0]:
 				if '\ufeff' in row[0]:
 					row[0] = str(row[0].replace(u'\ufeff',''))
-				plate_map2.append(row)
-	plate_name2 = os.path.splitext(os.path.basename(filename2))[0]
-	plate_maps[plate_name2] = plate_map2
-	return plate_maps
+				plate_map.append(row)
+	plate_name = os.path.splitext(os.path.basename(filename))[0]
+	return plate_name, plate_map
 
 def generate_combinations(combinations_filename):
 	combinations_to_make = []
@@ -132,10 +241,10 @@ def generate_combinations(combinations_filename):
 											})
 	return combinations_to_make
 
-def check_number_of_combinations( combinations_to_make): 
+def check_number_of_combinations( combinations_to_make, plate_format=96): 
 	number_of_combinations = len(combinations_to_make)
-	if number_of_combinations > 96:
-		raise ValueError('Too many combinations ({0}) requested. Max for single combinations is 96.'.format(number_of_combinations))
+	if number_of_combinations > plate_format:
+		raise ValueError('Too many combinations ({0}) requested. Max for a {1}-well reaction plate is {1}, use --shard to split them into several runs.'.format(number_of_combinations, plate_format))
 
 
 # Functions for creating output files
@@ -167,21 +276,95 @@ def generate_and_save_output_plate_maps(combinations_to_make, output_folder_path
 		for row in output_plate_map:
 			writer.writerow(row)
 
-def create_protocol(dna_plate_map_dict, combinations_to_make, protocol_template_path, output_folder_path):
-
-	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
+def read_template(protocol_template_path):
+	# Get the contents of the workflow file, which contains the body of the protocol.
 	with open(protocol_template_path, encoding='utf-8') as template_file:
-		template_string = template_file.read()
-	with open(output_folder_path + '/' + 'protocol_for_cloning_YTK_' + str(today) + '.py', "w+") as protocol_file:
-		# Paste in plate maps at top of file.
-		protocol_file.write('dna_plate_map_dict = ' + json.dumps(dna_plate_map_dict) + '\n\n')
-		protocol_file.write('combinations_to_make = ' + json.dumps(combinations_to_make) + '\n\n')
+		return template_file.read()
+
+# Workflow modes written into the protocol, each with the conversion of its command line or manifest value.
+# A mode left out (None) keeps the default of the workflow file.
+def parse_flag(value):
+	"""Return a yes/no manifest value (true/false, yes/no, 1/0) as a bool."""
+	if isinstance(value, bool):
+		return value
+	if str(value).strip().lower() in ('true', 'yes', '1'):
+		return True
+	if str(value).strip().lower() in ('false', 'no', '0'):
+		return False
+	raise ValueError('"{0}" is not a yes/no value'.format(value))
+
+def parse_agar_plate_format(value):
+	"""Return an agar plate format as its number of wells, or its name (omnitray)."""
+	return int(value) if str(value).strip().isdigit() else str(value).strip()
+
+WORKFLOW_MODES = {
+	'multichannel_mode': parse_flag,
+	'dna_tip_policy': str,
+	'master_mix_mode': parse_flag,
+	'thermocycler_mode': parse_flag,
+	'agar_exchange_mode': parse_flag,
+	'agar_plate_format': parse_agar_plate_format,
+	'multichannel_plating': parse_flag,
+}
+
+# Emissions of the plate maps and combinations in the protocol, see compact_payload
+EMISSIONS = ['full', 'compact', 'compressed']
+
+def compact_payload(dna_plate_map_dict, combinations_to_make):
+	"""Return the plate maps pruned to the parts of the combinations and the combinations, with the part names as IDs.
+
+	Each part name is written once in part_names and referred to by its index. The pruned plate maps keep the rows
+	and columns of the full ones, as [rows, columns, [[part ID, row, column], ...]]."""
+	part_ids = {}
+	for combination in combinations_to_make:
+		for part in combination["parts"]:
+			part_ids.setdefault(part, len(part_ids))
+	plate_maps = {}
+	for plate_name, plate_map in dna_plate_map_dict.items():
+		nb_rows = max((i + 1 for i, row in enumerate(plate_map) if any(row)), default=0)
+		nb_columns = max((j + 1 for row in plate_map for j, dna_name in enumerate(row) if dna_name), default=0)
+		wells = [[part_ids[dna_name], i, j] for i, row in enumerate(plate_map) for j, dna_name in enumerate(row) if dna_name in part_ids]
+		plate_maps[plate_name] = [nb_rows, nb_columns, wells]
+	combinations = [[combination["name"], [part_ids[part] for part in combination["parts"]]] for combination in combinations_to_make]
+	return {'part_names': list(part_ids), 'plate_maps': plate_maps, 'combinations': combinations}
+
+def compress_payload(payload):
+	"""Return a JSON value as a Python string literal of its zlib-compressed JSON in base64."""
+	return json.dumps(base64.b64encode(zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 9)).decode('ascii'))
+
+def create_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path, plate_format=96, reaction_profile=None, run_plan=None, transfer_plan=None,
+                    emission='full', workflow_modes=None):
+	protocol_path = output_folder_path + '/' + 'protocol_for_cloning_YTK_' + str(today) + '.py'
+	with open(protocol_path, "w+") as protocol_file:
+		# Paste in plate maps at top of file, or the compact payload the workflow expands into them.
+		if emission == 'full':
+			protocol_file.write('dna_plate_map_dict = ' + json.dumps(dna_plate_map_dict) + '\n\n')
+			protocol_file.write('combinations_to_make = ' + json.dumps(combinations_to_make) + '\n\n')
+			protocol_file.write('compact_payload = None\n\n')
+		else:
+			payload = compact_payload(dna_plate_map_dict, combinations_to_make)
+			protocol_file.write('dna_plate_map_dict = None\n\n')
+			protocol_file.write('combinations_to_make = None\n\n')
+			protocol_file.write('compact_payload = ' + (compress_payload(payload) if emission == 'compressed' else json.dumps(payload, separators=(',', ':'))) + '\n\n')
+		protocol_file.write('reaction_plate_format = ' + str(plate_format) + '\n\n')
+		protocol_file.write('reaction_profile = ' + (json.dumps(reaction_profile) if reaction_profile else 'None') + '\n\n')
+		for name in WORKFLOW_MODES:
+			protocol_file.write(name + ' = ' + repr((workflow_modes or {}).get(name)) + '\n\n')
+		protocol_file.write('run_plan = ' + (json.dumps(run_plan) if run_plan else 'None') + '\n\n')
+		if not transfer_plan:
+			protocol_file.write('transfer_plan = None\n\n')
+		elif emission == 'compressed':
+			protocol_file.write('transfer_plan = ' + compress_payload(transfer_plan) + '\n\n')
+		else:
+			protocol_file.write('transfer_plan = ' + json.dumps(transfer_plan, separators=(',', ':')) + '\n\n')
+		protocol_file.write('thermocycler_programs = ' + json.dumps(cloning_programs()) + '\n\n')
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	return protocol_path
 
-# Call main function
+# Call main function: the dialogs without arguments, the command line otherwise
 if __name__ == '__main__':
-	main()
-    
-# Display success message
-messagebox.showinfo("Completed", "The protocol has been successfully generated!")
\ No newline at end of file
+	if len(sys.argv) > 1:
+		main_cli()
+	else:
+		main()
\ No newline at end of file
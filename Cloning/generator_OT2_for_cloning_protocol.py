@@ -2,14 +2,23 @@
 # Written by Fankang Meng, and Koray Malci Imperial College London
 
 import os
-import tkinter
-from tkinter import filedialog, messagebox
+import argparse
 import csv
 import json
 import sys
 
+# The run time estimator and the thermocycler programs are shared by the cloning and colony PCR generators, at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layout_optimiser import optimise_combination_layout, save_reaction_plate_layout
+from sharding import generate_shards
+from thermocycler_profiles import cloning_programs, print_programs
+
 def main():
 
+	# tkinter is only imported for the dialogs, so that the command line works without a display
+	import_tkinter()
+
 	# GETTING USER INPUT
 	dna_fixed_plate_map_filename = ask_fixed_dna_plate_map_filename()
 	dna_customised_plate_map_filename = ask_customised_dna_plate_map_filename()
@@ -17,16 +26,70 @@ def main():
 	template_folder_path_config = get_template_path_config()
 	output_folder_path_config = get_output_folder_path_config()
 
+	generate_protocol(dna_fixed_plate_map_filename, dna_customised_plate_map_filename, combinations_filename, template_folder_path_config, output_folder_path_config)
+
+	# Display success message
+	messagebox.showinfo("Completed", "The protocol has been successfully generated!")
+
+def main_cli(argv=None):
+	parser = argparse.ArgumentParser(description='Generate Golden Gate cloning protocols for the OT-2.')
+	parser.add_argument('--fixed-map', required=True, help='fixed toolkit map CSV (fixed_toolkit_map.csv)')
+	parser.add_argument('--custom-map', required=True, help='custom parts map CSV (custom_parts_map.csv)')
+	parser.add_argument('--combinations', required=True, nargs='+', help='combinations to make CSV, one protocol per file')
+	parser.add_argument('--template', required=True, help='workflow file (cloning_workflow_OT2.py)')
+	parser.add_argument('--output', required=True, help='output folder, with one subfolder per protocol when several are generated')
+	parser.add_argument('--shard', action='store_true', help='split more than 96 combinations into several runs, one protocol per shard')
+	args = parser.parse_args(argv)
+
+	# With several files, each protocol goes to a subfolder named after its file
+	job_names = [os.path.splitext(os.path.basename(filename))[0] for filename in args.combinations]
+	if len(set(job_names)) != len(job_names):
+		parser.error('the --combinations files must have different names')
+	for combinations_filename, job_name in zip(args.combinations, job_names):
+		output_folder_path = args.output if len(job_names) == 1 else os.path.join(args.output, job_name)
+		os.makedirs(output_folder_path, exist_ok=True)
+		if args.shard:
+			protocol_paths = generate_sharded_protocols(args.fixed_map, args.custom_map, combinations_filename, args.template, output_folder_path)
+		else:
+			protocol_paths = [generate_protocol(args.fixed_map, args.custom_map, combinations_filename, args.template, output_folder_path)]
+		for protocol_path in protocol_paths:
+			print("Protocol generated:", protocol_path)
+
+def generate_protocol(dna_fixed_plate_map_filename, dna_customised_plate_map_filename, combinations_filename, template_folder_path_config, output_folder_path_config):
+	"""Generate the protocol and its output files from the input files, and return the protocol path."""
 	# Load in CSV files as a dict containing lists of lists.
 	dna_plate_map_dict = generate_plate_maps(dna_fixed_plate_map_filename, dna_customised_plate_map_filename)
 	combinations_to_make = generate_combinations(combinations_filename)
+	template_string = read_template(template_folder_path_config)
+	return build_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config)
+
+def generate_sharded_protocols(dna_fixed_plate_map_filename, dna_customised_plate_map_filename, combinations_filename, template_folder_path_config, output_folder_path_config):
+	"""Generate one protocol per shard of at most 96 combinations, with the shard manifest, and return the protocol paths."""
+	dna_plate_map_dict = generate_plate_maps(dna_fixed_plate_map_filename, dna_customised_plate_map_filename)
+	combinations_to_make = generate_combinations(combinations_filename)
+	template_string = read_template(template_folder_path_config)
+	return generate_shards(build_protocol, dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config)
+
+def build_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config):
+	"""Generate the protocol and its output files from the parsed input files, and return the protocol path."""
 	check_number_of_combinations( combinations_to_make)
 
+	# Reorder combinations so that combinations sharing parts fill whole reaction plate columns.
+	combinations_to_make = optimise_combination_layout(combinations_to_make)
+
 	# Generate and save output plate maps.
 	generate_and_save_output_plate_maps(combinations_to_make, output_folder_path_config)
+	save_reaction_plate_layout(combinations_to_make, output_folder_path_config)
 
 	# Create a protocol file.
-	create_protocol(dna_plate_map_dict, combinations_to_make, template_folder_path_config, output_folder_path_config)
+	protocol_path = create_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path_config)
+	print_programs(cloning_programs())
+	return protocol_path
+
+def import_tkinter():
+	global tkinter, filedialog, messagebox
+	import tkinter
+	from tkinter import filedialog, messagebox
 
 
 # Functions for getting user input
@@ -87,30 +150,23 @@ def ask_combinations_filename():
 
 def generate_plate_maps(filename1, filename2):
 	plate_maps = {}
-	plate_map1 = []
-	plate_map2 = []
-	with open(filename1, "r") as file:
-		for row in csv.reader(file, dialect='excel'):
-			if len(row) == 0:
-				continue
-			if row[0]:
-				if '\ufeff' in row[0]:
-					row[0] = str(row[0].replace(u'\ufeff',''))
-				plate_map1.append(row)
-	plate_name1 = os.path.splitext(os.path.basename(filename1))[0]
-	plate_maps[plate_name1] = plate_map1
+	for filename in (filename1, filename2):
+		plate_name, plate_map = read_plate_map(filename)
+		plate_maps[plate_name] = plate_map
+	return plate_maps
 
-	with open(filename2, "r") as file:
+def read_plate_map(filename):
+	plate_map = []
+	with open(filename, "r") as file:
 		for row in csv.reader(file, dialect='excel'):
 			if len(row) == 0:
 				continue
 			if row[0]:
 				if '\ufeff' in row[0]:
 					row[0] = str(row[0].replace(u'\ufeff',''))
-				plate_map2.append(row)
-	plate_name2 = os.path.splitext(os.path.basename(filename2))[0]
-	plate_maps[plate_name2] = plate_map2
-	return plate_maps
+				plate_map.append(row)
+	plate_name = os.path.splitext(os.path.basename(filename))[0]
+	return plate_name, plate_map
 
 def generate_combinations(combinations_filename):
 	combinations_to_make = []
@@ -130,7 +186,7 @@ def generate_combinations(combinations_filename):
 def check_number_of_combinations( combinations_to_make): 
 	number_of_combinations = len(combinations_to_make)
 	if number_of_combinations > 96:
-		raise ValueError('Too many combinations ({0}) requested. Max for single combinations is 96.'.format(number_of_combinations))
+		raise ValueError('Too many combinations ({0}) requested. Max for single combinations is 96, use --shard to split them into several runs.'.format(number_of_combinations))
 
 
 # Functions for creating output files
@@ -162,21 +218,25 @@ def generate_and_save_output_plate_maps(combinations_to_make, output_folder_path
 		for row in output_plate_map:
 			writer.writerow(row)
 
-def create_protocol(dna_plate_map_dict, combinations_to_make, protocol_template_path, output_folder_path):
-
-	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
+def read_template(protocol_template_path):
+	# Get the contents of the workflow file, which contains the body of the protocol.
 	with open(protocol_template_path) as template_file:
-		template_string = template_file.read()
-	with open(output_folder_path + '/' + 'protocol_for_cloning.py', "w+") as protocol_file:
+		return template_file.read()
+
+def create_protocol(dna_plate_map_dict, combinations_to_make, template_string, output_folder_path):
+	protocol_path = output_folder_path + '/' + 'protocol_for_cloning.py'
+	with open(protocol_path, "w+") as protocol_file:
 		# Paste in plate maps at top of file.
 		protocol_file.write('dna_plate_map_dict = ' + json.dumps(dna_plate_map_dict) + '\n\n')
 		protocol_file.write('combinations_to_make = ' + json.dumps(combinations_to_make) + '\n\n')
+		protocol_file.write('thermocycler_programs = ' + json.dumps(cloning_programs()) + '\n\n')
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	return protocol_path
 
-# Call main function
+# Call main function: the dialogs without arguments, the command line otherwise
 if __name__ == '__main__':
-	main()
-    
-# Display success message
-messagebox.showinfo("Completed", "The protocol has been successfully generated!")
+	if len(sys.argv) > 1:
+		main_cli()
+	else:
+		main()
@@ -0,0 +1,66 @@
+# Reaction plate layout optimiser for the Golden Gate cloning generators
+# Reorders combinations so that each column of the reaction plate gathers combinations sharing parts,
+# which lets the multi-channel and multi-dispense steps serve more wells per aspiration.
+
+import csv
+import os
+
+
+ROWS = 'ABCDEFGHIJKLMNOP'
+
+# Number of (rows, columns) of the reaction plate formats
+PLATE_FORMATS = {96: (8, 12), 384: (16, 24)}
+
+
+def well_name(index, nb_rows=8):
+	"""Return the name of the well at a column-major index (the order of labware.wells())."""
+	return ROWS[index % nb_rows] + str(index // nb_rows + 1)
+
+def count_part_visits(combinations_to_make, nb_rows=8):
+	"""Return the number of (part, plate column) pairs, i.e. how many times a part has to be taken to a column."""
+	part_visits = set()
+	for i, combo in enumerate(combinations_to_make):
+		for part in combo["parts"]:
+			part_visits.add((part, i // nb_rows))
+	return len(part_visits)
+
+def optimise_combination_layout(combinations_to_make, nb_rows=8):
+	"""Return the combinations reordered so that each plate column shares as many parts as possible.
+
+	Columns are filled greedily: each column starts with the first combination left in input order,
+	then takes the combination sharing the most parts with the column, preferring the same number
+	of parts (same water volume, hence the same master mix) and then the input order."""
+	remaining = list(combinations_to_make)
+	ordered = []
+	while remaining:
+		seed = remaining.pop(0)
+		column = [seed]
+		column_parts = set(seed["parts"])
+		while remaining and len(column) < nb_rows:
+			best = max(range(len(remaining)), key=lambda k: (
+				len(column_parts.intersection(remaining[k]["parts"])),
+				len(remaining[k]["parts"]) == len(seed["parts"]),
+				-k))
+			combo = remaining.pop(best)
+			column.append(combo)
+			column_parts.update(combo["parts"])
+		ordered.extend(column)
+	print("Layout optimiser: part visits per column reduced from {0} to {1}".format(
+		count_part_visits(combinations_to_make, nb_rows), count_part_visits(ordered, nb_rows)))
+	return ordered
+
+def save_reaction_plate_layout(combinations_to_make, output_folder_path, nb_rows=8, nb_columns=12):
+	"""Write the reaction plate map and the reaction name -> well table next to the protocol."""
+	plate_map = [['' for j in range(nb_columns)] for i in range(nb_rows)]
+	for i, combo in enumerate(combinations_to_make):
+		plate_map[i % nb_rows][i // nb_rows] = combo["name"]
+	with open(os.path.join(output_folder_path, "Reaction_plate.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		for row in plate_map:
+			writer.writerow(row)
+
+	with open(os.path.join(output_folder_path, "Reaction_wells.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["name", "well"])
+		for i, combo in enumerate(combinations_to_make):
+			writer.writerow([combo["name"], well_name(i, nb_rows)])
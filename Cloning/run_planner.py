@@ -0,0 +1,122 @@
+# Reagent and tip planner for the Flex HT cloning generator
+# Runs the generated protocol offline, step by step, and turns the tips and volumes it used into the run plan
+# written into the protocol (tip racks to load, volume of each reagent well) and into a bill of materials.
+
+import csv
+import math
+import os
+
+from run_time_estimator import estimate_run_time, load_protocol
+
+
+# Volume (uL) left in a well that the pipette cannot reach, for each reagent labware
+DEAD_VOLUMES = {
+	'opentrons_24_aluminumblock_nest_1.5ml_snapcap': 30,
+	'nest_96_wellplate_2ml_deep': 50,
+	'biorad_96_wellplate_200ul_pcr': 5,
+}
+
+TIPS_PER_RACK = 96
+COLUMNS_PER_RACK = 12
+
+
+def plan_run(protocol_path):
+	"""Run the protocol offline and return its run plan and the offline run report.
+
+	The run plan gives the tips of the 1-channel pipette, the tip columns of the 8-channel pipette (full and partial)
+	and, for each reagent named in the protocol, the volume to put in each of its wells, dead volume included."""
+	report = estimate_run_time(protocol_path)
+
+	tips = {'single': 0, 'multichannel_full_columns': 0, 'multichannel_partial_columns': 0}
+	for pipette_name, pickups in report['tip_pickups'].items():
+		for nb_channels, nb_pickups in pickups.items():
+			if '8channel' not in pipette_name:
+				tips['single'] += nb_channels * nb_pickups
+			elif nb_channels == 8:
+				tips['multichannel_full_columns'] += nb_pickups
+			else:
+				tips['multichannel_partial_columns'] += nb_pickups
+
+	volumes = {}
+	for display_name, volume in report['volumes'].items():
+		liquid, well_name, load_name = report['wells'][display_name]
+		# Wells the protocol does not name are intermediates, such as the reaction wells when plating
+		if liquid and volume > 0:
+			volumes.setdefault(liquid, {})[well_name] = round(volume + DEAD_VOLUMES.get(load_name, 0), 1)
+	return {'tips': tips, 'volumes': volumes}, report
+
+def plan_transfers(protocol_path):
+	"""Compile the DNA transfer plan (Step 2) of the protocol offline, as the protocol would at the start of the run."""
+	namespace = load_protocol(protocol_path)
+	return namespace['compile_transfer_plan'](namespace['combinations_to_make'])
+
+def save_transfer_plan(transfer_plan, output_folder_path):
+	"""Write the DNA transfer plan to Transfer_plan.csv next to the protocol, one row per dispense, for review before the run."""
+	with open(os.path.join(output_folder_path, "Transfer_plan.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["step", "tip", "part", "part_plate", "part_well", "reaction_well", "volume_ul", "dna_tip_policy", "mix"])
+		for tip, (part, plate_name, part_well, volume, aspirations, mix_well) in enumerate(transfer_plan['dna_transfers'], 1):
+			for wells in aspirations:
+				for well_name in wells:
+					writer.writerow([2, tip, part, plate_name, part_well, well_name, volume, transfer_plan['dna_tip_policy'], 'yes' if well_name == mix_well else ''])
+
+def bill_of_materials(run_plan, report):
+	"""Return the bill of materials of a planned run as (item, quantity, unit) rows."""
+	tips = run_plan['tips']
+	rows = [
+		['Tip racks of 50 uL, 1-channel', max(1, math.ceil(tips['single'] / TIPS_PER_RACK)), 'racks'],
+		['Tips, 1-channel', tips['single'], 'tips'],
+	]
+	if tips['multichannel_full_columns'] or tips['multichannel_partial_columns']:
+		rows.append(['Tip racks of 50 uL, 8-channel full columns', math.ceil(tips['multichannel_full_columns'] / COLUMNS_PER_RACK), 'racks'])
+		rows.append(['Tip racks of 50 uL, 8-channel partial columns', math.ceil(tips['multichannel_partial_columns'] / COLUMNS_PER_RACK), 'racks'])
+
+	# Wells are named with their plate ('A1 of Input DNA Plate'), the same well can be used on several plates
+	display_names = {(liquid, well_name): display_name for display_name, (liquid, well_name, load_name) in report['wells'].items()}
+	for liquid, wells in run_plan['volumes'].items():
+		for well_name, volume in sorted(wells.items(), key=lambda item: (item[0][1:].zfill(2), item[0][0])):
+			rows.append(['{0} in {1}'.format(liquid, display_names.get((liquid, well_name), well_name)), volume, 'uL'])
+
+	settings = report['settings']
+	if not settings.get('multichannel_mode'):
+		rows.append(['Competent cell tubes', len(run_plan['volumes'].get('Competent cells', {})), 'tubes'])
+	if 'constructs_per_plate' in settings:
+		rows.append(['Agar plates', math.ceil(settings['num_rxns'] / settings['constructs_per_plate']), 'plates'])
+	if settings.get('agar_exchange_mode'):
+		# The first plate in C1 and the plates the gripper swaps in
+		rows.append(['Agar plates to stage before plating', report['labware'].get('Agar Plate', 0), 'plates'])
+	return rows
+
+def save_bill_of_materials(run_plan, report, output_folder_path):
+	"""Print the bill of materials and write it to Bill_of_materials.csv next to the protocol."""
+	rows = bill_of_materials(run_plan, report)
+	print("Bill of materials:")
+	for item, quantity, unit in rows:
+		print(" - {0}: {1} {2}".format(item, quantity, unit))
+	with open(os.path.join(output_folder_path, "Bill_of_materials.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["item", "quantity", "unit"])
+		writer.writerows(rows)
+
+def spot_map(protocol_path):
+	"""Return the spots of each construct on the agar plates as (construct, agar plate, site, spot, x, y) rows.
+
+	Sites are named as wells, column by column, and x and y (mm) are taken from the centre of the agar plate well."""
+	namespace = load_protocol(protocol_path)
+	sites, spot_offsets = namespace['agar_plate_sites'], namespace['spot_offsets']
+	nb_rows = namespace['agar_plate_profile']['sites'][0]
+	rows = []
+	for i, combination in enumerate(namespace['combinations_to_make']):
+		site_index = i % len(sites)
+		well_index, site_x, site_y = sites[site_index]
+		site_name = 'ABCDEFGH'[site_index % nb_rows] + str(site_index // nb_rows + 1)
+		for k, (x, y) in enumerate(spot_offsets):
+			rows.append([combination["name"], i // len(sites) + 1, site_name, k + 1, round(site_x + x, 1), round(site_y + y, 1)])
+	return rows
+
+def save_spot_map(protocol_path, output_folder_path):
+	"""Write the spot -> construct map of the agar plates to Spot_map.csv next to the protocol, for reading the colonies."""
+	with open(os.path.join(output_folder_path, "Spot_map.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["construct", "agar_plate", "site", "spot", "x_mm", "y_mm"])
+		writer.writerows(spot_map(protocol_path))
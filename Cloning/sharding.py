@@ -0,0 +1,84 @@
+# Sharding of large Golden Gate libraries for the cloning generators
+# Splits more combinations than fit on a reaction plate into shards of one plate (96 or 384 wells), one robot run each,
+# grouping the combinations that share parts so that each run needs as few DNA parts as possible.
+
+import csv
+import math
+import os
+
+from run_time_estimator import estimate_run_time, format_duration
+
+
+def count_parts(shards):
+	"""Return the total number of distinct parts over the shards, i.e. how many part wells have to be prepared."""
+	return sum(len(set(part for combo in shard for part in combo["parts"])) for shard in shards)
+
+def shard_combinations(combinations_to_make, shard_size=96):
+	"""Return the combinations split into shards of at most shard_size combinations.
+
+	Shards are filled greedily: each shard starts with the first combination left in input order,
+	then takes the combination bringing the fewest new parts to the shard, and then the input order."""
+	remaining = list(combinations_to_make)
+	shards = []
+	while remaining:
+		shard = [remaining.pop(0)]
+		shard_parts = set(shard[0]["parts"])
+		while remaining and len(shard) < shard_size:
+			best = min(range(len(remaining)), key=lambda k: (len(set(remaining[k]["parts"]) - shard_parts), k))
+			combo = remaining.pop(best)
+			shard.append(combo)
+			shard_parts.update(combo["parts"])
+		shards.append(shard)
+
+	input_order_shards = [combinations_to_make[i:i + shard_size] for i in range(0, len(combinations_to_make), shard_size)]
+	print("Sharding: {0} combinations in {1} runs, parts to prepare reduced from {2} to {3}".format(
+		len(combinations_to_make), len(shards), count_parts(input_order_shards), count_parts(shards)))
+	return shards
+
+def generate_shards(build_protocol, dna_plate_map_dict, combinations_to_make, template_string, output_folder_path, shard_size=96):
+	"""Build one protocol per shard in shard_<n> subfolders and write the shard manifest and plate map.
+
+	build_protocol is the build_protocol function of the generator. Return the protocol paths."""
+	shards = shard_combinations(combinations_to_make, shard_size)
+	nb_digits = len(str(len(shards)))
+	protocol_paths = []
+	manifest_rows = []
+	plate_map_rows = []
+	needs_rows = []
+	for i, shard in enumerate(shards):
+		shard_name = 'shard_{0}'.format(str(i + 1).zfill(nb_digits))
+		shard_folder_path = os.path.join(output_folder_path, shard_name)
+		os.makedirs(shard_folder_path, exist_ok=True)
+		protocol_path = build_protocol(dna_plate_map_dict, shard, template_string, shard_folder_path)
+		protocol_paths.append(protocol_path)
+
+		# Tips and reagents needed by the shard, from an offline run of its protocol
+		report = estimate_run_time(protocol_path)
+		parts = sorted(set(part for combo in shard for part in combo["parts"]))
+		manifest_rows.append([shard_name, protocol_path, len(shard), len(parts), sum(report['tips'].values()),
+		                      math.ceil(report['total_seconds'] / 60), len(report['pauses'])])
+		for pipette_name, nb_tips in sorted(report['tips'].items()):
+			needs_rows.append([shard_name, 'tips', pipette_name, nb_tips])
+		for source, volume in sorted(report['volumes'].items()):
+			needs_rows.append([shard_name, 'uL', source, volume])
+		print("{0}: {1} combinations, {2} parts, {3} tips, {4} of robot time".format(
+			shard_name, len(shard), len(parts), sum(report['tips'].values()), format_duration(report['total_seconds'])))
+
+		# The generator reorders the reaction plate, the final wells are the ones it saved for the shard
+		with open(os.path.join(shard_folder_path, "Reaction_wells.csv"), 'r', newline='') as f:
+			for row in csv.DictReader(f):
+				plate_map_rows.append([row["name"], shard_name, row["well"]])
+
+	with open(os.path.join(output_folder_path, "Shards.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["shard", "protocol", "combinations", "parts", "tips", "estimated_minutes", "operator_pauses"])
+		writer.writerows(manifest_rows)
+	with open(os.path.join(output_folder_path, "Shard_plate_map.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["name", "shard", "well"])
+		writer.writerows(plate_map_rows)
+	with open(os.path.join(output_folder_path, "Shard_needs.csv"), 'w+', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(["shard", "unit", "item", "quantity"])
+		writer.writerows(needs_rows)
+	return protocol_paths
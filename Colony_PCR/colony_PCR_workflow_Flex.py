@@ -15,19 +15,54 @@ requirements = {"robotType": "Flex", "apiLevel": "2.21"}
 
 
 #####################################
-#PCR cycles and extension time；change this!!!
-pcr_cycles = [
-    {'temperature': 95, 'hold_time_seconds': 30},
-    {'temperature': 55 , 'hold_time_seconds': 30},
-    {'temperature': 72, 'hold_time_seconds': 60}]#change this!!!
-pcr_cycles_number = 30 #change this!!!
+#PCR cycles and extension time: set in the generator (annealing temperature, amplicon length, number of cycles),
+#with the Flex cycle by default (95C 30 s, annealing 30 s, 72C 60 s),
+#which compiles them into thermocycler_programs
 reaction_volume = 10 #change this!!!
 #####################################
 
+# Master mix volume (uL) per reaction of each recipe part: water, MM_Dreamtaq, forward primer, reverse primer
+master_mix_part_volumes = [4.5, 2.5, 1, 1]
+master_mix_dead_volume = 2 # uL of each part added to every master mix tube
+master_mix_tube_capacity = 1200 # uL of master mix per tube of pcr_mix_deck (1.5 mL tubes)
+
 
 #number of ractions
 num_rxns = len(pcr_recipe_to_make)
 
+# Master mixes: the reactions sharing water, mastermix and primers are made from one tube of master mix
+def group_master_mixes(pcr_recipe_to_make):
+    """Return the master mixes as a list of {"name": [reaction names], "parts": [water, mastermix, primers]}, in order of first use.
+
+    Reactions are grouped on their parts (all but the colony) with a dict, in one pass over the recipe."""
+    master_mixes = {}
+    for reaction in pcr_recipe_to_make:
+        parts = reaction["parts"][0:-1]
+        if tuple(parts) not in master_mixes:
+            master_mixes[tuple(parts)] = {"name": [], "parts": parts}
+        master_mixes[tuple(parts)]["name"].append(reaction["name"])
+    return list(master_mixes.values())
+
+def master_mix_volumes(master_mix):
+    """Return the volume (uL) of each part to put in the master mix tube, dead volume included."""
+    return [len(master_mix["name"]) * master_mix_part_volumes[min(j, len(master_mix_part_volumes) - 1)] + master_mix_dead_volume
+            for j in range(len(master_mix["parts"]))]
+
+def split_master_mixes(master_mixes):
+    """Return the master mixes split into tubes of at most master_mix_tube_capacity uL, one tube per item.
+
+    A master mix that does not fit in one tube is shared evenly between the fewest tubes that hold it."""
+    tubes = []
+    for master_mix in master_mixes:
+        nb_parts = len(master_mix["parts"])
+        volume_per_reaction = sum(master_mix_part_volumes[min(j, len(master_mix_part_volumes) - 1)] for j in range(nb_parts))
+        reactions_per_tube = int((master_mix_tube_capacity - nb_parts * master_mix_dead_volume) // volume_per_reaction)
+        nb_tubes = math.ceil(len(master_mix["name"]) / reactions_per_tube)
+        reactions_per_tube = math.ceil(len(master_mix["name"]) / nb_tubes)
+        for k in range(0, len(master_mix["name"]), reactions_per_tube):
+            tubes.append({"name": master_mix["name"][k:k + reactions_per_tube], "parts": master_mix["parts"]})
+    return tubes
+
 def run(protocol: protocol_api.ProtocolContext):
     # Trash need to be specified with Flex
     trash = protocol.load_trash_bin("A3")
@@ -76,28 +111,7 @@ def run(protocol: protocol_api.ProtocolContext):
     #pcr_mix_deck = protocol.load_labware('opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap', '5', ' pcr_deck')
 
 #Calculate how many PCR reaction systems there are in total
-    combinations = [] # list of dict [{name:[...],parts:[water,mastermix,primerfor,primerrev]},{name:[...],parts:[water,mastermix,primerfor,primerrev]}]
-    name_1 = pcr_recipe_to_make[0]["name"]
-    part_1 = pcr_recipe_to_make[0]["parts"][0:-1]
-    combinations.append({"name": [name_1], "parts": part_1})
-
-    for i in pcr_recipe_to_make[1:]:
-        name = i["name"]
-        part = i["parts"][0:-1] # take water, mastermix, primers (but not colony ofc)
-        j = 0
-        a = len(combinations) # number of combinations
-        while j < a: # looping through existing combinations
-            # If the parts of j are different from i["parts"], set a new dictionary in combinations
-            name_j = combinations[j]["name"]
-            parts_j = combinations[j]["parts"]
-            if part == parts_j:
-                name_j.append(name)
-                break
-                # If the parts of j are the same as i["parts"], insert the name corresponding to i["parts"] into the 
-                #the dictionary corresponding to this part.
-            elif j == a - 1:
-                combinations.append({"name": [name], "parts": part})
-            j = j + 1
+    combinations = group_master_mixes(pcr_recipe_to_make) # list of dict [{name:[...],parts:[water,mastermix,primerfor,primerrev]},...]
 
     # This function checks the existance of pcr raw materials and returns for well location of the raw materials
     def find_rawpcr(name, pcr_plate_map_dict, pcr_deck):
@@ -110,66 +124,77 @@ def run(protocol: protocol_api.ProtocolContext):
                         return pcr_deck.wells()[well_num]
         raise ValueError("Could not find dna piece named \"{0}\"".format(name))
 
+    # This function maps every combination to its well in the reaction plates, filling the plates in order.
+    # The layout is built once and shared by all the transfer steps below.
+    def map_combinations_to_wells(combinations_to_make, plates):
+        """Return a dict mapping each combination name to its destination well."""
+        plate_wells = [well for plate in plates for well in plate.wells()]
+        if len(combinations_to_make) > len(plate_wells):
+            raise ValueError("Too many combinations ({0}) for {1} reaction wells.".format(len(combinations_to_make), len(plate_wells)))
+        reaction_layout = {}
+        for i, combination in enumerate(combinations_to_make):
+            if combination["name"] in reaction_layout:
+                raise ValueError("Combination \"{0}\" is listed twice.".format(combination["name"]))
+            reaction_layout[combination["name"]] = plate_wells[i]
+        return reaction_layout
+
+    reaction_layout = map_combinations_to_wells(pcr_recipe_to_make, [reaction_plate, addition_plate])
+    reaction_wells = list(reaction_layout.values())
+
     # This function checks if the DNA parts exist in the DNA plates and returns for well locaion of output DNA combinations
-    def find_combination(name, combinations_to_make):
+    def find_combination(name, reaction_layout):
         """Return a well containing the named combination."""
-        for i, combination in enumerate(combinations_to_make):
-            if combination["name"] == name:
-                if i < 96:
-                    return reaction_plate.wells()[i]
-                else:
-                    return addition_plate.wells()[i-96]
-        raise ValueError("Could not find combination \"{0}\".".format(name))
+        if name not in reaction_layout:
+            raise ValueError("Could not find combination \"{0}\".".format(name))
+        return reaction_layout[name]
 
     #According to the type of PCR reaction, add different PCR raw materials and distribute them into the corresponding locations.
-    
-    if len(combinations) > 0:
-        combination = combinations[0]
-        part_i = combination["parts"]
-        total_reactions = len(pcr_recipe_to_make)
-    
-        #Prepare Dreamtaq master mix for all reactions
-        for j, part in enumerate(part_i):
-            if j == 0:
-                a = 4.5  # Water - 4.5 µL per reaction
-            elif j == 1:
-                a = 2.5  # MM_Dreamtaq - 2.5 µL per reaction
-            elif j == 2:
-                a = 1    # P128 - 1 µL per reaction
-            elif j == 3:
-                a = 1    # P132 - 1 µL per reaction
-            
-            rawpcr_well = find_rawpcr(part, pcr_deck_colony_template_maps_dict, pcr_deck)
-            p50_single.pick_up_tip()
-            p50_single.transfer(total_reactions * a + 2,  # +2 of dead volume
+    # Each master mix gets its own tube of pcr_mix_deck (several when it exceeds the tube capacity).
+    master_mix_tubes = split_master_mixes(combinations)
+    if len(master_mix_tubes) > len(pcr_mix_deck.wells()):
+        raise ValueError("Too many master mix tubes ({0}) for the {1} tubes of the PCR mix deck.".format(
+            len(master_mix_tubes), len(pcr_mix_deck.wells())))
+
+    # Each part is added with one tip to every tube that needs it, as for a single master mix
+    tubes_by_part = {}
+    for i, tube in enumerate(master_mix_tubes):
+        for part, volume in zip(tube["parts"], master_mix_volumes(tube)):
+            if part in tubes_by_part.keys():
+                tubes_by_part[part].append((pcr_mix_deck.wells()[i], volume))
+            else:
+                tubes_by_part[part] = [(pcr_mix_deck.wells()[i], volume)]
+
+    for part, part_tubes in tubes_by_part.items():
+        rawpcr_well = find_rawpcr(part, pcr_deck_colony_template_maps_dict, pcr_deck)
+        p50_single.pick_up_tip()
+        for mix_well, volume in part_tubes:
+            p50_single.transfer(volume,
                             rawpcr_well.bottom(z=2),
-                            pcr_mix_deck.wells()[0].bottom(z=3),
+                            mix_well.bottom(z=3),
                             blow_out=True, blowout_location='destination well',
                             new_tip='never')
-            p50_single.drop_tip()
+        p50_single.drop_tip()
+
+    for i, tube in enumerate(master_mix_tubes):
+        mix_well = pcr_mix_deck.wells()[i]
 
         # Mix the master mix
         p50_single.pick_up_tip()
-        p50_single.mix(3, 40, pcr_mix_deck.wells()[0].bottom(z=1))
+        p50_single.mix(3, min(40, 0.8 * sum(master_mix_volumes(tube))), mix_well.bottom(z=1))
         p50_single.drop_tip()
 
         # Distribute the master mix
-        destination_wells = []
-        for idx in range(total_reactions):
-            if idx < 96:
-                destination_wells.append(reaction_plate.wells()[idx])
-            else:
-                destination_wells.append(addition_plate.wells()[idx-96])
+        destination_wells = [find_combination(x, reaction_layout) for x in tube["name"]]
 
         p50_single.pick_up_tip()
         p50_single.distribute(reaction_volume-1,
-                            pcr_mix_deck.wells()[0].bottom(z=1),
+                            mix_well.bottom(z=1),
                             destination_wells,
                             disposal_volume=2, 
                             new_tip='never')
         p50_single.drop_tip()
 
-        print(f"Master mix distribué dans {total_reactions} puits")
+        print(f"Master mix {i + 1} distribué dans {len(destination_wells)} puits")
 
     # This function checks the existance of pcr raw materials and returns for well location of the raw materials
     def find_template(name, pcr_deck_colony_template_maps_dict, colony_template_deck):
@@ -197,10 +222,7 @@ def run(protocol: protocol_api.ProtocolContext):
                 
         template_well = find_template(colony_name, pcr_deck_colony_template_maps_dict, colony_template_deck)
         
-        if idx < 96:
-            destination_well = reaction_plate.wells()[idx]
-        else:
-            destination_well = addition_plate.wells()[idx-96]
+        destination_well = reaction_layout[recipe["name"]]
     
         p50_single.pick_up_tip()
         p50_single.transfer(1,
@@ -227,17 +249,9 @@ def run(protocol: protocol_api.ProtocolContext):
     # PCR steps
     tc_mod.close_lid()
     tc_mod.set_lid_temperature(105)
-    # denaturation
-    pre_denaturation_step = [{'temperature': 98, 'hold_time_seconds': 300}]
-    tc_mod.execute_profile(steps=pre_denaturation_step, repetitions=1, block_max_volume=reaction_volume)
-    # amplification cycles
-    j = 0
-    while j < pcr_cycles_number:
-        tc_mod.execute_profile(steps=pcr_cycles, repetitions=1, block_max_volume=reaction_volume)
-        j = j + 1
-    # further  extension step
-    extension_step = [{'temperature': 72, 'hold_time_seconds': 300}]
-    tc_mod.execute_profile(steps=extension_step, repetitions=1, block_max_volume=reaction_volume)
+    # denaturation, amplification cycles and further extension, one execute_profile call per segment
+    for steps, repetitions in thermocycler_programs['colony_pcr']:
+        tc_mod.execute_profile(steps=steps, repetitions=repetitions, block_max_volume=reaction_volume)
     tc_mod.set_block_temperature(25)
 
 
@@ -0,0 +1,152 @@
+# Colony PCR Protocol - 96-channel stamping
+# Companion of colony_PCR_workflow_Flex_v2_for_HT.py (stamping_mode = True), run on a Flex fitted with the 96-channel pipette
+# once the HT protocol has set up the master mixes and the other colonies.
+# Colony templates laid out as their reactions are stamped: a whole plate in one move, else one full column or row at a time.
+
+from opentrons import protocol_api, types
+import math
+
+metadata = {
+    'protocolName': 'Colony PCR - Flex 96-channel stamping',
+    'description': 'Colony PCR'}
+
+requirements = {"robotType": "Flex", "apiLevel": "2.21"}
+
+
+#####################################
+###### PCR reaction settings ########
+# As set up by the HT protocol in stamping mode, scaled up to the 5 uL colony template (stamping_colony_volume)
+reaction_volume = 37.5
+dna_volume = 5
+temperature_modules = 4
+#####################################
+
+# Smallest volume (uL) the 96-channel pipette transfers accurately with 50 uL tips
+min_pipette_volume = 5
+if dna_volume < min_pipette_volume:
+    raise ValueError("The {0} uL colony volume is under the {1} uL minimum of the 96-channel pipette".format(dna_volume, min_pipette_volume))
+
+#number of reactions
+num_rxns = len(pcr_recipe_to_make)
+
+# Stamping: the reactions fill the reaction plates column by column, as in the HT workflow.
+# A plate, column or row is stamped when each of its wells takes its colony from the same well of the template plate.
+def plan_stamps(pcr_recipe_to_make, pcr_deck_colony_template_maps_dict):
+    """Return the stamps and the names of the stamped reactions.
+
+    A stamp is (reaction plate index, 'plate', None), (index, 'column', column number) or (index, 'row', row letter)."""
+    rows = 'ABCDEFGH'
+    # Only the colony template map locates colonies, the deck map holds the master mix and reagent tubes
+    template_maps = [plate_map for map_name, plate_map in pcr_deck_colony_template_maps_dict.items() if map_name != "pcr_deck_map"]
+    template_wells = {}
+    for plate_map in template_maps:
+        for i, row in enumerate(plate_map):
+            for j, colony_name in enumerate(row):
+                if colony_name:
+                    if i >= 8 or j >= 12:
+                        raise ValueError("Colony {0} is outside a 96-well plate, stamping needs a 96-well colony template plate".format(colony_name))
+                    template_wells.setdefault(colony_name, rows[i] + str(j + 1))
+
+    aligned_wells = {}
+    reaction_names = {}
+    for k, reaction in enumerate(pcr_recipe_to_make):
+        plate_index, well_name = k // 96, rows[k % 8] + str(k % 96 // 8 + 1)
+        reaction_names[(plate_index, well_name)] = reaction["name"]
+        if template_wells.get(reaction["parts"][-1]) == well_name:
+            aligned_wells.setdefault(plate_index, set()).add(well_name)
+
+    stamps = []
+    for plate_index, wells in aligned_wells.items():
+        if len(wells) == 96:
+            stamps.append((plate_index, 'plate', None))
+            continue
+        # Full columns and full rows cross each other, so only the layout covering more wells is used
+        columns = [str(j) for j in range(1, 13) if all(row + str(j) in wells for row in rows)]
+        full_rows = [row for row in rows if all(row + str(j) in wells for j in range(1, 13))]
+        if len(columns) * 8 >= len(full_rows) * 12:
+            stamps += [(plate_index, 'column', column) for column in columns]
+        else:
+            stamps += [(plate_index, 'row', row) for row in full_rows]
+
+    stamped_names = set()
+    for plate_index, style, line in stamps:
+        for (index, well_name), name in reaction_names.items():
+            if index == plate_index and (style == 'plate' or (style == 'column' and well_name[1:] == line) or (style == 'row' and well_name[0] == line)):
+                stamped_names.add(name)
+    return stamps, stamped_names
+
+def run(protocol: protocol_api.ProtocolContext):
+    # Trash need to be specified with Flex
+    trash = protocol.load_trash_bin("A3")
+
+    # loading pipette and tips
+    # Whole-plate pickups need the tip rack on the 96-channel adapter, partial pickups a rack without it.
+    # Column pickups use nozzle A12 and row pickups nozzle A1: the slots left of and in front of these racks stay low.
+    tr_plate = protocol.load_labware('opentrons_flex_96_tiprack_50ul', 'A2', '96-channel Tips Rack',
+                                     adapter='opentrons_flex_96_tiprack_adapter')
+    tr_column = protocol.load_labware('opentrons_flex_96_tiprack_50ul', 'B2', '96-channel Column Tips Rack')
+    tr_row = protocol.load_labware('opentrons_flex_96_tiprack_50ul', 'B3', '96-channel Row Tips Rack')
+
+    p96 = protocol.load_instrument('flex_96channel_1000', 'left', tip_racks=[tr_plate])
+
+    # loading reaction plates
+    reaction_mod = protocol.load_module('temperature module gen2', 'A1')
+    temp_reaction = reaction_mod.load_adapter('opentrons_96_well_aluminum_block')
+    reaction_plate = temp_reaction.load_labware('biorad_96_wellplate_200ul_pcr')
+
+    addition_plate = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 'C1')
+
+    # loading plate with picked colonies in 80ul medium
+    colony_template_deck = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 'B1')
+
+    reaction_plates = [reaction_plate, addition_plate]
+    stamps, stamped_names = plan_stamps(pcr_recipe_to_make, pcr_deck_colony_template_maps_dict)
+
+    reaction_mod.start_set_temperature(temperature_modules)
+    protocol.pause(f'Temp module cooling down!\n Put the reaction plate set up by the HT protocol on the module (A1)'
+                   f'{", the addition plate in C1" if num_rxns > 96 else ""} and the colony template plate in B1:'
+                   f' {len(stamps)} stamps for {len(stamped_names)} reactions.')
+    reaction_mod.await_temperature(temperature_modules)
+
+    # Tip racks are replaced by the operator when the next pickup would need more tips than they have left
+    tip_racks = {'plate': (tr_plate, 'A2', 1), 'column': (tr_column, 'B2', 12), 'row': (tr_row, 'B3', 8)}
+    pickups_left = {style: capacity for style, (tip_rack, slot, capacity) in tip_racks.items()}
+    def pick_up_tips(style):
+        tip_rack, slot, capacity = tip_racks[style]
+        if pickups_left[style] == 0:
+            protocol.pause(f'Replace the empty tip rack in {slot}.')
+            tip_rack.reset()
+            pickups_left[style] = capacity
+        p96.pick_up_tip()
+        pickups_left[style] -= 1
+
+    mix_volume = min(reaction_volume * 0.75, 10)
+    def stamp_colonies(style, template_well, colony_well):
+        pick_up_tips(style)
+        p96.aspirate(dna_volume, template_well.bottom(z=2))
+        p96.dispense(dna_volume, colony_well)
+        p96.mix(3, mix_volume, colony_well)
+        p96.blow_out()
+        p96.drop_tip()
+
+    # Whole plates first, then the columns and the rows, as the nozzle layout is set once for each
+    for layout_style in ['plate', 'column', 'row']:
+        layout_stamps = [stamp for stamp in stamps if stamp[1] == layout_style]
+        if not layout_stamps:
+            continue
+        if layout_style == 'plate':
+            p96.configure_nozzle_layout(style=protocol_api.ALL, tip_racks=[tr_plate])
+        elif layout_style == 'column':
+            p96.configure_nozzle_layout(style=protocol_api.COLUMN, start='A12', tip_racks=[tr_column])
+        else:
+            p96.configure_nozzle_layout(style=protocol_api.ROW, start='A1', tip_racks=[tr_row])
+        for plate_index, style, line in layout_stamps:
+            # The primary nozzle targets the first well of the plate, column or row
+            well_name = 'A1' if style == 'plate' else 'A' + line if style == 'column' else line + '1'
+            stamp_colonies(style, colony_template_deck[well_name], reaction_plates[plate_index][well_name])
+
+    protocol.comment(f'Colony templates: {len(stamps)} stamps instead of {len(stamped_names)} single-well moves')
+
+    # seal the pcr plate with adhesive film and conduct the GG program
+    protocol.pause('Please seal the PCR plates.')
+    reaction_mod.deactivate()
@@ -15,19 +15,139 @@ metadata = {
 requirements = {"robotType": "Flex", "apiLevel": "2.21"}
 
 
+# Reaction plate format, chosen in the generator (reaction_plate_format): labware of the reaction plates, adapter on the
+# temperature module and volume scale of the reactions. 384-well plates take half-volume reactions, whose 1 uL colony
+# template is the smallest volume the 50 uL pipette transfers accurately.
+reaction_plate_formats = {
+    96: {'labware': 'biorad_96_wellplate_200ul_pcr', 'adapter': 'opentrons_96_well_aluminum_block', 'volume_scale': 1},
+    384: {'labware': 'biorad_384_wellplate_50ul', 'adapter': None, 'volume_scale': 0.5},
+}
+if reaction_plate_format not in reaction_plate_formats:
+    raise ValueError("Unknown reaction plate format {0}, choose one of {1}".format(reaction_plate_format, ', '.join(str(x) for x in reaction_plate_formats)))
+reaction_plate_profile = reaction_plate_formats[reaction_plate_format]
+volume_scale = reaction_plate_profile['volume_scale']
+
+# 8-channel mode: reaction columns whose colonies sit in the same rows of one template column
+# get their colony templates one column at a time
+multichannel_mode = False
+
+# 96-channel stamping mode: colony templates laid out as their reactions are left to colony_PCR_workflow_Flex_96channel.py,
+# run afterwards on a Flex fitted with the 96-channel pipette (it takes both mounts, so it cannot share this run)
+stamping_mode = False
+
+if (multichannel_mode or stamping_mode) and reaction_plate_format != 96:
+    raise ValueError("8-channel and stamping modes need 96-well reaction plates, the nozzles only reach every other row of a 384-well plate")
+
+# The 96-channel pipette transfers 5 uL at least with 50 uL tips: in stamping mode the reactions are scaled up to the
+# 5 uL colony template that colony_PCR_workflow_Flex_96channel.py stamps
+stamping_colony_volume = 5
+if stamping_mode:
+    volume_scale = stamping_colony_volume / 2
+
 #####################################
 ###### PCR reaction settings ########
-reaction_volume = 15
-dna_volume = 2
-enzyme_buffer_volume = 7.5
-primer_volume = 1.5
-water_volume = 2.5
+reaction_volume = 15 * volume_scale
+dna_volume = 2 * volume_scale
+enzyme_buffer_volume = 7.5 * volume_scale
+primer_volume = 1.5 * volume_scale
+water_volume = 2.5 * volume_scale
 temperature_modules = 4
 #####################################
 
+# Smallest volume (uL) the 50 uL pipette transfers accurately, the protocol is refused for a colony volume under it
+min_pipette_volume = 1
+if dna_volume < min_pipette_volume:
+    raise ValueError("The {0} uL colony volume is under the {1} uL pipette minimum".format(dna_volume, min_pipette_volume))
+
 #number of reactions
 num_rxns = len(pcr_recipe_to_make)
 
+# Colony template plate: the smallest plate (rows, columns, labware) the colony template maps fit in
+template_plate_formats = [(8, 12, 'biorad_96_wellplate_200ul_pcr'), (16, 24, 'biorad_384_wellplate_50ul')]
+
+def template_plate_labware(pcr_deck_colony_template_maps_dict):
+    """Return the load name of the colony template plate for template maps of up to 16 rows and 24 columns."""
+    template_maps = [plate_map for map_name, plate_map in pcr_deck_colony_template_maps_dict.items() if map_name != "pcr_deck_map"]
+    nb_rows = max((i + 1 for plate_map in template_maps for i, row in enumerate(plate_map) if any(row)), default=0)
+    nb_columns = max((j + 1 for plate_map in template_maps for row in plate_map for j, colony_name in enumerate(row) if colony_name), default=0)
+    for max_rows, max_columns, load_name in template_plate_formats:
+        if nb_rows <= max_rows and nb_columns <= max_columns:
+            return load_name
+    raise ValueError("Colony template map has {0} rows and {1} columns, template plates have at most 16 rows and 24 columns".format(nb_rows, nb_columns))
+
+template_plate_load_name = template_plate_labware(pcr_deck_colony_template_maps_dict)
+
+if stamping_mode and template_plate_load_name != 'biorad_96_wellplate_200ul_pcr':
+    raise ValueError("Stamping mode needs a 96-well colony template plate, the colony template map does not fit in 8 rows and 12 columns")
+
+# Master mixes: the reactions sharing water, mastermix and primers are made from one tube of master mix
+def group_master_mixes(pcr_recipe_to_make):
+    """Return the master mixes as a list of {"name": [reaction names], "parts": [water, mastermix, primers]}, in order of first use.
+
+    Reactions are grouped on their parts (all but the colony) with a dict, in one pass over the recipe."""
+    master_mixes = {}
+    for reaction in pcr_recipe_to_make:
+        parts = reaction["parts"][0:-1]
+        if tuple(parts) not in master_mixes:
+            master_mixes[tuple(parts)] = {"name": [], "parts": parts}
+        master_mixes[tuple(parts)]["name"].append(reaction["name"])
+    return list(master_mixes.values())
+
+def master_mix_volumes(master_mix):
+    """Return the volume (uL) of each part to put in the master mix tube, with 20% extra to avoid pipetting errors.
+
+    Small master mixes are made larger, so that no part is pipetted under the pipette minimum."""
+    pcr_sample_number = len(master_mix["name"]) * 1.2
+    part_volumes = [water_volume, enzyme_buffer_volume]
+    volumes = [pcr_sample_number * (part_volumes[j] if j < 2 else primer_volume) for j in range(len(master_mix["parts"]))]
+    return [volume * max(1, min_pipette_volume / min(volumes)) for volume in volumes]
+
+# Stamping: the reactions fill the reaction plates column by column, as in the HT workflow.
+# A plate, column or row is stamped when each of its wells takes its colony from the same well of the template plate.
+def plan_stamps(pcr_recipe_to_make, pcr_deck_colony_template_maps_dict):
+    """Return the stamps and the names of the stamped reactions.
+
+    A stamp is (reaction plate index, 'plate', None), (index, 'column', column number) or (index, 'row', row letter)."""
+    rows = 'ABCDEFGH'
+    # Only the colony template map locates colonies, the deck map holds the master mix and reagent tubes
+    template_maps = [plate_map for map_name, plate_map in pcr_deck_colony_template_maps_dict.items() if map_name != "pcr_deck_map"]
+    template_wells = {}
+    for plate_map in template_maps:
+        for i, row in enumerate(plate_map):
+            for j, colony_name in enumerate(row):
+                if colony_name:
+                    if i >= 8 or j >= 12:
+                        raise ValueError("Colony {0} is outside a 96-well plate, stamping needs a 96-well colony template plate".format(colony_name))
+                    template_wells.setdefault(colony_name, rows[i] + str(j + 1))
+
+    aligned_wells = {}
+    reaction_names = {}
+    for k, reaction in enumerate(pcr_recipe_to_make):
+        plate_index, well_name = k // 96, rows[k % 8] + str(k % 96 // 8 + 1)
+        reaction_names[(plate_index, well_name)] = reaction["name"]
+        if template_wells.get(reaction["parts"][-1]) == well_name:
+            aligned_wells.setdefault(plate_index, set()).add(well_name)
+
+    stamps = []
+    for plate_index, wells in aligned_wells.items():
+        if len(wells) == 96:
+            stamps.append((plate_index, 'plate', None))
+            continue
+        # Full columns and full rows cross each other, so only the layout covering more wells is used
+        columns = [str(j) for j in range(1, 13) if all(row + str(j) in wells for row in rows)]
+        full_rows = [row for row in rows if all(row + str(j) in wells for j in range(1, 13))]
+        if len(columns) * 8 >= len(full_rows) * 12:
+            stamps += [(plate_index, 'column', column) for column in columns]
+        else:
+            stamps += [(plate_index, 'row', row) for row in full_rows]
+
+    stamped_names = set()
+    for plate_index, style, line in stamps:
+        for (index, well_name), name in reaction_names.items():
+            if index == plate_index and (style == 'plate' or (style == 'column' and well_name[1:] == line) or (style == 'row' and well_name[0] == line)):
+                stamped_names.add(name)
+    return stamps, stamped_names
+
 def run(protocol: protocol_api.ProtocolContext):
     # Trash need to be specified with Flex
     trash = protocol.load_trash_bin("A3")
@@ -39,15 +159,28 @@ def run(protocol: protocol_api.ProtocolContext):
 
     p50_single = protocol.load_instrument('flex_1channel_50', 'right', tip_racks=[tr_50_1,tr_50_2,tr_50_3])
 
+    # The operator replaces the racks once they are empty
+    single_tips_left = {'tips': 3 * 96}
+    def pick_up_single_tip():
+        if single_tips_left['tips'] == 0:
+            protocol.pause('Replace the 3 empty tip racks (C3, B3, A2) with full ones.')
+            p50_single.reset_tipracks()
+            single_tips_left['tips'] = 3 * 96
+        single_tips_left['tips'] -= 1
+        p50_single.pick_up_tip()
+
     # loading thermocycler
     reaction_mod = protocol.load_module('temperature module gen2', 'A1')
-    temp_reaction = reaction_mod.load_adapter('opentrons_96_well_aluminum_block')
-    reaction_plate = temp_reaction.load_labware('biorad_96_wellplate_200ul_pcr')
+    if reaction_plate_profile['adapter']:
+        temp_reaction = reaction_mod.load_adapter(reaction_plate_profile['adapter'])
+        reaction_plate = temp_reaction.load_labware(reaction_plate_profile['labware'])
+    else:
+        reaction_plate = reaction_mod.load_labware(reaction_plate_profile['labware'])
 
-    addition_plate = protocol.load_labware('biorad_96_wellplate_200ul_pcr', 'D1')
+    addition_plate = protocol.load_labware(reaction_plate_profile['labware'], 'D1')
 
     # loading plate with picked colonies in 80ul medium
-    colony_template_deck= protocol.load_labware('biorad_96_wellplate_200ul_pcr', 'B1')
+    colony_template_deck= protocol.load_labware(template_plate_load_name, 'B1')
 
     # loading rack with PCR recipe tubes
     pcr_mod = protocol.load_module('temperature module gen2', 'D3')
@@ -56,34 +189,16 @@ def run(protocol: protocol_api.ProtocolContext):
 
     pcr_mix_deck = protocol.load_labware('opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap', 'D2')
 
-    # Mettre les modules de température à 4°C
-    pcr_mod.set_temperature(temperature_modules)
-    reaction_mod.set_temperature(temperature_modules)
+    # Mettre les modules de température à 4°C, sans attendre : ils refroidissent pendant la pause
+    pcr_mod.start_set_temperature(temperature_modules)
+    reaction_mod.start_set_temperature(temperature_modules)
 
-    protocol.pause(f'Temp modules ready!')
+    protocol.pause(f'Temp modules cooling down!')
+    pcr_mod.await_temperature(temperature_modules)
+    reaction_mod.await_temperature(temperature_modules)
 
 #Calculate how many PCR reaction systems there are in total
-    combinations = [] # list of dict [{name:[...],parts:[water,mastermix,primerfor,primerrev]},{name:[...],parts:[water,mastermix,primerfor,primerrev]}]
-    name_1 = pcr_recipe_to_make[0]["name"]
-    part_1 = pcr_recipe_to_make[0]["parts"][0:-1]
-    combinations.append({"name": [name_1], "parts": part_1})
-    for i in pcr_recipe_to_make[1:]:
-        name = i["name"]
-        part = i["parts"][0:-1] # take water, mastermix, primers (but not colony ofc)
-        j = 0
-        a = len(combinations) # number of combinations
-        while j < a: # looping through existing combinations
-            # If the parts of j are different from i["parts"], set a new dictionary in combinations
-            name_j = combinations[j]["name"]
-            parts_j = combinations[j]["parts"]
-            if part == parts_j:
-                name_j.append(name)
-                break
-                # If the parts of j are the same as i["parts"], insert the name corresponding to i["parts"] into the 
-                #the dictionary corresponding to this part.
-            elif j == a - 1:
-                combinations.append({"name": [name], "parts": part})
-            j = j + 1
+    combinations = group_master_mixes(pcr_recipe_to_make) # list of dict [{name:[...],parts:[water,mastermix,primerfor,primerrev]},...]
 
     # This function checks the existance of pcr raw materials and returns for well location of the raw materials
     def find_rawpcr(name, pcr_plate_map_dict, pcr_deck):
@@ -96,16 +211,29 @@ def run(protocol: protocol_api.ProtocolContext):
                         return pcr_deck.wells()[well_num]
         raise ValueError("Could not find dna piece named \"{0}\"".format(name))
 
+    # This function maps every combination to its well in the reaction plates, filling the plates in order.
+    # The layout is built once and shared by all the transfer steps below.
+    def map_combinations_to_wells(combinations_to_make, plates):
+        """Return a dict mapping each combination name to its destination well."""
+        plate_wells = [well for plate in plates for well in plate.wells()]
+        if len(combinations_to_make) > len(plate_wells):
+            raise ValueError("Too many combinations ({0}) for {1} reaction wells.".format(len(combinations_to_make), len(plate_wells)))
+        reaction_layout = {}
+        for i, combination in enumerate(combinations_to_make):
+            if combination["name"] in reaction_layout:
+                raise ValueError("Combination \"{0}\" is listed twice.".format(combination["name"]))
+            reaction_layout[combination["name"]] = plate_wells[i]
+        return reaction_layout
+
+    reaction_layout = map_combinations_to_wells(pcr_recipe_to_make, [reaction_plate, addition_plate])
+    reaction_wells = list(reaction_layout.values())
+
     # This function checks if the DNA parts exist in the DNA plates and returns for well location of output DNA combinations
-    def find_combination(name, combinations_to_make):
+    def find_combination(name, reaction_layout):
         """Return a well containing the named combination."""
-        for i, combination in enumerate(combinations_to_make):
-            if combination["name"] == name:
-                if i < 96:
-                    return reaction_plate.wells()[i]
-                else:
-                    return addition_plate.wells()[i-96]
-        raise ValueError("Could not find combination \"{0}\".".format(name))
+        if name not in reaction_layout:
+            raise ValueError("Could not find combination \"{0}\".".format(name))
+        return reaction_layout[name]
 
     #According to the type of PCR reaction, add different PCR raw materials and distribute them into the corresponding locations.
     for i, combination in enumerate(combinations):
@@ -115,21 +243,13 @@ def run(protocol: protocol_api.ProtocolContext):
         pcr_plate_map_dict_list = pcr_deck_colony_template_maps_dict["pcr_deck_map"]
         pcr_plate_map_dict_number = sum([len(count) for count in pcr_plate_map_dict_list])
 
-        for j, part in enumerate(part_i):
-            if j == 0:
-                a = water_volume
-            elif j == 1:
-                a = enzyme_buffer_volume
-            elif j == 2 or 3:
-                a = primer_volume
-
-            volume_j = pcr_sample_number * a
+        for j, (part, volume_j) in enumerate(zip(part_i, master_mix_volumes(combination))):
             repeat = volume_j // 50
             last = volume_j % 50
 
             rawpcr_well = find_rawpcr(part, pcr_deck_colony_template_maps_dict, pcr_deck)
 
-            p50_single.pick_up_tip()
+            pick_up_single_tip()
             for k in range(int(repeat)):
                 p50_single.configure_for_volume(50)
                 p50_single.transfer(50,
@@ -139,10 +259,10 @@ def run(protocol: protocol_api.ProtocolContext):
                                      new_tip='never')
                 if (j == 2) or (j == 3):
                     p50_single.drop_tip()
-                    p50_single.pick_up_tip()
+                    pick_up_single_tip()
                 elif (k % 4) == 3:
                     p50_single.drop_tip()
-                    p50_single.pick_up_tip()
+                    pick_up_single_tip()
 
             p50_single.configure_for_volume(last)
             p50_single.transfer(last,
@@ -154,26 +274,28 @@ def run(protocol: protocol_api.ProtocolContext):
 
         protocol.pause('Mix PCR mastermixes manually if needed')
 
-        p50_single.pick_up_tip()
+        pick_up_single_tip()
         volume_mix = min(50,(reaction_volume - dna_volume) * (pcr_sample_number - 1))
         p50_single.configure_for_volume(volume_mix)
         p50_single.mix(2, volume_mix, pcr_mix_deck.wells()[i].bottom(z=1))
         p50_single.drop_tip()
 
         p50_single.configure_for_volume(reaction_volume-dna_volume)
-        pcr_combination_wells = [find_combination(x, pcr_recipe_to_make) for x in name_i]
+        pcr_combination_wells = [find_combination(x, reaction_layout) for x in name_i]
 
-        nb_per_disp = 3 * (50 // reaction_volume-dna_volume)
+        nb_per_disp = 3 * int(50 // (reaction_volume - dna_volume))
         div = len(pcr_combination_wells) // nb_per_disp
         for disp in range(div + 1):
             start_pos = disp * nb_per_disp
             end_pos = min(start_pos + nb_per_disp, len(pcr_combination_wells))
             distribute_wells = pcr_combination_wells[start_pos:end_pos]
             if distribute_wells != []:
+                pick_up_single_tip()
                 p50_single.distribute(reaction_volume-dna_volume,
                                 pcr_mix_deck.wells()[i].bottom(z=1),
                                 distribute_wells,
-                                disposal_volume=1, new_tip='once')
+                                disposal_volume=1, new_tip='never')
+                p50_single.drop_tip()
 
 
     # This function checks the existence of pcr raw materials and returns for well location of the raw materials
@@ -183,8 +305,7 @@ def run(protocol: protocol_api.ProtocolContext):
             for i, row in enumerate(plate_map):
                 for j, colony_name in enumerate(row):
                     if colony_name == name:
-                        well_num = 8 * j + i
-                        return colony_template_deck.wells()[well_num]
+                        return colony_template_deck.rows()[i][j]
         raise ValueError("Could not find colony template named \"{0}\"".format(name))
 
     combinations_by_colony_template = {}
@@ -196,18 +317,114 @@ def run(protocol: protocol_api.ProtocolContext):
         else:
             combinations_by_colony_template[template] = [name]
 
-    p50_single.configure_for_volume(dna_volume)
+    # This function splits wells into the column blocks the 8-channel pipette can serve in one move.
+    # A block is a run of wells ending at row H of a plate column, so that partial blocks can be served
+    # from nozzle H1 without the empty nozzles leaving the deck; ragged columns are left to the single channel.
+    def split_column_blocks(wells):
+        """Return the list of column blocks and the list of leftover wells."""
+        wells_by_column = {}
+        for well in wells:
+            column = (well.parent, well.well_name[1:])
+            if column in wells_by_column.keys():
+                wells_by_column[column].append(well)
+            else:
+                wells_by_column[column] = [well]
+        column_blocks = []
+        single_wells = []
+        for column_wells in wells_by_column.values():
+            column_wells = sorted(column_wells, key=lambda well: well.well_name[0])
+            rows = ''.join(well.well_name[0] for well in column_wells)
+            if len(column_wells) > 1 and rows == 'ABCDEFGH'[8 - len(column_wells):]:
+                column_blocks.append(column_wells)
+            else:
+                single_wells.extend(column_wells)
+        return column_blocks, single_wells
+
+    # This function groups column blocks by height, as the nozzle layout has to be set once for each height
+    def group_blocks_by_rows(column_blocks):
+        """Return a dict mapping a number of rows to the column blocks of that height."""
+        blocks_by_rows = {}
+        for block in column_blocks:
+            if len(block) in blocks_by_rows.keys():
+                blocks_by_rows[len(block)].append(block)
+            else:
+                blocks_by_rows[len(block)] = [block]
+        return blocks_by_rows
+
+    # This function checks that a block of reactions takes its colonies from the same rows of one template column
+    def is_template_aligned(block, template_by_well):
+        """Return True if the 8-channel pipette can move the whole block from the template plate."""
+        templates = [template_by_well[well] for well in block]
+        if len(set(template.well_name[1:] for template in templates)) != 1:
+            return False
+        return all(template.well_name[0] == well.well_name[0] for template, well in zip(templates, block))
+
+    mix_volume = min(reaction_volume * 0.75, 10)
+    def add_colony(pipette, template_well, colony_well):
+        if pipette is p50_single:
+            pick_up_single_tip()
+        else:
+            pipette.pick_up_tip()
+        pipette.aspirate(dna_volume, template_well.bottom(z=2))
+        pipette.dispense(dna_volume, colony_well)
+        pipette.mix(3, mix_volume, colony_well)
+        pipette.blow_out()
+        pipette.drop_tip()
+
+    # In stamping mode, the stamped reactions get their colonies in the 96-channel run
+    if stamping_mode:
+        stamps, stamped_names = plan_stamps(pcr_recipe_to_make, pcr_deck_colony_template_maps_dict)
+    else:
+        stamps, stamped_names = [], set()
+
+    template_by_well = {}
     for part, combination_template in combinations_by_colony_template.items():
         template_well = find_template(part, pcr_deck_colony_template_maps_dict, colony_template_deck)
-        colony_combination_wells = [find_combination(x, pcr_recipe_to_make) for x in combination_template]
-        for colony_well in colony_combination_wells:
-            p50_single.pick_up_tip()
-            p50_single.aspirate(dna_volume, template_well.bottom(z=2))
-            p50_single.dispense(dna_volume, colony_well)
-            mix_volume = min(reaction_volume * 0.75, 10)
-            p50_single.mix(3, mix_volume, colony_well)
-            p50_single.blow_out()
-            p50_single.drop_tip()
+        for x in combination_template:
+            if x not in stamped_names:
+                template_by_well[find_combination(x, reaction_layout)] = template_well
+
+    if multichannel_mode:
+        column_blocks, single_wells = split_column_blocks(list(template_by_well.keys()))
+        single_wells += [well for block in column_blocks if not is_template_aligned(block, template_by_well) for well in block]
+        column_blocks = [block for block in column_blocks if is_template_aligned(block, template_by_well)]
+    else:
+        column_blocks, single_wells = [], list(template_by_well.keys())
+
+    if column_blocks:
+        # Partial-column pickups start from nozzle H1, so the empty nozzles hang over the slot behind the rack:
+        # the partial rack goes in C1, behind which sits the colony template plate (B1)
+        nb_partial_blocks = len([block for block in column_blocks if len(block) < 8])
+        nb_full_blocks = len(column_blocks) - nb_partial_blocks
+        partial_tip_racks = [protocol.load_labware('opentrons_flex_96_tiprack_50ul', slot, '8-channel Partial Tips Rack')
+                             for slot in ['C1'][:math.ceil(nb_partial_blocks / 12)]]
+        full_tip_racks = [protocol.load_labware('opentrons_flex_96_tiprack_50ul', slot, f'8-channel Tips Rack {i+1}')
+                          for i, slot in enumerate(['B2', 'C2'][:math.ceil(nb_full_blocks / 12)])]
+        p50_multi = protocol.load_instrument('flex_8channel_50', 'left', tip_racks=full_tip_racks)
+        p50_multi.configure_for_volume(dna_volume)
+        for nb_rows, blocks in group_blocks_by_rows(column_blocks).items():
+            # Partial blocks use the bottom nozzles (from H1), so the primary nozzle targets the row H well of the block
+            if nb_rows == 8:
+                p50_multi.configure_nozzle_layout(style=protocol_api.ALL, tip_racks=full_tip_racks)
+                target = 0
+            else:
+                p50_multi.configure_nozzle_layout(style=protocol_api.PARTIAL_COLUMN, start='H1', end='ABCDEFGH'[8 - nb_rows] + '1',
+                                                   tip_racks=partial_tip_racks)
+                target = -1
+            for block in blocks:
+                add_colony(p50_multi, template_by_well[block[target]], block[target])
+
+    p50_single.configure_for_volume(dna_volume)
+    for colony_well in single_wells:
+        add_colony(p50_single, template_by_well[colony_well], colony_well)
+
+    if multichannel_mode and template_by_well:
+        nb_moves = len(column_blocks) + len(single_wells)
+        protocol.comment(f'Colony templates: {len(column_blocks)} column moves + {len(single_wells)} single-well moves instead of {num_rxns} ({num_rxns / nb_moves:.1f}x)')
+
+    if stamps:
+        protocol.pause(f'Colony templates of {len(stamped_names)} reactions are left to the 96-channel stamping protocol '
+                       f'({len(stamps)} stamps): keep the reaction plates cold and run it next.')
 
 
 
@@ -12,12 +12,8 @@ metadata = {
     'description': 'Colony PCR Protocol'}
 
 #####################################
-#PCR cycles and extension time；change this!!!
-pcr_cycles = [
-    {'temperature': 98, 'hold_time_seconds': 15},
-    {'temperature': 55 , 'hold_time_seconds': 30},
-    {'temperature': 72, 'hold_time_seconds': 200}]#change this!!!
-pcr_cycles_number = 30 #change this!!!
+#PCR cycles and extension time: set in the generator (annealing temperature, amplicon length, number of cycles),
+#which compiles them into thermocycler_programs
 reaction_volume = 10 #change this!!!
 #####################################
 
@@ -25,6 +21,25 @@ reaction_volume = 10 #change this!!!
 #number of ractions
 num_rxns = len(pcr_recipe_to_make)
 
+# Master mixes: the reactions sharing water, mastermix and primers are made from one tube of master mix
+def group_master_mixes(pcr_recipe_to_make):
+    """Return the master mixes as a list of {"name": [reaction names], "parts": [water, mastermix, primers]}, in order of first use.
+
+    Reactions are grouped on their parts (all but the colony) with a dict, in one pass over the recipe."""
+    master_mixes = {}
+    for reaction in pcr_recipe_to_make:
+        parts = reaction["parts"][0:-1]
+        if tuple(parts) not in master_mixes:
+            master_mixes[tuple(parts)] = {"name": [], "parts": parts}
+        master_mixes[tuple(parts)]["name"].append(reaction["name"])
+    return list(master_mixes.values())
+
+def master_mix_volumes(master_mix):
+    """Return the volume (uL) of each part to put in the master mix tube, with 2 reactions extra."""
+    pcr_sample_number = len(master_mix["name"]) + 2
+    part_volumes = [reaction_volume/2-3, reaction_volume/2]
+    return [pcr_sample_number * (part_volumes[j] if j < 2 else 1) for j in range(len(master_mix["parts"]))]
+
 def run(protocol: protocol_api.ProtocolContext):
     # loading pipette and tips
     tr_300 = protocol.load_labware('opentrons_96_tiprack_300ul', '6')
@@ -46,27 +61,7 @@ def run(protocol: protocol_api.ProtocolContext):
     pcr_mix_deck = protocol.load_labware('opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap', '5', ' pcr_deck')
 
 #Calculate how many PCR reaction systems there are in total
-    combinations = []
-    name_1 = pcr_recipe_to_make[0]["name"]
-    part_1 = pcr_recipe_to_make[0]["parts"][0:-1]
-    combinations.append({"name": [name_1], "parts": part_1})
-    for i in pcr_recipe_to_make[1:]:
-        name = i["name"]
-        part = i["parts"][0:-1]
-        j = 0
-        a = len(combinations)
-        while j < a:
-            # If the parts of j are different from i["parts"], set a new dictionary in combinations
-            name_j = combinations[j]["name"]
-            parts_j = combinations[j]["parts"]
-            if part == parts_j:
-                name_j.append(name)
-                break
-                # If the parts of j are the same as i["parts"], insert the name corresponding to i["parts"] into the 
-                #the dictionary corresponding to this part.
-            elif j == a - 1:
-                combinations.append({"name": [name], "parts": part})
-            j = j + 1
+    combinations = group_master_mixes(pcr_recipe_to_make) # list of dict [{name:[...],parts:[water,mastermix,primerfor,primerrev]},...]
 
     # This function checks the existance of pcr raw materials and returns for well location of the raw materials
     def find_rawpcr(name, pcr_plate_map_dict, pcr_deck):
@@ -79,16 +74,29 @@ def run(protocol: protocol_api.ProtocolContext):
                         return pcr_deck.wells()[well_num]
         raise ValueError("Could not find dna piece named \"{0}\"".format(name))
 
+    # This function maps every combination to its well in the reaction plates, filling the plates in order.
+    # The layout is built once and shared by all the transfer steps below.
+    def map_combinations_to_wells(combinations_to_make, plates):
+        """Return a dict mapping each combination name to its destination well."""
+        plate_wells = [well for plate in plates for well in plate.wells()]
+        if len(combinations_to_make) > len(plate_wells):
+            raise ValueError("Too many combinations ({0}) for {1} reaction wells.".format(len(combinations_to_make), len(plate_wells)))
+        reaction_layout = {}
+        for i, combination in enumerate(combinations_to_make):
+            if combination["name"] in reaction_layout:
+                raise ValueError("Combination \"{0}\" is listed twice.".format(combination["name"]))
+            reaction_layout[combination["name"]] = plate_wells[i]
+        return reaction_layout
+
+    reaction_layout = map_combinations_to_wells(pcr_recipe_to_make, [reaction_plate, addition_plate])
+    reaction_wells = list(reaction_layout.values())
+
     # This function checks if the DNA parts exist in the DNA plates and returns for well locaion of output DNA combinations
-    def find_combination(name, combinations_to_make):
+    def find_combination(name, reaction_layout):
         """Return a well containing the named combination."""
-        for i, combination in enumerate(combinations_to_make):
-            if combination["name"] == name:
-                if i < 96:
-                    return reaction_plate.wells()[i]
-                else:
-                    return addition_plate.wells()[i-96]
-        raise ValueError("Could not find combination \"{0}\".".format(name))
+        if name not in reaction_layout:
+            raise ValueError("Could not find combination \"{0}\".".format(name))
+        return reaction_layout[name]
 
     #According to the type of PCR reaction, add different PCR raw materials and distribute them into the corresponding locations.
     for i, combination in enumerate(combinations):
@@ -98,16 +106,10 @@ def run(protocol: protocol_api.ProtocolContext):
         pcr_plate_map_dict_list = pcr_deck_colony_template_maps_dict["pcr_deck_map"]
         pcr_plate_map_dict_number = sum([len(count) for count in pcr_plate_map_dict_list])
 
-        for j, part in enumerate(part_i):
-            if j == 0:
-                a = reaction_volume/2-3
-            elif j == 1:
-                a = reaction_volume/2
-            elif j == 2 or 3:
-                a = 1
+        for part, volume_j in zip(part_i, master_mix_volumes(combination)):
             rawpcr_well = find_rawpcr(part, pcr_deck_colony_template_maps_dict, pcr_deck)
             p300_single.pick_up_tip()
-            p300_single.transfer(pcr_sample_number * a,
+            p300_single.transfer(volume_j,
                                  rawpcr_well.bottom(z=2),
                                  pcr_mix_deck.wells()[i].bottom(z=3),
                                  blow_out=True, blowout_location='destination well',
@@ -116,7 +118,7 @@ def run(protocol: protocol_api.ProtocolContext):
 
         p300_single.pick_up_tip()
         p300_single.mix(2, 2 * (pcr_sample_number + 4), pcr_mix_deck.wells()[i].bottom(z=1))
-        pcr_combination_wells = [find_combination(x, pcr_recipe_to_make) for x in name_i]
+        pcr_combination_wells = [find_combination(x, reaction_layout) for x in name_i]
         p300_single.distribute(reaction_volume-1,
                                pcr_mix_deck.wells()[i].bottom(z=1),
                                pcr_combination_wells,
@@ -145,7 +147,7 @@ def run(protocol: protocol_api.ProtocolContext):
 
     for part, combination_template in combinations_by_colony_template.items():
         template_well = find_template(part, pcr_deck_colony_template_maps_dict, colony_template_deck)
-        colony_combination_wells = [find_combination(x, pcr_recipe_to_make) for x in combination_template]
+        colony_combination_wells = [find_combination(x, reaction_layout) for x in combination_template]
         p10_single.pick_up_tip()
         p10_single.distribute(1,
                               template_well.bottom(z=1),
@@ -159,17 +161,9 @@ def run(protocol: protocol_api.ProtocolContext):
     # PCR steps
     tc_mod.close_lid()
     tc_mod.set_lid_temperature(105)
-    # denaturation
-    pre_denaturation_step = [{'temperature': 98, 'hold_time_seconds': 300}]
-    tc_mod.execute_profile(steps=pre_denaturation_step, repetitions=1, block_max_volume=reaction_volume)
-    # amplification cycles
-    j = 0
-    while j < pcr_cycles_number:
-        tc_mod.execute_profile(steps=pcr_cycles, repetitions=1, block_max_volume=reaction_volume)
-        j = j + 1
-    # further  extension step
-    extension_step = [{'temperature': 72, 'hold_time_seconds': 300}]
-    tc_mod.execute_profile(steps=extension_step, repetitions=1, block_max_volume=reaction_volume)
+    # denaturation, amplification cycles and further extension, one execute_profile call per segment
+    for steps, repetitions in thermocycler_programs['colony_pcr']:
+        tc_mod.execute_profile(steps=steps, repetitions=repetitions, block_max_volume=reaction_volume)
     tc_mod.set_block_temperature(25)
 
 
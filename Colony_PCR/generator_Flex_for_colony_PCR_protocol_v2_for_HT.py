@@ -3,16 +3,29 @@
 #2022-09-04
 
 import os
-import tkinter
-from tkinter import filedialog, messagebox
+import argparse
 import csv
 import json
 import datetime
 import time
 import sys
 
+# The run time estimator is shared by the cloning and colony PCR generators, at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run_time_estimator import estimate_run_time, load_protocol, print_run_time_report
+
+# Reaction plate formats: wells of a plate, the HT workflow fills a reaction plate and an addition plate
+PLATE_FORMATS = (96, 384)
+
+# Workflow of the 96-channel run that stamps the colony templates left by the HT workflow in stamping mode
+STAMPING_WORKFLOW_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'colony_PCR_workflow_Flex_96channel.py')
+
 def main():
 
+	# tkinter is only imported for the dialogs, so that the command line works without a display
+	import_tkinter()
+
 	# GETTING USER INPUT
 	pcr_deck_map_filename = ask_pcr_deck_map_filename()
 	colony_template_map_filename = ask_colony_template_map_filename()
@@ -20,13 +33,88 @@ def main():
 	template_folder_path_config = get_template_path_config()
 	output_folder_path_config = get_output_folder_path_config()
 
+	generate_protocol(pcr_deck_map_filename, colony_template_map_filename, pcr_recipe_filename, template_folder_path_config, output_folder_path_config)
+
+	# Display success message
+	messagebox.showinfo("Completed", "The protocol has been successfully generated!")
+
+def main_cli(argv=None):
+	parser = argparse.ArgumentParser(description='Generate high-throughput colony PCR protocols for the Flex.')
+	parser.add_argument('--deck-map', required=True, help='PCR deck map CSV (pcr_deck_map.csv)')
+	parser.add_argument('--template-map', required=True, help='colony template map CSV (colony_template_map.csv)')
+	parser.add_argument('--recipe', required=True, nargs='+', help='PCR recipe CSV, one protocol per file')
+	parser.add_argument('--template', required=True, help='workflow file (colony_PCR_workflow_Flex_v2_for_HT.py)')
+	parser.add_argument('--output', required=True, help='output folder, with one subfolder per protocol when several are generated')
+	parser.add_argument('--plate-format', type=int, choices=PLATE_FORMATS, default=96,
+	                    help='wells of the reaction plates, 384 for half-volume reactions (default: 96)')
+	args = parser.parse_args(argv)
+
+	# With several files, each protocol goes to a subfolder named after its file
+	job_names = [os.path.splitext(os.path.basename(filename))[0] for filename in args.recipe]
+	if len(set(job_names)) != len(job_names):
+		parser.error('the --recipe files must have different names')
+	for pcr_recipe_filename, job_name in zip(args.recipe, job_names):
+		output_folder_path = args.output if len(job_names) == 1 else os.path.join(args.output, job_name)
+		os.makedirs(output_folder_path, exist_ok=True)
+		protocol_path = generate_protocol(args.deck_map, args.template_map, pcr_recipe_filename, args.template, output_folder_path, args.plate_format)
+		print("Protocol generated:", protocol_path)
+
+def generate_protocol(pcr_deck_map_filename, colony_template_map_filename, pcr_recipe_filename, template_folder_path_config, output_folder_path_config, plate_format=96):
+	"""Generate the protocol and its output files from the input files, and return the protocol path."""
 	# Load in CSV files as a dict containing lists of lists.
 	pcr_deck_colony_template_maps_dict = pcr_deck_colony_template_maps(pcr_deck_map_filename, colony_template_map_filename)
 	pcr_recipe_to_make = generate_pcr_recipe(pcr_recipe_filename)
-	check_number_of_combinations(pcr_recipe_to_make)
+	template_string = read_template(template_folder_path_config)
+	return build_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path_config, plate_format)
+
+def build_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path_config, plate_format=96):
+	"""Generate the protocol from the parsed input files, and return the protocol path.
+
+	plate_format is the number of wells of the reaction plates, 96 or 384 (half-volume reactions)."""
+	check_number_of_combinations(pcr_recipe_to_make, plate_format)
 
 	# Create a protocol file.
-	create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_folder_path_config, output_folder_path_config)
+	protocol_path = create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path_config, plate_format)
+
+	# Master mixes to prepare, as grouped by the workflow.
+	print_master_mix_plan(protocol_path, pcr_recipe_to_make)
+
+	# Estimate the run time offline, without a robot.
+	print_run_time_report(estimate_run_time(protocol_path))
+
+	# In stamping mode, the stamped colony templates go to a second protocol for the 96-channel pipette.
+	protocol = load_protocol(protocol_path)
+	if protocol.get('stamping_mode'):
+		stamping_protocol_path = create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, read_template(STAMPING_WORKFLOW_PATH),
+		                                         output_folder_path_config, plate_format, 'colony_PCR_96channel_stamping_protocol_')
+		# The stamping protocol refuses colony volumes under the 96-channel minimum, and must stamp the volume the reactions were set up for
+		stamping_protocol = load_protocol(stamping_protocol_path)
+		if stamping_protocol['dna_volume'] != protocol['dna_volume']:
+			os.remove(stamping_protocol_path)
+			raise ValueError("The stamping protocol transfers {0} uL of colony, the HT protocol sets up the reactions for {1} uL".format(
+				stamping_protocol['dna_volume'], protocol['dna_volume']))
+		print("96-channel stamping protocol, to run after this one:", stamping_protocol_path)
+		print_run_time_report(estimate_run_time(stamping_protocol_path))
+	return protocol_path
+
+def print_master_mix_plan(protocol_path, pcr_recipe_to_make):
+	"""Print the master mixes the protocol prepares, grouped by the workflow itself: reactions and volume of each part."""
+	protocol = load_protocol(protocol_path)
+	if 'group_master_mixes' not in protocol:
+		return
+	master_mixes = protocol['group_master_mixes'](pcr_recipe_to_make)
+	print("Master mix plan: {0} master mixes for {1} reactions".format(len(master_mixes), len(pcr_recipe_to_make)))
+	for i, master_mix in enumerate(master_mixes):
+		if 'master_mix_volumes' in protocol:
+			parts = ['{0} {1} uL'.format(part, round(volume, 1)) for part, volume in zip(master_mix["parts"], protocol['master_mix_volumes'](master_mix))]
+		else:
+			parts = master_mix["parts"]
+		print(" {0}. {1} reactions: {2}".format(i + 1, len(master_mix["name"]), ', '.join(parts)))
+
+def import_tkinter():
+	global tkinter, filedialog, messagebox
+	import tkinter
+	from tkinter import filedialog, messagebox
 
     
 
@@ -89,30 +177,23 @@ def ask_pcr_recipe_filename():
 
 def pcr_deck_colony_template_maps(filename1, filename2):
 	pcr_deck_colony_template_maps = {}
-	pcr_deck_map = []
-	colony_template_map = []
-	with open(filename1, "r") as file:
-		for row in csv.reader(file, dialect='excel'):
-			if len(row) == 0:
-				continue
-			if row[0]:
-				if '\ufeff' in row[0]:
-					row[0] = str(row[0].replace(u'\ufeff',''))
-				pcr_deck_map.append(row)
-	pcr_deck_name = os.path.splitext(os.path.basename(filename1))[0]
-	pcr_deck_colony_template_maps[pcr_deck_name] = pcr_deck_map
+	for filename in (filename1, filename2):
+		map_name, plate_map = read_plate_map(filename)
+		pcr_deck_colony_template_maps[map_name] = plate_map
+	return pcr_deck_colony_template_maps
 
-	with open(filename2, "r") as file:
+def read_plate_map(filename):
+	plate_map = []
+	with open(filename, "r") as file:
 		for row in csv.reader(file, dialect='excel'):
 			if len(row) == 0:
 				continue
 			if row[0]:
 				if '\ufeff' in row[0]:
 					row[0] = str(row[0].replace(u'\ufeff',''))
-				colony_template_map.append(row)
-	colony_template_map_name = os.path.splitext(os.path.basename(filename2))[0]
-	pcr_deck_colony_template_maps[colony_template_map_name] = colony_template_map
-	return pcr_deck_colony_template_maps
+				plate_map.append(row)
+	map_name = os.path.splitext(os.path.basename(filename))[0]
+	return map_name, plate_map
 
 def generate_pcr_recipe(combinations_filename):
 	pcr_recipe_to_make = []
@@ -129,25 +210,32 @@ def generate_pcr_recipe(combinations_filename):
 											})
 	return pcr_recipe_to_make
 
-def check_number_of_combinations( combinations_to_make): 
+def check_number_of_combinations( combinations_to_make, plate_format=96): 
 	number_of_combinations = len(combinations_to_make)
+	if number_of_combinations > 2 * plate_format:
+		raise ValueError('Too many PCR reactions ({0}) requested. Max for the reaction and addition {1}-well plates is {2}.'.format(number_of_combinations, plate_format, 2 * plate_format))
 
 
-def create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, protocol_template_path, output_folder_path):
-	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
+def read_template(protocol_template_path):
+	# Get the contents of the workflow file, which contains the body of the protocol.
 	with open(protocol_template_path) as template_file:
-		template_string = template_file.read()
+		return template_file.read()
+
+def create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path, plate_format=96, protocol_name='colony_PCR_protocol_'):
 	folder_time = datetime.datetime.now().strftime("%Y_%m_%d")
-	with open(output_folder_path + '/' + 'colony_PCR_protocol_'+ folder_time + '.py', "w+") as protocol_file:
+	protocol_path = output_folder_path + '/' + protocol_name + folder_time + '.py'
+	with open(protocol_path, "w+") as protocol_file:
 		# Paste in plate maps at top of file.
 		protocol_file.write('pcr_deck_colony_template_maps_dict = ' + json.dumps(pcr_deck_colony_template_maps_dict) + '\n\n')
 		protocol_file.write('pcr_recipe_to_make = ' + json.dumps(pcr_recipe_to_make) + '\n\n')
+		protocol_file.write('reaction_plate_format = ' + str(plate_format) + '\n\n')
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	return protocol_path
 
-# Call main function
+# Call main function: the dialogs without arguments, the command line otherwise
 if __name__ == '__main__':
-	main()
-
-# Display success message
-messagebox.showinfo("Completed", "The protocol has been successfully generated!")
\ No newline at end of file
+	if len(sys.argv) > 1:
+		main_cli()
+	else:
+		main()
\ No newline at end of file
@@ -3,16 +3,25 @@
 #2024
 
 import os
-import tkinter
-from tkinter import filedialog, messagebox
+import argparse
 import csv
 import json
 import datetime
+import re
 import time
 import sys
 
+# The run time estimator and the thermocycler programs are shared by the cloning and colony PCR generators, at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run_time_estimator import load_protocol
+from thermocycler_profiles import colony_pcr_program, compile_programs, print_programs
+
 def main():
 
+	# tkinter is only imported for the dialogs, so that the command line works without a display
+	import_tkinter()
+
 	# GETTING USER INPUT
 	pcr_deck_map_filename = ask_pcr_deck_map_filename()
 	colony_template_map_filename = ask_colony_template_map_filename()
@@ -20,13 +29,91 @@ def main():
 	template_folder_path_config = get_template_path_config()
 	output_folder_path_config = get_output_folder_path_config()
 
+	generate_protocol(pcr_deck_map_filename, colony_template_map_filename, pcr_recipe_filename, template_folder_path_config, output_folder_path_config)
+
+	# Display success message
+	messagebox.showinfo("Completed", "The protocol has been successfully generated!")
+
+def main_cli(argv=None):
+	parser = argparse.ArgumentParser(description='Generate colony PCR protocols.')
+	parser.add_argument('--deck-map', required=True, help='PCR deck map CSV (pcr_deck_map.csv)')
+	parser.add_argument('--template-map', required=True, help='colony template map CSV (colony_template_map.csv)')
+	parser.add_argument('--recipe', required=True, nargs='+', help='PCR recipe CSV, one protocol per file')
+	parser.add_argument('--template', required=True, help='workflow file (colony_PCR_workflow_OT2.py or colony_PCR_workflow_Flex.py)')
+	parser.add_argument('--output', required=True, help='output folder, with one subfolder per protocol when several are generated')
+	parser.add_argument('--annealing-temperature', type=float, default=55, help='annealing temperature of the primers in C (default: 55)')
+	parser.add_argument('--amplicon-length', type=int, help='length of the amplicons in bp, which sets the extension time '
+	                                                         '(default: 200 s extension on the OT-2, 60 s on the Flex)')
+	parser.add_argument('--pcr-cycles', type=int, default=30, help='number of amplification cycles (default: 30)')
+	args = parser.parse_args(argv)
+
+	# With several files, each protocol goes to a subfolder named after its file
+	job_names = [os.path.splitext(os.path.basename(filename))[0] for filename in args.recipe]
+	if len(set(job_names)) != len(job_names):
+		parser.error('the --recipe files must have different names')
+	for pcr_recipe_filename, job_name in zip(args.recipe, job_names):
+		output_folder_path = args.output if len(job_names) == 1 else os.path.join(args.output, job_name)
+		os.makedirs(output_folder_path, exist_ok=True)
+		protocol_path = generate_protocol(args.deck_map, args.template_map, pcr_recipe_filename, args.template, output_folder_path,
+		                                  args.annealing_temperature, args.amplicon_length, args.pcr_cycles)
+		print("Protocol generated:", protocol_path)
+
+def generate_protocol(pcr_deck_map_filename, colony_template_map_filename, pcr_recipe_filename, template_folder_path_config, output_folder_path_config,
+                      annealing_temperature=55, amplicon_length=None, pcr_cycles=30):
+	"""Generate the protocol and its output files from the input files, and return the protocol path."""
 	# Load in CSV files as a dict containing lists of lists.
 	pcr_deck_colony_template_maps_dict = pcr_deck_colony_template_maps(pcr_deck_map_filename, colony_template_map_filename)
 	pcr_recipe_to_make = generate_pcr_recipe(pcr_recipe_filename)
+	template_string = read_template(template_folder_path_config)
+	return build_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path_config,
+	                      annealing_temperature, amplicon_length, pcr_cycles)
+
+def build_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path_config,
+                   annealing_temperature=55, amplicon_length=None, pcr_cycles=30):
+	"""Generate the protocol from the parsed input files, and return the protocol path.
+
+	The PCR program is built from the annealing temperature (C), the amplicon length (bp, None for the default extension
+	of the workflow's robot) and the number of cycles, and compiled into the fewest thermocycler calls.
+	The cycles keep the denaturation of the robot's workflow: 98 C for 15 s on the OT-2, 95 C for 30 s on the Flex."""
 	check_number_of_combinations(pcr_recipe_to_make)
+	robot_type = template_robot_type(template_string)
+	thermocycler_programs = compile_programs({'colony_pcr': colony_pcr_program(annealing_temperature, amplicon_length, pcr_cycles, robot_type)})
 
 	# Create a protocol file.
-	create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_folder_path_config, output_folder_path_config)
+	protocol_path = create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path_config, thermocycler_programs)
+	print_programs(thermocycler_programs)
+
+	# Master mixes to prepare, as grouped by the workflow.
+	print_master_mix_plan(protocol_path, pcr_recipe_to_make)
+	return protocol_path
+
+def template_robot_type(template_string):
+	"""Return the robot the workflow is written for, 'Flex' when its requirements say so, else 'OT-2'."""
+	if re.search(r'[\'"]robotType[\'"]\s*:\s*[\'"]Flex[\'"]', template_string):
+		return 'Flex'
+	return 'OT-2'
+
+def print_master_mix_plan(protocol_path, pcr_recipe_to_make):
+	"""Print the master mixes the protocol prepares, grouped by the workflow itself: reactions and volume of each part."""
+	protocol = load_protocol(protocol_path)
+	if 'group_master_mixes' not in protocol:
+		return
+	master_mixes = protocol['group_master_mixes'](pcr_recipe_to_make)
+	print("Master mix plan: {0} master mixes for {1} reactions".format(len(master_mixes), len(pcr_recipe_to_make)))
+	if 'split_master_mixes' in protocol:
+		# Master mixes larger than a tube are split, one line per tube
+		master_mixes = protocol['split_master_mixes'](master_mixes)
+	for i, master_mix in enumerate(master_mixes):
+		if 'master_mix_volumes' in protocol:
+			parts = ['{0} {1} uL'.format(part, round(volume, 1)) for part, volume in zip(master_mix["parts"], protocol['master_mix_volumes'](master_mix))]
+		else:
+			parts = master_mix["parts"]
+		print(" {0}. {1} reactions: {2}".format(i + 1, len(master_mix["name"]), ', '.join(parts)))
+
+def import_tkinter():
+	global tkinter, filedialog, messagebox
+	import tkinter
+	from tkinter import filedialog, messagebox
 
     
 
@@ -89,30 +176,23 @@ def ask_pcr_recipe_filename():
 
 def pcr_deck_colony_template_maps(filename1, filename2):
 	pcr_deck_colony_template_maps = {}
-	pcr_deck_map = []
-	colony_template_map = []
-	with open(filename1, "r") as file:
-		for row in csv.reader(file, dialect='excel'):
-			if len(row) == 0:
-				continue
-			if row[0]:
-				if '\ufeff' in row[0]:
-					row[0] = str(row[0].replace(u'\ufeff',''))
-				pcr_deck_map.append(row)
-	pcr_deck_name = os.path.splitext(os.path.basename(filename1))[0]
-	pcr_deck_colony_template_maps[pcr_deck_name] = pcr_deck_map
+	for filename in (filename1, filename2):
+		map_name, plate_map = read_plate_map(filename)
+		pcr_deck_colony_template_maps[map_name] = plate_map
+	return pcr_deck_colony_template_maps
 
-	with open(filename2, "r") as file:
+def read_plate_map(filename):
+	plate_map = []
+	with open(filename, "r") as file:
 		for row in csv.reader(file, dialect='excel'):
 			if len(row) == 0:
 				continue
 			if row[0]:
 				if '\ufeff' in row[0]:
 					row[0] = str(row[0].replace(u'\ufeff',''))
-				colony_template_map.append(row)
-	colony_template_map_name = os.path.splitext(os.path.basename(filename2))[0]
-	pcr_deck_colony_template_maps[colony_template_map_name] = colony_template_map
-	return pcr_deck_colony_template_maps
+				plate_map.append(row)
+	map_name = os.path.splitext(os.path.basename(filename))[0]
+	return map_name, plate_map
 
 def generate_pcr_recipe(combinations_filename):
 	pcr_recipe_to_make = []
@@ -133,21 +213,26 @@ def check_number_of_combinations( combinations_to_make):
 	number_of_combinations = len(combinations_to_make)
 
 
-def create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, protocol_template_path, output_folder_path):
-	# Get the contents of colony_pick_template.py, which contains the body of the protocol.
+def read_template(protocol_template_path):
+	# Get the contents of the workflow file, which contains the body of the protocol.
 	with open(protocol_template_path) as template_file:
-		template_string = template_file.read()
+		return template_file.read()
+
+def create_protocol(pcr_deck_colony_template_maps_dict, pcr_recipe_to_make, template_string, output_folder_path, thermocycler_programs):
 	folder_time = datetime.datetime.now().strftime("%Y_%m_%d")
-	with open(output_folder_path + '/' + 'colony_PCR_protocol_'+ folder_time + '.py', "w+") as protocol_file:
+	protocol_path = output_folder_path + '/' + 'colony_PCR_protocol_'+ folder_time + '.py'
+	with open(protocol_path, "w+") as protocol_file:
 		# Paste in plate maps at top of file.
 		protocol_file.write('pcr_deck_colony_template_maps_dict = ' + json.dumps(pcr_deck_colony_template_maps_dict) + '\n\n')
 		protocol_file.write('pcr_recipe_to_make = ' + json.dumps(pcr_recipe_to_make) + '\n\n')
+		protocol_file.write('thermocycler_programs = ' + json.dumps(thermocycler_programs) + '\n\n')
 		# Paste the rest of the protocol.
 		protocol_file.write(template_string)
+	return protocol_path
 
-# Call main function
+# Call main function: the dialogs without arguments, the command line otherwise
 if __name__ == '__main__':
-	main()
-
-# Display success message
-messagebox.showinfo("Completed", "The protocol has been successfully generated!")
+	if len(sys.argv) > 1:
+		main_cli()
+	else:
+		main()
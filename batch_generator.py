@@ -0,0 +1,189 @@
+# Batch generation of cloning and colony PCR protocols from a manifest
+# Each manifest row (CSV) or entry (YAML) is one job: protocol, robot, input maps, recipe and optional workflow file.
+# Shared maps and workflow files are parsed once, then the protocols are generated in parallel,
+# each one checked by running it offline, and an index of the outputs is written next to them.
+
+import argparse
+import concurrent.futures
+import csv
+import importlib
+import os
+import sys
+
+BASE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_FOLDER, 'Colony_PCR'))
+sys.path.insert(0, os.path.join(BASE_FOLDER, 'Cloning'))
+
+from run_time_estimator import estimate_run_time
+
+
+# Generator module and default workflow file of each (protocol, robot)
+GENERATORS = {
+	('cloning', 'OT-2'): ('generator_OT2_for_cloning_protocol', 'Cloning/cloning_workflow_OT2.py'),
+	('cloning', 'Flex'): ('generator_Flex_for_cloning_protocol', 'Cloning/cloning_workflow_Flex.py'),
+	('cloning', 'Flex HT'): ('generator_Flex_for_cloning_protocol_v2_for_HT', 'Cloning/cloning_workflow_Flex_v2_for_HT.py'),
+	('colony_pcr', 'OT-2'): ('generator_for_colony_PCR_protocol', 'Colony_PCR/colony_PCR_workflow_OT2.py'),
+	('colony_pcr', 'Flex'): ('generator_for_colony_PCR_protocol', 'Colony_PCR/colony_PCR_workflow_Flex.py'),
+	('colony_pcr', 'Flex HT'): ('generator_Flex_for_colony_PCR_protocol_v2_for_HT', 'Colony_PCR/colony_PCR_workflow_Flex_v2_for_HT.py'),
+}
+
+# Manifest fields of the two input maps and of the recipe for each protocol
+INPUT_FIELDS = {
+	'cloning': ('fixed_map', 'custom_map', 'combinations'),
+	'colony_pcr': ('deck_map', 'template_map', 'recipe'),
+}
+
+INDEX_FIELDS = ['name', 'protocol', 'robot', 'status', 'protocol_path', 'estimated_minutes', 'operator_pauses', 'message']
+
+
+def read_manifest(manifest_filename):
+	"""Return the list of jobs of a CSV or YAML manifest, with paths relative to the manifest folder made absolute."""
+	if os.path.splitext(manifest_filename)[1].lower() in ('.yaml', '.yml'):
+		try:
+			import yaml
+		except ImportError:
+			raise ValueError('PyYAML is needed to read a YAML manifest ("pip install pyyaml"), or use a CSV manifest.')
+		with open(manifest_filename, "r") as f:
+			manifest = yaml.safe_load(f) or []
+		jobs = manifest.get('jobs', []) if isinstance(manifest, dict) else manifest
+	else:
+		with open(manifest_filename, "r", encoding='utf-8-sig') as f:
+			jobs = [row for row in csv.DictReader(f) if any(row.values())]
+
+	manifest_folder = os.path.dirname(os.path.abspath(manifest_filename))
+	names = set()
+	for i, job in enumerate(jobs):
+		if not job.get('name'):
+			job['name'] = 'job_{0}'.format(i + 1)
+		if job['name'] in names:
+			raise ValueError('Job name "{0}" is used twice in {1}'.format(job['name'], manifest_filename))
+		names.add(job['name'])
+		for field in INPUT_FIELDS['cloning'] + INPUT_FIELDS['colony_pcr'] + ('template',):
+			if job.get(field):
+				job[field] = os.path.join(manifest_folder, job[field])
+	return jobs
+
+def prepare_jobs(jobs, output_folder_path):
+	"""Parse the inputs of every job, each shared map or workflow file only once, and return the jobs ready to build.
+
+	A job whose inputs cannot be read gets an 'error' instead of its parsed inputs."""
+	plate_maps = {}
+	templates = {}
+	prepared_jobs = []
+	for job in jobs:
+		prepared_job = {'name': job['name'], 'protocol': job.get('protocol'), 'robot': job.get('robot'),
+		                'output': os.path.join(output_folder_path, job['name'])}
+		try:
+			if (job.get('protocol'), job.get('robot')) not in GENERATORS:
+				raise ValueError('unknown protocol/robot "{0}"/"{1}", choose among {2}'.format(
+					job.get('protocol'), job.get('robot'), ', '.join('/'.join(key) for key in GENERATORS)))
+			generator_name, default_template = GENERATORS[(job['protocol'], job['robot'])]
+			generator = importlib.import_module(generator_name)
+			map_fields = INPUT_FIELDS[job['protocol']][:2]
+			recipe_field = INPUT_FIELDS[job['protocol']][2]
+			for field in map_fields + (recipe_field,):
+				if not job.get(field):
+					raise ValueError('missing "{0}"'.format(field))
+
+			maps = {}
+			for field in map_fields:
+				# The cloning generators do not read the maps with the same delimiter, hence a cache per generator
+				key = (generator_name, job[field])
+				if key not in plate_maps:
+					plate_maps[key] = generator.read_plate_map(job[field])
+				map_name, plate_map = plate_maps[key]
+				maps[map_name] = plate_map
+
+			template_path = job.get('template') or os.path.join(BASE_FOLDER, default_template)
+			if template_path not in templates:
+				templates[template_path] = generator.read_template(template_path)
+
+			if job['protocol'] == 'cloning':
+				recipe = generator.generate_combinations(job[recipe_field])
+			else:
+				recipe = generator.generate_pcr_recipe(job[recipe_field])
+			prepared_job.update({'generator': generator_name, 'maps': maps, 'recipe': recipe,
+			                     'template_string': templates[template_path]})
+
+			# 384-well reaction plates are only targeted by the Flex HT generators, reaction profiles and emissions by the HT cloning one
+			options = {}
+			if job.get('plate_format'):
+				if job['robot'] != 'Flex HT':
+					raise ValueError('plate_format is only available for the Flex HT robot')
+				options['plate_format'] = int(job['plate_format'])
+			if job.get('reaction_profile'):
+				if (job['protocol'], job['robot']) != ('cloning', 'Flex HT'):
+					raise ValueError('reaction_profile is only available for Flex HT cloning')
+				options['reaction_profile'] = job['reaction_profile']
+			if job.get('emission'):
+				if (job['protocol'], job['robot']) != ('cloning', 'Flex HT'):
+					raise ValueError('emission is only available for Flex HT cloning')
+				options['emission'] = job['emission']
+			# Workflow modes (WORKFLOW_MODES of the HT cloning generator), under the same names as in the workflow file
+			cloning_ht_generator = importlib.import_module(GENERATORS[('cloning', 'Flex HT')][0])
+			for field, convert in cloning_ht_generator.WORKFLOW_MODES.items():
+				if job.get(field) not in (None, ''):
+					if (job['protocol'], job['robot']) != ('cloning', 'Flex HT'):
+						raise ValueError('{0} is only available for Flex HT cloning'.format(field))
+					options.setdefault('workflow_modes', {})[field] = convert(job[field])
+			# The PCR program is compiled by the OT-2 and Flex colony PCR generator, whose workflows run the thermocycler
+			for field, convert in (('annealing_temperature', float), ('amplicon_length', int), ('pcr_cycles', int)):
+				if job.get(field):
+					if (job['protocol'], job['robot']) not in (('colony_pcr', 'OT-2'), ('colony_pcr', 'Flex')):
+						raise ValueError('{0} is only available for OT-2 and Flex colony PCR'.format(field))
+					options[field] = convert(job[field])
+			prepared_job['options'] = options
+		except (OSError, ValueError) as error:
+			prepared_job['error'] = str(error)
+		prepared_jobs.append(prepared_job)
+	return prepared_jobs
+
+def build_job(job):
+	"""Build the protocol of a prepared job, run it offline and return its line of the index."""
+	result = {'name': job['name'], 'protocol': job['protocol'], 'robot': job['robot'], 'status': 'failed',
+	          'protocol_path': '', 'estimated_minutes': '', 'operator_pauses': '', 'message': job.get('error', '')}
+	if 'error' in job:
+		return result
+	try:
+		os.makedirs(job['output'], exist_ok=True)
+		generator = importlib.import_module(job['generator'])
+		result['protocol_path'] = generator.build_protocol(job['maps'], job['recipe'], job['template_string'], job['output'], **job['options'])
+		report = estimate_run_time(result['protocol_path'])
+	except Exception as error:
+		result['message'] = '{0}: {1}'.format(type(error).__name__, error)
+		return result
+	result.update({'status': 'ok', 'estimated_minutes': round(report['total_seconds'] / 60),
+	               'operator_pauses': len(report['pauses'])})
+	return result
+
+def generate_batch(manifest_filename, output_folder_path, workers=None):
+	"""Generate every job of the manifest and write batch_index.csv in the output folder. Return the index lines."""
+	jobs = prepare_jobs(read_manifest(manifest_filename), output_folder_path)
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+		results = list(executor.map(build_job, jobs))
+
+	os.makedirs(output_folder_path, exist_ok=True)
+	with open(os.path.join(output_folder_path, "batch_index.csv"), 'w+', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=INDEX_FIELDS)
+		writer.writeheader()
+		writer.writerows(results)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate the cloning and colony PCR protocols of a CSV or YAML manifest.')
+	parser.add_argument('manifest', help='manifest with the fields name, protocol (cloning or colony_pcr), robot (OT-2, Flex or Flex HT), '
+	                                     'fixed_map, custom_map and combinations for cloning, deck_map, template_map and recipe for colony PCR, '
+	                                     'an optional template (workflow file) and, for Flex HT, an optional plate_format (96 or 384) '
+	                                     'and reaction_profile, emission and the workflow modes (cloning only, e.g. multichannel_mode, '
+	                                     'see WORKFLOW_MODES), and for OT-2 and Flex colony PCR, optional '
+	                                     'annealing_temperature, amplicon_length and pcr_cycles')
+	parser.add_argument('--output', required=True, help='output folder, with one subfolder per job')
+	parser.add_argument('--workers', type=int, help='number of parallel processes (default: number of CPUs)')
+	args = parser.parse_args()
+
+	results = generate_batch(args.manifest, args.output, args.workers)
+	for result in results:
+		print("{0}: {1} {2}".format(result['name'], result['status'], result['protocol_path'] if result['status'] == 'ok' else result['message']))
+	print("{0}/{1} protocols generated, index in {2}".format(
+		sum(result['status'] == 'ok' for result in results), len(results), os.path.join(args.output, "batch_index.csv")))
@@ -0,0 +1,491 @@
+# Offline run-time estimator for the generated protocols
+# Runs the protocol run() against a recording stand-in of the Opentrons ProtocolContext,
+# so that no robot, no Opentrons server and no opentrons package are needed.
+# The run is split into steps at every operator pause, and each operation is timed with a per-robot model.
+# The tips used by each pipette and the volume drawn from each source well are recorded along the way.
+
+import argparse
+import collections
+import math
+import re
+import sys
+import types
+
+from thermocycler_profiles import profile_duration
+
+
+# Approximate durations (s) of each operation, travel to the location included
+TIMING_MODELS = {
+	'Flex': {
+		'pick_up_tip': 9, 'drop_tip': 7, 'aspirate': 5, 'dispense': 4, 'blow_out': 2, 'touch_tip': 3,
+		'mix_cycle': 2, 'air_gap': 2, 'move': 3, 'configure': 1, 'move_labware': 25,
+		'set_temperature': 300, 'lid': 20, 'thermocycler_step': 15, 'module': 2,
+	},
+	'OT-2': {
+		'pick_up_tip': 11, 'drop_tip': 8, 'aspirate': 6, 'dispense': 5, 'blow_out': 3, 'touch_tip': 4,
+		'mix_cycle': 3, 'air_gap': 3, 'move': 4, 'configure': 1, 'move_labware': 0,
+		'set_temperature': 300, 'lid': 25, 'thermocycler_step': 20, 'module': 2,
+	},
+}
+
+# Number of (rows, columns) of a labware from the number of wells in its load name
+LABWARE_FORMATS = {1: (1, 1), 6: (2, 3), 12: (3, 4), 15: (3, 5), 24: (4, 6), 48: (6, 8), 96: (8, 12), 384: (16, 24)}
+
+ROWS = 'ABCDEFGHIJKLMNOP'
+
+
+class Recorder:
+	"""Collect the timed operations of a protocol run, split into steps at each operator pause."""
+
+	def __init__(self, robot_type):
+		self.robot_type = robot_type
+		self.timing = TIMING_MODELS[robot_type]
+		self.steps = [{'name': 'Start', 'seconds': 0, 'operations': collections.Counter()}]
+		self.pauses = []
+		self.tips = collections.Counter()
+		self.tip_pickups = collections.defaultdict(collections.Counter)
+		self.volumes = collections.Counter()
+		self.wells = {}
+		self.labware = collections.Counter()
+
+	def elapsed(self):
+		return sum(step['seconds'] for step in self.steps)
+
+	def record(self, operation, count=1, seconds=None):
+		if seconds is None:
+			seconds = self.timing[operation] * count
+		self.steps[-1]['operations'][operation] += count
+		self.steps[-1]['seconds'] += seconds
+
+	def pause(self, msg=None):
+		lines = [line.strip().rstrip(':') for line in (msg or 'Pause').splitlines() if line.strip()]
+		self.pauses.append(lines[0] if lines else 'Pause')
+		self.steps.append({'name': self.pauses[-1], 'seconds': 0, 'operations': collections.Counter()})
+
+	def draw(self, well, volume):
+		self.volumes[well.display_name] += volume
+		self.wells[well.display_name] = (well.liquid, well.well_name, well.parent.load_name)
+
+
+class Stub:
+	"""Accept any attribute, call or index, for the parts of the API that are not timed."""
+
+	def __getattr__(self, name):
+		return self
+
+	def __call__(self, *args, **kwargs):
+		return self
+
+	def __getitem__(self, key):
+		return self
+
+	def __iter__(self):
+		return iter([])
+
+
+class Location(Stub):
+
+	def __init__(self, well=None, point=None):
+		self.well = well
+		self.point = point
+
+	def move(self, point):
+		return Location(self.well, point)
+
+
+class Well(Stub):
+
+	def __init__(self, parent, well_name):
+		self.parent = parent
+		self.well_name = well_name
+		self.display_name = well_name + ' of ' + parent.name
+		self.liquid = ''
+
+	def load_liquid(self, liquid, volume):
+		self.liquid = liquid.name
+
+	def bottom(self, z=0):
+		return Location(self)
+
+	def top(self, z=0):
+		return Location(self)
+
+	def center(self):
+		return Location(self)
+
+	def __repr__(self):
+		return self.display_name
+
+
+class Labware(Stub):
+
+	def __init__(self, recorder, load_name, label=None):
+		self.recorder = recorder
+		self.load_name = load_name
+		self.name = label or load_name
+		match = re.search(r'_(\d+)_', '_' + load_name + '_')
+		nb_rows, nb_columns = LABWARE_FORMATS.get(int(match.group(1)) if match else 1, (1, 1))
+		self._columns = [[Well(self, ROWS[i] + str(j + 1)) for i in range(nb_rows)] for j in range(nb_columns)]
+
+	def load_labware(self, load_name, label=None, *args, **kwargs):
+		return Labware(self.recorder, load_name, label)
+
+	def load_adapter(self, load_name, *args, **kwargs):
+		return Labware(self.recorder, load_name)
+
+	def wells(self, *args):
+		return [well for column in self._columns for well in column]
+
+	def columns(self, *args):
+		return [list(column) for column in self._columns]
+
+	def rows(self, *args):
+		return [list(row) for row in zip(*self._columns)]
+
+	def wells_by_name(self):
+		return {well.well_name: well for well in self.wells()}
+
+	def columns_by_name(self):
+		return {column[0].well_name[1:]: list(column) for column in self._columns}
+
+	def rows_by_name(self):
+		return {row[0].well_name[0]: row for row in self.rows()}
+
+	def __getitem__(self, well_name):
+		return self.wells_by_name()[well_name]
+
+	def __repr__(self):
+		return self.name
+
+
+class Module(Labware):
+
+	def __init__(self, recorder, load_name):
+		super().__init__(recorder, load_name)
+		self.temperature = None
+		self.ramp_start = None
+
+	def set_temperature(self, celsius=None, *args, **kwargs):
+		# Only a change of temperature takes time, keeping the same temperature is immediate
+		if celsius != self.temperature:
+			self.recorder.record('set_temperature')
+		self.temperature = celsius
+		self.ramp_start = None
+
+	def start_set_temperature(self, celsius=None, *args, **kwargs):
+		# The ramp runs while the protocol goes on, await_temperature only waits for what is left of it
+		if celsius != self.temperature:
+			self.ramp_start = (len(self.recorder.pauses), self.recorder.elapsed())
+		self.temperature = celsius
+		self.recorder.record('module')
+
+	def await_temperature(self, celsius=None, *args, **kwargs):
+		# A ramp started before an operator pause is taken as over once the operator resumes the run
+		if self.ramp_start:
+			nb_pauses, started = self.ramp_start
+			if nb_pauses == len(self.recorder.pauses):
+				left = self.recorder.timing['set_temperature'] - (self.recorder.elapsed() - started)
+				self.recorder.record('set_temperature', seconds=max(0, left))
+		self.ramp_start = None
+
+	def set_block_temperature(self, temperature=None, hold_time_seconds=0, hold_time_minutes=0, *args, **kwargs):
+		self.set_temperature(temperature)
+		self.recorder.record('thermocycler_step', seconds=(hold_time_seconds or 0) + 60 * (hold_time_minutes or 0))
+
+	def set_lid_temperature(self, temperature=None, *args, **kwargs):
+		self.recorder.record('module')
+
+	def execute_profile(self, steps=(), repetitions=1, *args, **kwargs):
+		# Holds and block ramps, as estimated for the thermocycler programs of the generators
+		self.recorder.record('thermocycler_step', count=len(steps) * repetitions,
+		                     seconds=profile_duration(steps, repetitions, self.temperature))
+		self.temperature = steps[-1]['temperature']
+
+	def open_lid(self, *args, **kwargs):
+		self.recorder.record('lid')
+
+	def close_lid(self, *args, **kwargs):
+		self.recorder.record('lid')
+
+	def deactivate(self, *args, **kwargs):
+		self.temperature = None
+		self.ramp_start = None
+		self.recorder.record('module')
+
+	def deactivate_block(self, *args, **kwargs):
+		self.deactivate()
+
+	def deactivate_lid(self, *args, **kwargs):
+		self.recorder.record('module')
+
+
+class Pipette(Stub):
+
+	def __init__(self, recorder, instrument_name):
+		self.recorder = recorder
+		self.name = instrument_name
+		# Maximum volume from the instrument name, e.g. 'flex_8channel_50' or 'p300_single_gen2'
+		self.max_volume = int(re.search(r'(\d+)(?=_|$)', instrument_name).group(1))
+		self.working_volume = self.max_volume
+		self.nb_channels = 96 if '96channel' in instrument_name else 8 if '8channel' in instrument_name or 'multi' in instrument_name else 1
+		self.active_channels = self.nb_channels
+		self.nozzle_start = 'A1'
+
+	def configure_for_volume(self, volume):
+		# Flex 50 uL pipettes switch to the low-volume mode (30 uL max) under 5 uL
+		self.working_volume = 30 if self.max_volume == 50 and volume < 5 else self.max_volume
+		self.recorder.record('configure')
+
+	def configure_nozzle_layout(self, style=None, start=None, end=None, *args, **kwargs):
+		if style in ('SINGLE', 'COLUMN', 'ROW'):
+			self.active_channels = {'SINGLE': 1, 'COLUMN': 8, 'ROW': 12}[style]
+		elif style == 'PARTIAL_COLUMN' and start and end:
+			self.active_channels = abs(ROWS.index(end[0]) - ROWS.index(start[0])) + 1
+		else:
+			self.active_channels = self.nb_channels
+		self.nozzle_start = start or 'A1'
+		self.recorder.record('configure')
+
+	def pick_up_tip(self, *args, **kwargs):
+		self.recorder.tips[self.name] += self.active_channels
+		self.recorder.tip_pickups[self.name][self.active_channels] += 1
+		self.recorder.record('pick_up_tip')
+
+	def drop_tip(self, *args, **kwargs):
+		self.recorder.record('drop_tip')
+
+	def return_tip(self, *args, **kwargs):
+		self.recorder.record('drop_tip')
+
+	def aspirate(self, volume=None, location=None, *args, **kwargs):
+		self._draw(location, volume or 0)
+		self.recorder.record('aspirate')
+		return self
+
+	def dispense(self, *args, **kwargs):
+		self.recorder.record('dispense')
+		return self
+
+	def blow_out(self, *args, **kwargs):
+		self.recorder.record('blow_out')
+		return self
+
+	def touch_tip(self, *args, **kwargs):
+		self.recorder.record('touch_tip')
+		return self
+
+	def air_gap(self, *args, **kwargs):
+		self.recorder.record('air_gap')
+		return self
+
+	def mix(self, repetitions=1, *args, **kwargs):
+		self.recorder.record('move')
+		self.recorder.record('mix_cycle', count=repetitions)
+		return self
+
+	def move_to(self, *args, **kwargs):
+		self.recorder.record('move')
+		return self
+
+	def transfer(self, volume, source, dest, new_tip='once', mix_before=None, mix_after=None, blow_out=False, touch_tip=False, **kwargs):
+		sources = source if isinstance(source, list) else [source]
+		dests = dest if isinstance(dest, list) else [dest]
+		volumes = volume if isinstance(volume, list) else [volume]
+		nb_pairs = max(len(sources), len(dests))
+		nb_aspirations = sum(math.ceil(volumes[i % len(volumes)] / self.working_volume) for i in range(nb_pairs))
+		for i in range(nb_pairs):
+			self._draw(sources[i % len(sources)], volumes[i % len(volumes)])
+		self._record_tips(new_tip, nb_pairs)
+		self.recorder.record('aspirate', count=nb_aspirations)
+		self.recorder.record('dispense', count=nb_aspirations)
+		for mix in (mix_before, mix_after):
+			if mix:
+				self.recorder.record('mix_cycle', count=mix[0] * nb_aspirations)
+		if blow_out:
+			self.recorder.record('blow_out', count=nb_aspirations)
+		if touch_tip:
+			self.recorder.record('touch_tip', count=nb_aspirations)
+		return self
+
+	def distribute(self, volume, source, dest, new_tip='once', disposal_volume=None, **kwargs):
+		dests = dest if isinstance(dest, list) else [dest]
+		disposal_volume = self.working_volume * 0.1 if disposal_volume is None else disposal_volume
+		volume = max(volume) if isinstance(volume, list) else volume
+		nb_per_aspiration = max(1, int((self.working_volume - disposal_volume) // volume))
+		nb_aspirations = math.ceil(len(dests) / nb_per_aspiration)
+		self._draw(source, volume * len(dests) + disposal_volume * nb_aspirations)
+		# The API falls back from new_tip='always' to 'once' for distribute and consolidate
+		self._record_tips(new_tip, 1)
+		self.recorder.record('aspirate', count=nb_aspirations)
+		self.recorder.record('dispense', count=len(dests))
+		if disposal_volume:
+			self.recorder.record('blow_out', count=nb_aspirations)
+		return self
+
+	def consolidate(self, volume, source, dest, new_tip='once', **kwargs):
+		sources = source if isinstance(source, list) else [source]
+		volume = max(volume) if isinstance(volume, list) else volume
+		nb_per_dispense = max(1, int(self.working_volume // volume))
+		nb_dispenses = math.ceil(len(sources) / nb_per_dispense)
+		for well in sources:
+			self._draw(well, volume)
+		self._record_tips(new_tip, 1)
+		self.recorder.record('aspirate', count=len(sources))
+		self.recorder.record('dispense', count=nb_dispenses)
+		return self
+
+	def _draw(self, source, volume):
+		# Each active nozzle draws the volume from its own well: the whole plate or row of a 96-channel pipette,
+		# else the wells of the column of the primary nozzle
+		well = source.well if isinstance(source, Location) else source
+		if not isinstance(well, Well):
+			return
+		column = well.parent.columns_by_name()[well.well_name[1:]]
+		i = column.index(well)
+		if self.active_channels == 96:
+			wells = well.parent.wells()
+		elif self.active_channels == 12:
+			wells = well.parent.rows_by_name()[well.well_name[0]]
+		elif self.nozzle_start.startswith('H'):
+			wells = column[max(0, i - self.active_channels + 1):i + 1]
+		else:
+			wells = column[i:i + self.active_channels]
+		for nozzle_well in wells:
+			self.recorder.draw(nozzle_well, volume)
+
+	def _record_tips(self, new_tip, nb_transfers):
+		nb_tips = {'always': nb_transfers, 'once': 1}.get(new_tip, 0)
+		self.recorder.tips[self.name] += nb_tips * self.active_channels
+		self.recorder.tip_pickups[self.name][self.active_channels] += nb_tips
+		self.recorder.record('pick_up_tip', count=nb_tips)
+		self.recorder.record('drop_tip', count=nb_tips)
+
+
+class ProtocolContext(Stub):
+
+	def __init__(self, recorder):
+		self.recorder = recorder
+
+	def load_labware(self, load_name, location=None, label=None, *args, **kwargs):
+		self.recorder.labware[label or load_name] += 1
+		return Labware(self.recorder, load_name, label)
+
+	def load_adapter(self, load_name, *args, **kwargs):
+		return Labware(self.recorder, load_name)
+
+	def load_module(self, module_name, *args, **kwargs):
+		return Module(self.recorder, module_name)
+
+	def load_instrument(self, instrument_name, *args, **kwargs):
+		return Pipette(self.recorder, instrument_name)
+
+	def move_labware(self, labware=None, new_location=None, use_gripper=False, *args, **kwargs):
+		# Without the gripper, the robot waits for the operator to move the labware
+		if use_gripper:
+			self.recorder.record('move_labware')
+		else:
+			self.recorder.pause('Move labware manually')
+
+	def pause(self, msg=None):
+		self.recorder.pause(msg)
+
+	def delay(self, seconds=0, minutes=0, *args, **kwargs):
+		self.recorder.record('module', seconds=seconds + 60 * minutes)
+
+	def comment(self, msg=None):
+		pass
+
+	def define_liquid(self, name, *args, **kwargs):
+		return types.SimpleNamespace(name=name)
+
+	def is_simulating(self):
+		return False
+
+
+def stand_in_opentrons():
+	"""Return the stand-in opentrons, opentrons.protocol_api and opentrons.types modules."""
+	opentrons = types.ModuleType('opentrons')
+	protocol_api = types.ModuleType('opentrons.protocol_api')
+	protocol_api.ProtocolContext = ProtocolContext
+	for name in ('ALL', 'SINGLE', 'COLUMN', 'ROW', 'PARTIAL_COLUMN', 'OFF_DECK'):
+		setattr(protocol_api, name, name)
+	opentrons_types = types.ModuleType('opentrons.types')
+	opentrons_types.Point = collections.namedtuple('Point', ['x', 'y', 'z'], defaults=[0, 0, 0])
+	opentrons_types.Location = Location
+	opentrons_types.Mount = Stub()
+	opentrons.protocol_api = protocol_api
+	opentrons.types = opentrons_types
+	return {'opentrons': opentrons, 'opentrons.protocol_api': protocol_api, 'opentrons.types': opentrons_types}
+
+
+def load_protocol(protocol_path):
+	"""Execute the module level of a generated protocol against the stand-in opentrons and return its namespace,
+	so that its settings and functions can be used without the opentrons package."""
+	with open(protocol_path, encoding='utf-8') as protocol_file:
+		protocol_string = protocol_file.read()
+
+	stand_in_modules = stand_in_opentrons()
+	saved_modules = {name: sys.modules.get(name) for name in stand_in_modules}
+	sys.modules.update(stand_in_modules)
+	try:
+		namespace = {'__name__': 'protocol'}
+		exec(compile(protocol_string, protocol_path, 'exec'), namespace)
+	finally:
+		for name, module in saved_modules.items():
+			if module is None:
+				sys.modules.pop(name, None)
+			else:
+				sys.modules[name] = module
+	return namespace
+
+def estimate_run_time(protocol_path, robot_type=None):
+	"""Run the protocol offline and return the timing report: robot type, steps, operator pauses, total seconds,
+	tips and tip pickups (by number of nozzles) per pipette, volume (uL) drawn from each source well,
+	the (liquid, well name, labware load name) of these wells, the number of labware loaded under each label
+	(or load name) and the module-level settings of the protocol.
+
+	The robot type is read from the protocol requirements unless robot_type ('Flex' or 'OT-2') is given."""
+	namespace = load_protocol(protocol_path)
+	if robot_type is None:
+		robot_type = namespace.get('requirements', {}).get('robotType', 'OT-2')
+	if robot_type not in TIMING_MODELS:
+		raise ValueError('Unknown robot type "{0}", choose one of {1}'.format(robot_type, ', '.join(TIMING_MODELS)))
+	recorder = Recorder(robot_type)
+	namespace['run'](ProtocolContext(recorder))
+
+	return {
+		'robot_type': robot_type,
+		'steps': recorder.steps,
+		'pauses': recorder.pauses,
+		'total_seconds': sum(step['seconds'] for step in recorder.steps),
+		'tips': dict(recorder.tips),
+		'tip_pickups': {name: dict(pickups) for name, pickups in recorder.tip_pickups.items()},
+		'volumes': {name: round(volume, 1) for name, volume in recorder.volumes.items()},
+		'wells': recorder.wells,
+		'labware': dict(recorder.labware),
+		'settings': {name: value for name, value in namespace.items()
+		             if not name.startswith('_') and isinstance(value, (bool, int, float, str))}
+	}
+
+def format_duration(seconds):
+	"""Return a duration as '1 h 05 min' or '12 min'."""
+	minutes = math.ceil(seconds / 60)
+	if minutes < 60:
+		return '{0} min'.format(minutes)
+	return '{0} h {1:02d} min'.format(minutes // 60, minutes % 60)
+
+def print_run_time_report(report):
+	print("Estimated run time on {0}: {1} of robot time, {2} operator pauses".format(
+		report['robot_type'], format_duration(report['total_seconds']), len(report['pauses'])))
+	for i, step in enumerate(report['steps']):
+		operations = ', '.join('{0} {1}'.format(count, name) for name, count in sorted(step['operations'].items()) if count)
+		print(" {0}. {1}: {2} ({3})".format(i + 1, step['name'], format_duration(step['seconds']), operations or 'no operation'))
+	print("Each step after the first one starts once the operator resumes the run.")
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Estimate the run time of a generated protocol without a robot.')
+	parser.add_argument('protocol', help='generated protocol file')
+	parser.add_argument('--robot', choices=sorted(TIMING_MODELS), help='timing model (default: robot type of the protocol)')
+	args = parser.parse_args()
+	print_run_time_report(estimate_run_time(args.protocol, args.robot))
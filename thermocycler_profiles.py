@@ -0,0 +1,110 @@
+# Thermocycler programs for the cloning and colony PCR generators
+# Builds the named programs (Golden Gate, heat shock, colony PCR) as flat lists of steps, compiles them into the fewest
+# execute_profile calls, as (steps, repetitions) segments, and estimates how long the thermocycler takes to run them.
+# The generators paste the compiled programs into the protocols (thermocycler_programs), the workflows only run them.
+
+import math
+
+
+# Approximate block ramp rates (degrees C per second) of the Opentrons thermocyclers
+RAMP_RATE_HEATING = 4
+RAMP_RATE_COOLING = 2
+
+# Extension time of the polymerase (s per kb of amplicon) and shortest extension (s)
+EXTENSION_RATE = 60
+MIN_EXTENSION_TIME = 15
+
+# Colony PCR cycle of the workflow of each robot: denaturation (C, s) and extension (s) when the amplicon length is not given
+COLONY_PCR_CYCLES = {
+	'OT-2': {'denaturation': (98, 15), 'extension_seconds': 200},
+	'Flex': {'denaturation': (95, 30), 'extension_seconds': 60},
+}
+
+
+def step(temperature, hold_time_seconds):
+	return {'temperature': temperature, 'hold_time_seconds': hold_time_seconds}
+
+def golden_gate_program(cycles=25):
+	"""Return the Golden Gate program: cycles of digestion (37 C) and ligation (16 C), then 60 C to stop the ligase."""
+	return [step(37, 120), step(16, 300)] * cycles + [step(60, 300)]
+
+def heat_shock_program(outgrowth_seconds=3600):
+	"""Return the transformation program: 4 C on ice, heat shock at 42 C, back to 4 C, then outgrowth at 37 C."""
+	return [step(4, 600), step(42, 90), step(4, 120), step(37, outgrowth_seconds)]
+
+def extension_time(amplicon_length=None, extension_rate=EXTENSION_RATE, default_seconds=200):
+	"""Return the extension time (s) for an amplicon length (bp), default_seconds when the length is not known."""
+	if amplicon_length is None:
+		return default_seconds
+	return max(MIN_EXTENSION_TIME, math.ceil(amplicon_length / 1000 * extension_rate))
+
+def colony_pcr_program(annealing_temperature=55, amplicon_length=None, cycles=30, robot_type='OT-2'):
+	"""Return the colony PCR program: initial denaturation, cycles of denaturation, annealing and extension, final extension.
+
+	The denaturation of the cycles and the extension without an amplicon length are those of the robot's workflow."""
+	denaturation_temperature, denaturation_seconds = COLONY_PCR_CYCLES[robot_type]['denaturation']
+	extension_seconds = extension_time(amplicon_length, default_seconds=COLONY_PCR_CYCLES[robot_type]['extension_seconds'])
+	cycle = [step(denaturation_temperature, denaturation_seconds), step(annealing_temperature, 30), step(72, extension_seconds)]
+	return [step(98, 300)] + cycle * cycles + [step(72, 300)]
+
+def compile_program(steps):
+	"""Return the steps as the fewest [steps, repetitions] segments, in order.
+
+	At each step, the block of steps repeated over the most steps is taken as one segment,
+	and the steps that do not repeat are grouped into one segment run once."""
+	segments = []
+	i = 0
+	while i < len(steps):
+		best_length, best_repetitions = 1, 1
+		for length in range(1, (len(steps) - i) // 2 + 1):
+			block = steps[i:i + length]
+			repetitions = 1
+			while steps[i + repetitions * length:i + (repetitions + 1) * length] == block:
+				repetitions += 1
+			if repetitions > 1 and length * repetitions > best_length * best_repetitions:
+				best_length, best_repetitions = length, repetitions
+		if best_repetitions == 1 and segments and segments[-1][1] == 1:
+			segments[-1][0].append(steps[i])
+		else:
+			segments.append([steps[i:i + best_length], best_repetitions])
+		i += best_length * best_repetitions
+	return segments
+
+def ramp_time(start_temperature, end_temperature):
+	"""Return the time (s) the block takes to go from one temperature to another."""
+	if end_temperature >= start_temperature:
+		return (end_temperature - start_temperature) / RAMP_RATE_HEATING
+	return (start_temperature - end_temperature) / RAMP_RATE_COOLING
+
+def profile_duration(steps, repetitions=1, start_temperature=None):
+	"""Return the time (s) of one execute_profile call, ramps included, from the block temperature when it is known."""
+	temperatures = [profile_step['temperature'] for profile_step in steps]
+	hold_time = sum((profile_step.get('hold_time_seconds') or 0) + 60 * (profile_step.get('hold_time_minutes') or 0) for profile_step in steps)
+	ramps = sum(ramp_time(a, b) for a, b in zip(temperatures, temperatures[1:]))
+	seconds = repetitions * (hold_time + ramps) + (repetitions - 1) * ramp_time(temperatures[-1], temperatures[0])
+	if start_temperature is not None:
+		seconds += ramp_time(start_temperature, temperatures[0])
+	return seconds
+
+def program_duration(segments, start_temperature=None):
+	"""Return the time (s) of a compiled program, each segment starting from the last temperature of the previous one."""
+	seconds = 0
+	for steps, repetitions in segments:
+		seconds += profile_duration(steps, repetitions, start_temperature)
+		start_temperature = steps[-1]['temperature']
+	return seconds
+
+def compile_programs(programs):
+	"""Return a dict mapping each program name to the program compiled."""
+	return {name: compile_program(steps) for name, steps in programs.items()}
+
+def cloning_programs():
+	"""Return the compiled programs of the cloning workflows: Golden Gate, then heat shock and outgrowth."""
+	return compile_programs({'golden_gate': golden_gate_program(), 'heat_shock': heat_shock_program()})
+
+def print_programs(compiled_programs):
+	"""Print the execute_profile calls and the cycling time of each compiled program."""
+	for name, segments in compiled_programs.items():
+		nb_steps = sum(len(steps) * repetitions for steps, repetitions in segments)
+		print("Thermocycler program {0}: {1} steps in {2} execute_profile calls, {3} min".format(
+			name, nb_steps, len(segments), math.ceil(program_duration(segments) / 60)))